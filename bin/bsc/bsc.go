@@ -255,6 +255,7 @@ func handle_direction(data []string) {
 	scheds := make([]string, 0)
 	days := make([]string, 0)
 	features := make([]string, 0)
+	frequencies := make([]string, 0)
 	max_sched_width := 0
 	city_block := false
 
@@ -265,9 +266,13 @@ func handle_direction(data []string) {
 		if len(line) == 0 {
 			continue
 		}
-		// Schedules
-		if sc.MatchString(line) {
-			// Should be a schedule line
+		// Frequency directives are passed through, must be checked
+		// before schedules since they hold a time
+		if strings.Index(line, "frequency=") == 0 {
+			city_block = false
+			frequencies = append(frequencies, line)
+		} else if sc.MatchString(line) {
+			// Schedules, should be a schedule line
 			city_block = false
 			// Clean up the line
 			bkts := cl.FindAllString(line, -1)
@@ -354,6 +359,9 @@ func handle_direction(data []string) {
 	}()
 
 	fmt.Printf("\ndirection=\n")
+	for _, f := range frequencies {
+		fmt.Println(f)
+	}
 	st := 0
 	for _, d := range cities {
 		fmt.Printf("\ncity=%s\n", d.city)
@@ -1,6 +1,10 @@
 package main
 
-import "testing"
+import (
+	"io/ioutil"
+	"os"
+	"testing"
+)
 
 func equal(a, b []string) bool {
 	if len(a) != len(b) {
@@ -51,3 +55,41 @@ func TestGetFeatures(t *testing.T) {
 		}
 	}
 }
+
+// Returns the standard output of f
+func capture(t *testing.T, f func()) string {
+	r, w, err := os.Pipe()
+	if err != nil {
+		t.Fatal(err)
+	}
+	stdout := os.Stdout
+	os.Stdout = w
+	f()
+	os.Stdout = stdout
+	w.Close()
+	out, err := ioutil.ReadAll(r)
+	if err != nil {
+		t.Fatal(err)
+	}
+	return string(out)
+}
+
+func TestFrequencyPassThrough(t *testing.T) {
+	data := []string{
+		"c=MONTPELLIER Comedie",
+		"Gare",
+		"days=L à V L à V",
+		"06:00 06:10",
+		"06:05 06:15",
+		"frequency=2;06:20;10",
+	}
+	want := "\ndirection=\nfrequency=2;06:20;10\n" +
+		"\ncity=MONTPELLIER\n" +
+		"Comedie;06:00*1-5*;06:10*1-5*\n" +
+		"Gare;06:05*1-5*;06:15*1-5*\n"
+
+	cities = make([]citySpot, 0)
+	if res := capture(t, func() { handle_direction(data) }); res != want {
+		t.Errorf("got %q, want %q", res, want)
+	}
+}
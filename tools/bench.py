@@ -0,0 +1,270 @@
+#!/usr/bin/env python2
+# -*- coding: latin-1 -*-
+
+"""
+End-to-end build benchmark.
+
+Times every stage of the database build against a tree of bus networks
+(i.e. generated with gensynth.py): pre-filter, parse, makeSQL, chunks
+for Android (both payloads, see --payload of makeres.py) and their
+replay, update tarball, SQLite load and some representative dbcalc
+queries. Results are written as JSON and can be compared to
+the ones of a previous run to spot regressions.
+"""
+
+import sys, os, os.path, shutil, json, time, random, platform, sqlite3
+from optparse import OptionParser
+import makeres, sqlitedb, dbcalc
+
+RESULTS_FILE = 'bench.json'
+# Relative slowdown reported as a regression by --compare
+TOLERANCE = 0.1
+
+class DevNull(object):
+    def write(self, data):
+        pass
+    def flush(self):
+        pass
+
+class Timer(object):
+    """
+    Records wall and CPU (user + sys) times of named stages.
+    """
+    def __init__(self, quiet=False):
+        self.stages = []
+        self.quiet = quiet
+
+    def run(self, name, func, *args, **kwargs):
+        """
+        Runs func, recording its duration under name. Returns the result
+        of func. Output of func is hidden in quiet mode.
+        """
+        stdout = sys.stdout
+        if self.quiet:
+            sys.stdout = DevNull()
+        try:
+            t0, c0 = time.time(), os.times()
+            res = func(*args, **kwargs)
+            t1, c1 = time.time(), os.times()
+        finally:
+            sys.stdout = stdout
+        wall, cpu = t1 - t0, (c1[0] + c1[1]) - (c0[0] + c0[1])
+        self.stages.append((name, {'wall': wall, 'cpu': cpu}))
+        print "[%-18s] %8.3fs wall %8.3fs cpu" % (name, wall, cpu)
+        return res
+
+def parse_all(sources):
+    return [makeres.parse(src) for src in sources]
+
+def clean_state(workdir):
+    """
+    Removes the incremental build state (stable ids, manifest and SQL 
+    fragments) of a previous run, so that makeSQL emits every line.
+    """
+    for name in (makeres.IDS_FILE, makeres.MANIFEST_FILE):
+        if os.path.exists(os.path.join(workdir, name)):
+            os.remove(os.path.join(workdir, name))
+    if os.path.exists(os.path.join(workdir, makeres.FRAGMENTS_DIR)):
+        shutil.rmtree(os.path.join(workdir, makeres.FRAGMENTS_DIR))
+
+def make_sql(networks, sources, outname):
+    out = open(outname, 'w')
+    out.write("BEGIN TRANSACTION;\n")
+    out.write(makeres.DBSTRUCT)
+    makeres.makeSQL(networks, sources, out)
+    out.write("END TRANSACTION;\n")
+    out.close()
+
+def load_sqlite(sqlname, dbname):
+    if os.path.exists(dbname):
+        os.remove(dbname)
+    conn = sqlite3.connect(dbname)
+    f = open(sqlname)
+    conn.executescript(f.read())
+    f.close()
+    conn.close()
+
+def query_stations(c):
+    c.execute('select s.name, c.name from station as s, city as c where s.city_id=c.id order by c.name')
+    return len(c.fetchall())
+
+def query_lines_of_stations(c, station_ids):
+    finder = dbcalc.Finder.__new__(dbcalc.Finder)
+    finder.c = c
+    for stid in station_ids:
+        finder.get_lines(stid)
+
+def query_graph_lines(c, num_lines):
+    for k in range(1, num_lines + 1):
+        dbcalc.graph_line(k, c, render=False)
+
+def query_departures(c, station_ids):
+    for stid in station_ids:
+        for dep in dbcalc.get_departures(stid, c):
+            pass
+
+def query_paths(c, pairs):
+    for sfrom, sto in pairs:
+        dbcalc.Finder(sfrom, sto, c)
+
+def run(srcdir, workdir, timer, options):
+    """
+    Runs all stages once.
+    """
+    makeres.TMP_DIR = workdir
+    makeres.LINES_SRC_DIR = srcdir
+    makeres.DBSTRUCT = sqlitedb.DBSTRUCT
+    makeres.g_timetable = options.timetable
+    makeres.g_cities = []
+
+    f = open(os.path.join(srcdir, makeres.NETWORKS_FILE))
+    networks = json.loads(f.read())
+    f.close()
+
+    sources = timer.run('prefilter', makeres.apply_prefilter, os.path.join(srcdir, 'filter.map'), srcdir)
+    sources.sort()
+    timer.run('parse', parse_all, sources)
+
+    sqlname = os.path.join(workdir, makeres.RAW_DB_FILE)
+    # Every run starts from scratch (see --repeat)
+    clean_state(workdir)
+    timer.run('makeSQL', make_sql, networks, sources, sqlname)
+
+    for name in makeres.chunk_files(makeres.CHUNK_PREFIX, 'xml') + makeres.chunk_files(makeres.ROWS_CHUNK_PREFIX, 'txt'):
+        os.remove(name)
+    num_chunks = timer.run('make_chunks', makeres.make_chunks, sqlname, options.chunksize)
+    timer.run('make_row_chunks', makeres.make_row_chunks, sqlname, options.chunksize)
+    chunks = makeres.chunk_files(makeres.CHUNK_PREFIX, 'xml')
+    row_chunks = makeres.chunk_files(makeres.ROWS_CHUNK_PREFIX, 'txt')
+    chkname = os.path.join(workdir, makeres.CHKSUM_DB_FILE)
+    f = open(chkname, 'w')
+    f.write(makeres.XML_HEADER)
+    f.write('<resources><string name="numchunks">%d</string></resources>\n' % num_chunks)
+    f.close()
+    timer.run('tarball', makeres.make_tarball, chkname)
+
+    dbname = os.path.join(workdir, 'ht.sqlite')
+    timer.run('sqlite load', load_sqlite, sqlname, dbname)
+    replayname = os.path.join(workdir, 'replay.sqlite')
+    timer.run('replay chunks', makeres.load_chunks, chunks, replayname)
+    timer.run('replay rows', makeres.load_row_chunks, row_chunks, replayname)
+    os.remove(replayname)
+
+    # Queries on random stations and lines (always the same ones)
+    rnd = random.Random(0)
+    conn = sqlite3.connect(dbname)
+    c = conn.cursor()
+    num_stations = c.execute('select count(*) from station').fetchone()[0]
+    num_lines = c.execute('select count(*) from line').fetchone()[0]
+    station_ids = [rnd.randint(1, num_stations) for k in range(options.queries)]
+    pairs = [(rnd.randint(1, num_stations), rnd.randint(1, num_stations)) for k in range(options.paths)]
+    timer.run('q stations', query_stations, c)
+    timer.run('q station lines', query_lines_of_stations, c, station_ids)
+    timer.run('q graph lines', query_graph_lines, c, min(num_lines, options.queries))
+    if options.timetable != 'stop':
+        timer.run('q departures', query_departures, c, station_ids)
+    timer.run('q paths', query_paths, c, pairs)
+    c.close()
+    conn.close()
+
+    sizes = {
+        'sources': len(sources),
+        'stations': num_stations,
+        'lines': num_lines,
+        'sql_bytes': os.path.getsize(sqlname),
+        'sqlite_bytes': os.path.getsize(dbname),
+        'chunks': num_chunks,
+        'chunks_bytes': sum([os.path.getsize(name) for name in chunks]),
+        'row_chunks_bytes': sum([os.path.getsize(name) for name in row_chunks]),
+        'tarball_bytes': os.path.getsize(os.path.join(workdir, makeres.UPDATE_TARBALL)),
+    }
+    return sizes
+
+def compare(old, new, tolerance):
+    """
+    Prints a side by side comparison of two results. Returns the number
+    of stages slower than tolerance.
+    """
+    regressions = 0
+    print
+    print "%-18s %10s %10s %8s" % ('stage (wall)', 'before', 'after', 'ratio')
+    for name, data in new['stages']:
+        prev = dict(old['stages']).get(name)
+        if not prev:
+            print "%-18s %10s %10.3f" % (name, '-', data['wall'])
+            continue
+        ratio = data['wall'] / prev['wall'] if prev['wall'] > 0 else 1
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = ' REGRESSION'
+            regressions += 1
+        print "%-18s %10.3f %10.3f %7.2fx%s" % (name, prev['wall'], data['wall'], ratio, flag)
+    for key in sorted(new['sizes'].keys()):
+        print "%-18s %10s %10s" % (key, old['sizes'].get(key, '-'), new['sizes'][key])
+    return regressions
+
+def main():
+    parser = OptionParser(usage="""%prog [options] srcdir
+
+srcdir is a tree of bus networks, i.e. generated with gensynth.py. Its
+network and station names are not ASCII, they are printed UTF-8 encoded
+(no need for PYTHONIOENCODING). makeres.py only writes the build checksum
+of a work directory once a build succeeded: a failed build is not taken
+for an up to date one.""")
+    parser.add_option("-o", '--output', action="store", dest="output", default=None, help="JSON results file [default: %s in work dir]" % RESULTS_FILE)
+    parser.add_option("-w", '--work-dir', action="store", dest="workdir", default=os.path.join(makeres.TMP_DIR, 'bench'), help="work directory [default: %default]")
+    parser.add_option("-r", '--repeat', type="int", dest="repeat", default=1, help="runs every stage N times, keeping the fastest [default: %default]")
+    parser.add_option("", '--compare', action="store", dest="compare", default=None, help="compares results with a previous JSON results file")
+    parser.add_option("", '--tolerance', type="float", dest="tolerance", default=TOLERANCE, help="relative slowdown reported as a regression [default: %default]")
+    parser.add_option("", '--timetable', type="choice", choices=('stop', 'trip', 'both'), dest="timetable", default='both', help="timetable tables to generate [default: %default]")
+    parser.add_option("", '--chunk-size', type="int", dest="chunksize", default=makeres.CHUNK_SIZE, help="chunk size [default: %default]")
+    parser.add_option("", '--queries', type="int", dest="queries", default=50, help="number of queries per query stage [default: %default]")
+    parser.add_option("", '--paths', type="int", dest="paths", default=5, help="number of path queries [default: %default]")
+    parser.add_option("-v", '--verbose', action="store_true", dest="verbose", default=False, help="shows output of stages")
+    options, args = parser.parse_args()
+
+    if len(args) != 1:
+        parser.print_usage()
+        sys.exit(2)
+    srcdir = os.path.abspath(args[0])
+    if not os.path.isfile(os.path.join(srcdir, makeres.NETWORKS_FILE)):
+        parser.error("%s not found in %s" % (makeres.NETWORKS_FILE, srcdir))
+    if not os.path.exists(options.workdir):
+        os.makedirs(options.workdir)
+
+    best = None
+    for k in range(options.repeat):
+        print "Run %d/%d" % (k + 1, options.repeat)
+        timer = Timer(quiet=not options.verbose)
+        sizes = run(srcdir, options.workdir, timer, options)
+        if best is None:
+            best = timer.stages
+        else:
+            best = [(name, min(a, b, key=lambda x: x['wall'])) for (name, a), (n, b) in zip(best, timer.stages)]
+
+    results = {
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'srcdir': srcdir,
+        'timetable': options.timetable,
+        'repeat': options.repeat,
+        'stages': best,
+        'total': {'wall': sum([s[1]['wall'] for s in best]), 'cpu': sum([s[1]['cpu'] for s in best])},
+        'sizes': sizes,
+    }
+    output = options.output or os.path.join(options.workdir, RESULTS_FILE)
+    f = open(output, 'w')
+    f.write(json.dumps(results, indent=2))
+    f.close()
+    print "Wrote %s" % output
+
+    if options.compare:
+        f = open(options.compare)
+        old = json.loads(f.read())
+        f.close()
+        if compare(old, results, options.tolerance):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -5,14 +5,21 @@
 Make DB queries
 """
 
-import os, sys, re, os.path, glob
+import os, sys, re, os.path, glob, heapq, math, json, time
 from optparse import OptionParser
 from makeres import TMP_DIR
 import sqlite3
 
 SQLITEDB = 'ht.sqlite'
+EARTH_RADIUS = 6371000.0 # meters
+# Stations coordinates are scaled by 10^6
+COORDS_SCALE = 10.0**6
 # Global SQLite DB connection
 CONN = None
+# Network shared by batch workers (see batch_paths)
+g_network = None
+# Grid index of stations, built once per process (see get_grid_index)
+g_grid_index = None
 DEBUG = False
 
 def graph_line(num_line, c, render=True):
@@ -117,6 +124,529 @@ def graph_network(c):
     os.system("dot -Tpng %s > %s" % (g_name, p_name))
     print p_name
 
+def get_station_from_num(num, c):
+    """
+    Returns (id, name, city name) of the station with number num, as 
+    listed by the --stations option.
+    """
+    c.execute("""
+SELECT s.id, s.name, c.name 
+FROM station AS s, city AS c 
+WHERE s.city_id=c.id 
+ORDER BY c.name
+    """)
+    k = 1
+    for st in c.fetchall():
+        if k == num:
+            return st[0], st[1].encode('utf-8'), st[2].encode('utf-8')
+        k += 1
+    return None
+
+def expand_frequencies(minutes, first, freqs):
+    """
+    Lazily yields the times of a trip at one of its stations. minutes is 
+    the time of the template trip at that station, first its departure 
+    time and freqs its (start, end, headway) frequency rows, if any.
+    """
+    if not freqs:
+        yield minutes
+        return
+    for start, end, headway in freqs:
+        for dep in xrange(start, end + 1, headway):
+            yield minutes - first + dep
+
+def get_trip_runs(trip_id, c):
+    """
+    Yields all runs of a trip as lists of (seq, minutes) tuples, 
+    frequency-based trips being expanded lazily.
+    """
+    c.execute("SELECT seq, minutes FROM stop_time WHERE trip_id=? ORDER BY seq", (trip_id,))
+    times = c.fetchall()
+    if not times:
+        return
+    c.execute("SELECT start_time, end_time, headway FROM frequency WHERE trip_id=?", (trip_id,))
+    freqs = c.fetchall()
+    first = times[0][1]
+    for dep in expand_frequencies(first, first, freqs):
+        yield [(seq, minutes - first + dep) for seq, minutes in times]
+
+def get_departures(station_id, c):
+    """
+    Yields (minutes, line name, direction name, circulation pattern) of 
+    all departures at a station, in time order, using the trip and 
+    stop_time tables. Frequency rows are expanded lazily.
+    """
+    c.execute("""
+SELECT t.id, st.minutes, l.name, c.name, 
+    CASE WHEN t.circpat='' THEN l.dflt_circpat ELSE t.circpat END,
+    (SELECT MIN(minutes) FROM stop_time WHERE trip_id=t.id)
+FROM line_station AS ls, trip AS t, stop_time AS st, line AS l, city AS c
+WHERE ls.station_id=?
+AND t.line_id=ls.line_id
+AND t.direction_id=ls.direction_id
+AND st.trip_id=t.id
+AND st.seq=ls.rank
+AND l.id=t.line_id
+AND c.id=t.direction_id""", (station_id,))
+    stops = c.fetchall()
+    freqs = {}
+    # Loop lines serve a station more than once
+    c.execute("""
+SELECT DISTINCT f.trip_id, f.start_time, f.end_time, f.headway 
+FROM frequency AS f, stop_time AS st, line_station AS ls, trip AS t
+WHERE ls.station_id=?
+AND t.line_id=ls.line_id
+AND t.direction_id=ls.direction_id
+AND st.trip_id=t.id
+AND st.seq=ls.rank
+AND f.trip_id=t.id""", (station_id,))
+    for f in c:
+        freqs.setdefault(f[0], []).append(f[1:])
+
+    def runs(trip_id, minutes, line, direction, circpat, first):
+        for m in expand_frequencies(minutes, first, freqs.get(trip_id)):
+            yield m, line, direction, circpat
+
+    return heapq.merge(*[runs(*st) for st in stops])
+
+def distance(lat1, lng1, lat2, lng2):
+    """
+    Great circle distance in meters between two points (in degrees).
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2)**2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+def covered_radius(lat, delta):
+    """
+    Distance in meters always covered by a box of delta degrees around 
+    a point at latitude lat.
+    """
+    return min(distance(lat, 0, lat + delta, 0), distance(lat, 0, lat, delta))
+
+class GridIndex(object):
+    """
+    In-memory grid index of stations coordinates, in cells of cellsize 
+    degrees. Same purpose as the station_rtree table of the database.
+    """
+    def __init__(self, points, cellsize=0.01):
+        """
+        points is an iterable of (station id, lat, lng) in degrees.
+        """
+        self.cellsize = cellsize
+        self.cells = {}
+        self.size = 0
+        for stid, lat, lng in points:
+            self.cells.setdefault(self.cell(lat, lng), []).append((stid, lat, lng))
+            self.size += 1
+        if self.cells:
+            self.bounds = (min([c[0] for c in self.cells]), max([c[0] for c in self.cells]), 
+                min([c[1] for c in self.cells]), max([c[1] for c in self.cells]))
+
+    def cell(self, lat, lng):
+        return int(math.floor(lat / self.cellsize)), int(math.floor(lng / self.cellsize))
+
+    def ring(self, center, r):
+        """
+        Yields cells at distance r (in cells) of the center cell.
+        """
+        ci, cj = center
+        for i in range(ci - r, ci + r + 1):
+            for j in range(cj - r, cj + r + 1):
+                if max(abs(i - ci), abs(j - cj)) == r:
+                    yield i, j
+
+    def nearest(self, lat, lng, k):
+        """
+        Returns the k nearest stations of (lat, lng) as a list of 
+        (distance in meters, station id). Only the cells around the point 
+        are searched, ring after ring.
+        """
+        if not self.cells:
+            return []
+        k = min(k, self.size)
+        center = self.cell(lat, lng)
+        mini, maxi, minj, maxj = self.bounds
+        # Rings needed to reach the farthest cell
+        last = max(abs(center[0] - mini), abs(center[0] - maxi), abs(center[1] - minj), abs(center[1] - maxj))
+        best = []
+        r = 0
+        while r <= last:
+            for c in self.ring(center, r):
+                for stid, slat, slng in self.cells.get(c, []):
+                    best.append((distance(lat, lng, slat, slng), stid))
+            best.sort()
+            del best[k:]
+            # Points out of the r rings are at least that far
+            if len(best) == k and best[-1][0] <= covered_radius(lat, r * self.cellsize):
+                break
+            r += 1
+        return best
+
+def has_table(c, name):
+    c.execute("SELECT name FROM sqlite_master WHERE name=?", (name,))
+    return c.fetchone() is not None
+
+def get_counts(c):
+    """
+    Returns a dict of the number of lines, cities and stations, read from 
+    the counts table or counted for databases built without it.
+    """
+    if has_table(c, 'counts'):
+        return dict(c.execute('SELECT name, value FROM counts').fetchall())
+    counts = {}
+    for name, table in (('lines', 'line'), ('cities', 'city'), ('stations', 'station')):
+        c.execute("SELECT COUNT(*) FROM %s" % table)
+        counts[name] = c.fetchone()[0]
+    return counts
+
+def get_grid_index(c):
+    """
+    Returns the grid index of the stations of the database, read once.
+    """
+    global g_grid_index
+    if g_grid_index is None:
+        c.execute("SELECT id, latitude, longitude FROM station WHERE latitude != 0 OR longitude != 0")
+        g_grid_index = GridIndex([(stid, lat / COORDS_SCALE, lng / COORDS_SCALE) for stid, lat, lng in c])
+    return g_grid_index
+
+def get_nearest_stations(lat, lng, k, c):
+    """
+    Returns the k nearest stations of (lat, lng) as a list of (distance 
+    in meters, station id), using the station_rtree spatial index if any 
+    (looking in larger and larger boxes) or an in-memory grid index.
+    """
+    if not has_table(c, 'station_rtree'):
+        return get_grid_index(c).nearest(lat, lng, k)
+
+    c.execute("SELECT COUNT(*) FROM station_rtree")
+    k = min(k, c.fetchone()[0])
+    if k == 0:
+        return []
+    delta = 0.005
+    while True:
+        c.execute("""
+SELECT s.id, s.latitude, s.longitude 
+FROM station_rtree AS r, station AS s
+WHERE r.min_lat >= ? AND r.max_lat <= ? AND r.min_lng >= ? AND r.max_lng <= ?
+AND s.id=r.id""", ((lat - delta) * COORDS_SCALE, (lat + delta) * COORDS_SCALE, 
+            (lng - delta) * COORDS_SCALE, (lng + delta) * COORDS_SCALE))
+        best = sorted([(distance(lat, lng, slat / COORDS_SCALE, slng / COORDS_SCALE), stid) for stid, slat, slng in c])[:k]
+        if len(best) == k and best[-1][0] <= covered_radius(lat, delta):
+            return best
+        if delta > 180:
+            return best
+        delta *= 2
+
+class Network(object):
+    """
+    Line/station connectivity of the whole network, built once from the 
+    line_station table and read-only afterwards. Finds paths with the 
+    least transfers between two stations without querying the database.
+    """
+    def __init__(self, c):
+        # Stations by number, as listed by --stations
+        c.execute("""
+SELECT s.id, s.name, c.name 
+FROM station AS s, city AS c 
+WHERE s.city_id=c.id 
+ORDER BY c.name
+        """)
+        self.stations = [(st[0], "%s, %s" % (st[1].encode('utf-8'), st[2].encode('utf-8'))) for st in c.fetchall()]
+        self.station_names = dict(self.stations)
+        c.execute("SELECT id, name FROM line")
+        self.line_names = dict([(l[0], l[1].encode('utf-8')) for l in c.fetchall()])
+        self.station_lines = {}
+        line_stations = {}
+        c.execute("SELECT DISTINCT line_id, station_id FROM line_station ORDER BY line_id, station_id")
+        for line_id, station_id in c:
+            self.station_lines.setdefault(station_id, []).append(line_id)
+            line_stations.setdefault(line_id, []).append(station_id)
+        self.line_stations = dict([(l, set(sts)) for l, sts in line_stations.iteritems()])
+        # Line -> list of (connected line, first transfer station)
+        self.connections = {}
+        for line_id, sts in line_stations.iteritems():
+            seen = set([line_id])
+            conns = []
+            for st in sts:
+                for other in self.station_lines[st]:
+                    if other not in seen:
+                        seen.add(other)
+                        conns.append((other, st))
+            self.connections[line_id] = conns
+
+    def station_from_num(self, num):
+        if 1 <= num <= len(self.stations):
+            return self.stations[num - 1][0]
+        return None
+
+    def find_path(self, from_id, to_id):
+        """
+        Returns the path with the least transfers from station from_id to 
+        station to_id as a list of (line id, station id where to board it), 
+        or None if there is no such path. Breadth-first search on lines.
+        """
+        prev = {}
+        queue = []
+        for line_id in self.station_lines.get(from_id, []):
+            prev[line_id] = (None, from_id)
+            queue.append(line_id)
+        k = 0
+        while k < len(queue):
+            line_id = queue[k]
+            k += 1
+            if to_id in self.line_stations[line_id]:
+                path = []
+                while line_id is not None:
+                    path.append((line_id, prev[line_id][1]))
+                    line_id = prev[line_id][0]
+                path.reverse()
+                return path
+            for other, st in self.connections[line_id]:
+                if not prev.has_key(other):
+                    prev[other] = (line_id, st)
+                    queue.append(other)
+        return None
+
+    def path_result(self, sfrom, sto):
+        """
+        Path between station numbers sfrom and sto as a dictionary (one 
+        JSON line of batch output).
+        """
+        res = {'from': sfrom, 'to': sto}
+        from_id, to_id = self.station_from_num(sfrom), self.station_from_num(sto)
+        if from_id is None or to_id is None:
+            res['error'] = 'station not found'
+            return res
+        res['from_name'] = self.station_names[from_id]
+        res['to_name'] = self.station_names[to_id]
+        path = self.find_path(from_id, to_id)
+        if path is None:
+            res['path'] = None
+        else:
+            res['path'] = [{'line': self.line_names[l], 'board': self.station_names[st]} for l, st in path]
+            res['transfers'] = len(path) - 1
+        return res
+
+def near_result(lat, lng, k):
+    """
+    Nearest stations of (lat, lng) as a dictionary (one JSON line of 
+    batch output), from the grid index.
+    """
+    stations = [{'distance': int(dist), 'name': g_network.station_names[stid]} 
+        for dist, stid in g_grid_index.nearest(lat, lng, k)]
+    return {'near': [lat, lng], 'stations': stations}
+
+def batch_path(query):
+    if query[0] == 'near':
+        return json.dumps(near_result(*query[1:]), sort_keys=True)
+    return json.dumps(g_network.path_result(*query), sort_keys=True)
+
+def read_pairs(f):
+    """
+    Yields (from, to) station numbers read from f, one FROM,TO pair per 
+    line, or ('near', lat, lng) for "near LAT,LNG" lines. Empty lines 
+    and comments are skipped.
+    """
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            if line.startswith('near '):
+                lat, lng = map(float, line[5:].split(','))
+                yield 'near', lat, lng
+                continue
+            sfrom, sto = line.split(',')
+            yield int(sfrom), int(sto)
+        except ValueError:
+            print >> sys.stderr, "Skipping bad input line: %s" % line
+
+def batch_paths(pairs, c, out, jobs=None, count=5):
+    """
+    Writes a JSON line per path between pairs of station numbers into out, 
+    or per list of the count nearest stations of a point (see 
+    read_pairs()). The network and the grid index of stations are built 
+    once then shared by jobs worker processes (forked after they are 
+    built, never copied). Returns the number of lines written.
+    """
+    import multiprocessing
+    global g_network
+    g_network = Network(c)
+    get_grid_index(c)
+    queries = (q + (count,) if q[0] == 'near' else q for q in pairs)
+    pool = multiprocessing.Pool(jobs)
+    k = 0
+    try:
+        for line in pool.imap(batch_path, queries, chunksize=64):
+            out.write(line + '\n')
+            k += 1
+    finally:
+        pool.close()
+        pool.join()
+    return k
+
+def transfer_matrix(c, filename, block=1024):
+    """
+    All-pairs minimum number of transfers between stations, computed 
+    with NumPy boolean matrix products on the station x line incidence 
+    matrix of line_station (a SciPy sparse matrix if available), block 
+    rows of stations at a time. Blocks are written to the .npy file 
+    filename, memory mapped, so the matrix never has to fit in memory.
+
+    Returns (matrix, station ids): matrix[i, j] is the minimum number of 
+    transfers from station i to station j (-1 if unreachable), stations 
+    being ordered by number (as listed by --stations).
+    """
+    import numpy
+    from numpy.lib.format import open_memmap
+    try:
+        from scipy import sparse
+    except ImportError:
+        sparse = None
+    c.execute("""
+SELECT s.id 
+FROM station AS s, city AS c 
+WHERE s.city_id=c.id 
+ORDER BY c.name
+    """)
+    station_ids = numpy.array([st[0] for st in c.fetchall()], dtype=numpy.int32)
+    srank = dict([(stid, k) for k, stid in enumerate(station_ids)])
+    c.execute("SELECT DISTINCT station_id, line_id FROM line_station")
+    pairs = [(srank[st], line_id) for st, line_id in c.fetchall() if srank.has_key(st)]
+    line_ids = sorted(set([p[1] for p in pairs]))
+    lrank = dict([(lid, k) for k, lid in enumerate(line_ids)])
+
+    # Incidence from (station, line) index pairs; float32 to use BLAS products
+    n = len(station_ids)
+    rows = [p[0] for p in pairs]
+    cols = [lrank[p[1]] for p in pairs]
+    if sparse:
+        inc = sparse.csr_matrix((numpy.ones(len(pairs), dtype=numpy.float32), (rows, cols)), 
+            shape=(n, len(line_ids)))
+        conn = inc.T.dot(inc).toarray()
+    else:
+        inc = numpy.zeros((n, len(line_ids)), dtype=numpy.float32)
+        if pairs:
+            inc[rows, cols] = 1
+        conn = numpy.dot(inc.T, inc)
+    # Line x line: lines sharing a station
+    conn = (conn > 0).astype(numpy.float32)
+
+    matrix = open_memmap(filename, mode='w+', dtype=numpy.int8, shape=(n, n))
+    for start in range(0, n, block):
+        end = min(n, start + block)
+        dist = numpy.empty((end - start, n), dtype=numpy.int8)
+        dist.fill(-1)
+        # Lines reachable from every station of the block with t transfers
+        lines = inc[start:end]
+        if sparse:
+            lines = lines.toarray()
+        lines = lines > 0
+        t = 0
+        while True:
+            # (stations x lines) . (lines x block), transposed
+            reach = inc.dot(lines.T.astype(numpy.float32)).T > 0
+            dist[reach & (dist < 0)] = t
+            more = numpy.dot(lines.astype(numpy.float32), conn) > 0
+            if (more == lines).all() or t == 126:
+                break
+            lines = more
+            t += 1
+        matrix[start:end] = dist
+    matrix.flush()
+    return matrix, station_ids
+
+def save_transfer_index(station_ids, filename):
+    """
+    Saves the station index of the transfer matrix filename (.npy file, 
+    numpy.load(filename, mmap_mode='r') maps it) in the -stations.npy 
+    file next to it. Returns the name of the index file.
+    """
+    import numpy
+    index = re.sub(r'(\.npy)?$', '-stations.npy', filename, count=1)
+    numpy.save(index, station_ids)
+    return index
+
+def load_columns(coldir):
+    """
+    Memory maps the stop columns written by makeres.py --columns. Returns 
+    a dictionary of arrays and the metadata (patterns, lines and cities 
+    names).
+    """
+    import numpy
+    cols = {}
+    for name in ('station', 'line', 'direction', 'run', 'minutes', 'pattern'):
+        cols[name] = numpy.load(os.path.join(coldir, name + '.npy'), mmap_mode='r')
+    f = open(os.path.join(coldir, 'meta.json'))
+    meta = json.loads(f.read())
+    f.close()
+    return cols, meta
+
+def stop_stats(cols):
+    """
+    Service reports computed with vectorized operations over the stop 
+    columns. A run departs at its first stop (its earliest time, times 
+    past midnight keep increasing). Runs are grouped by line, direction 
+    and circulation pattern. Returns a list of dictionaries with the line, 
+    direction and pattern ids, first and last departures (minutes past 
+    midnight of the service day, may exceed 24 * 60), number of runs, mean 
+    headway between departures and mean headway per hour of the service 
+    day (minutes) of every group.
+    """
+    import numpy
+    if len(cols['run']) == 0:
+        return []
+
+    # Departure of every run
+    order = numpy.argsort(cols['run'], kind='mergesort')
+    run = numpy.asarray(cols['run'])[order]
+    runstarts = numpy.flatnonzero(numpy.append(True, run[1:] != run[:-1]))
+    deps = numpy.minimum.reduceat(numpy.asarray(cols['minutes'])[order].astype(numpy.int32), runstarts)
+    line, direction, pattern = [numpy.asarray(cols[k])[order][runstarts] for k in ('line', 'direction', 'pattern')]
+
+    # Runs in departure order within groups of (line, direction, pattern)
+    order = numpy.lexsort((deps, pattern, direction, line))
+    deps, line, direction, pattern = deps[order], line[order], direction[order], pattern[order]
+    n = len(deps)
+    newgroup = numpy.ones(n, dtype=bool)
+    newgroup[1:] = (line[1:] != line[:-1]) | (direction[1:] != direction[:-1]) | (pattern[1:] != pattern[:-1])
+    starts = numpy.flatnonzero(newgroup)
+    gid = numpy.cumsum(newgroup) - 1
+    ngroups = len(starts)
+
+    first = deps[starts]
+    last = numpy.maximum.reduceat(deps, starts)
+    trips = numpy.diff(numpy.append(starts, n))
+
+    # Headways between consecutive departures, by hour of the service day
+    same = ~newgroup[1:]
+    headways = (deps[1:] - deps[:-1])[same]
+    hgid = gid[1:][same]
+    hours = deps[:-1][same] / 60
+    nhours = max(24, int(hours.max()) + 1 if len(hours) else 0)
+    hcount = numpy.bincount(hgid, minlength=ngroups)
+    hsum = numpy.bincount(hgid, weights=headways, minlength=ngroups)
+    bycount = numpy.bincount(hgid * nhours + hours, minlength=ngroups * nhours).reshape(ngroups, nhours)
+    bysum = numpy.bincount(hgid * nhours + hours, weights=headways, minlength=ngroups * nhours).reshape(ngroups, nhours)
+
+    stats = []
+    for k in range(ngroups):
+        hourly = {}
+        for h in numpy.flatnonzero(bycount[k]):
+            hourly[int(h)] = bysum[k, h] / bycount[k, h]
+        stats.append({
+            'line': int(line[starts[k]]),
+            'direction': int(direction[starts[k]]),
+            'pattern': int(pattern[starts[k]]),
+            'first': int(first[k]),
+            'last': int(last[k]),
+            'trips': int(trips[k]),
+            'headway': hsum[k] / hcount[k] if hcount[k] else None,
+            'hourly': hourly,
+        })
+    return stats
+
 class Finder(object):
     def __init__(self, sfrom, sto, c):
         self.c = c
@@ -127,7 +657,10 @@ class Finder(object):
         self.find_path(sfrom, sto)
 
     def get_lines(self, station_id):
-        self.c.execute("SELECT line_id, direction_id FROM line_station WHERE station_id=?", (station_id,))
+        if not hasattr(self, 'lines_table'):
+            # Databases built without the aggregate tables
+            self.lines_table = 'station_line' if has_table(self.c, 'station_line') else 'line_station'
+        self.c.execute("SELECT DISTINCT line_id, direction_id FROM %s WHERE station_id=?" % self.lines_table, (station_id,))
         res = self.c.fetchall()
         from_lines_ids = {}
         for d in res:
@@ -228,7 +761,7 @@ ORDER BY c.name
 def main():
     global CONN, DEBUG
 
-    parser = OptionParser(usage="""%prog [--path|--stations|--cities] [dbfile]""")
+    parser = OptionParser(usage="""%prog [--path|--batch|--stations|--cities] [dbfile]""")
     parser.add_option("-d", '', action="store_true", dest="debug", default=False, help='Debug output')
     parser.add_option("-p", '--path', action="store", metavar="FROM,TO", dest="path", default=None, help='Compute path from station number FROM to station number TO')
     parser.add_option("-c", '--cities', action="store_true", dest="cities", default=False, help='Show list of cities')
@@ -236,6 +769,14 @@ def main():
     parser.add_option("-l", '--lines', action="store_true", dest="lines", default=False, help='Show list of lines')
     parser.add_option("", '--graph-line', action="store", metavar="LINE_NUM", type="int", dest="graphline", default=None, help='Graph a line with all stations (dot graphviz)')
     parser.add_option("-n", '--network', action="store_true", dest="network", default=False, help='Graph full HT network')
+    parser.add_option("", '--station-lines', action="store", metavar="STATION_NUM", type="int", dest="stationlines", default=None, help='Show lines serving station number STATION_NUM, with their service span')
+    parser.add_option("", '--departures', action="store", metavar="STATION_NUM", type="int", dest="departures", default=None, help='Show all departures at station number STATION_NUM (needs trip tables)')
+    parser.add_option("", '--near', action="store", metavar="LAT,LNG", dest="near", default=None, help='Show the nearest stations of a point')
+    parser.add_option("-b", '--batch', action="store", metavar="FILE", dest="batch", default=None, help='Compute paths of the FROM,TO pairs of FILE (one per line, - for stdin) as JSON lines, or the nearest stations of "near LAT,LNG" lines')
+    parser.add_option("-j", '--jobs', type="int", dest="jobs", default=None, help='Number of worker processes of --batch [default: number of CPUs]')
+    parser.add_option("", '--transfers', action="store", metavar="FILE", dest="transfers", default=None, help='Compute the all-pairs transfer count matrix of stations into FILE (.npy, needs NumPy)')
+    parser.add_option("", '--stats', action="store", metavar="DIR", dest="stats", default=None, help='Show headways and service spans of lines from the stop columns in DIR (makeres.py --columns, needs NumPy)')
+    parser.add_option("-k", '', type="int", dest="count", default=5, help='Number of stations shown by --near (and near queries of --batch) [default: %default]')
     parser.add_option("-f", '--find', action="store", dest="find", metavar="KEYWORD", default=None, help='Search the DB for a match in city, line or station name')
 
     options, args = parser.parse_args()
@@ -243,6 +784,29 @@ def main():
         parser.print_usage()
         sys.exit(2)
 
+    if options.stats:
+        # No database needed
+        try:
+            import numpy
+        except ImportError:
+            print "NumPy is required by --stats"
+            sys.exit(1)
+        t0 = time.time()
+        cols, meta = load_columns(options.stats)
+        stats = stop_stats(cols)
+        # Times past midnight are shown as 24:10, not 00:10
+        hhmm = lambda m: "%02d:%02d" % (m / 60, m % 60)
+        print "%-10s %-25s %-8s %5s %5s %5s %5s %7s  %s" % ('line', 'direction', 'pattern', 'first', 'last', 
+            'span', 'trips', 'headway', 'headway by hour')
+        for st in stats:
+            print "%-10s %-25s %-8s %5s %5s %5s %5d %7s  %s" % (meta['lines'][str(st['line'])].encode('utf-8'), 
+                meta['cities'][str(st['direction'])].encode('utf-8'), meta['patterns'][st['pattern']].encode('utf-8'),
+                hhmm(st['first']), hhmm(st['last']), hhmm(st['last'] - st['first']), st['trips'], 
+                "%.1f" % st['headway'] if st['headway'] is not None else '-',
+                ' '.join(["%02dh:%.0f" % (h, v) for h, v in sorted(st['hourly'].iteritems())]))
+        print "%d stops, %d groups in %.3fs" % (len(cols['minutes']), len(stats), time.time() - t0)
+        return
+
     # Default path to DB
     db_path = os.path.join(os.getenv('HOME'), SQLITEDB)
     if len(args) == 1:
@@ -255,12 +819,16 @@ def main():
     DEBUG = options.debug
     CONN = sqlite3.connect(db_path)
     c = CONN.cursor()
-    c.execute('select count(*) from line')
-    num_lines = c.fetchone()[0]
-    c.execute('select count(*) from city')
-    num_cities = c.fetchone()[0]
-    c.execute('select count(*) from station')
-    num_stations = c.fetchone()[0]
+    counts = get_counts(c)
+    num_lines, num_cities, num_stations = counts['lines'], counts['cities'], counts['stations']
+
+    if options.batch:
+        # Only JSON on stdout
+        f = sys.stdin if options.batch == '-' else open(options.batch)
+        batch_paths(read_pairs(f), c, sys.stdout, options.jobs, options.count)
+        f.close()
+        c.close()
+        return
 
     print "Using database: %s" % db_path
     print "%d lines, %d cities, %d stations" % (num_lines, num_cities, num_stations)
@@ -286,6 +854,76 @@ def main():
             print "%3d. %s" % (k, li[0].encode('utf-8'))
             k += 1
 
+    if options.stationlines:
+        st = get_station_from_num(options.stationlines, c)
+        if not st:
+            print "Station %d not found." % options.stationlines
+            sys.exit(1)
+        if not has_table(c, 'line_service'):
+            print "No line_service table in %s, rebuild the database." % db_path
+            sys.exit(1)
+        print "Lines at %s, %s" % (st[1], st[2])
+        c.execute("""
+SELECT l.name, c.name, sl.rank, ls.first_departure, ls.last_departure, ls.runs
+FROM station_line AS sl, line AS l, city AS c, line_service AS ls
+WHERE sl.station_id=?
+AND l.id=sl.line_id
+AND c.id=sl.direction_id
+AND ls.line_id=sl.line_id
+AND ls.direction_id=sl.direction_id
+ORDER BY l.name""", (st[0],))
+        # Times past midnight are shown as 24:10, not 00:10
+        hhmm = lambda m: "%02d:%02d" % (m / 60, m % 60)
+        for line, direction, rank, first, last, runs in c.fetchall():
+            print "%-10s -> %-25s stop #%-3d %s-%s %4d runs" % (line.encode('utf-8'), direction.encode('utf-8'), 
+                rank, hhmm(first), hhmm(last), runs)
+
+    if options.departures:
+        st = get_station_from_num(options.departures, c)
+        if not st:
+            print "Station %d not found." % options.departures
+            sys.exit(1)
+        print "Departures at %s, %s" % (st[1], st[2])
+        k = 0
+        for minutes, line, direction, circpat in get_departures(st[0], c):
+            print "%02d:%02d  %-10s -> %-25s [%s]" % ((minutes / 60) % 24, minutes % 60, 
+                line.encode('utf-8'), direction.encode('utf-8'), circpat.encode('utf-8'))
+            k += 1
+        if k == 0:
+            print "No departures (database built with --timetable=stop?)"
+
+    if options.transfers:
+        try:
+            import numpy
+        except ImportError:
+            print "NumPy is required by --transfers"
+            sys.exit(1)
+        t0 = time.time()
+        # As numpy.save() does
+        filename = re.sub(r'(\.npy)?$', '.npy', options.transfers, count=1)
+        matrix, station_ids = transfer_matrix(c, filename)
+        index = save_transfer_index(station_ids, filename)
+        # Row blocks, as written
+        connected = tmax = 0
+        for start in range(0, len(matrix), 1024):
+            rows = matrix[start:start + 1024]
+            connected += (rows >= 0).sum()
+            tmax = max(tmax, rows.max())
+        print "%dx%d transfer matrix computed in %.2fs, %d%% of pairs connected, %d transfers max" % (
+            matrix.shape + (time.time() - t0, 100 * connected / matrix.size if matrix.size else 0, tmax))
+        print "Wrote %s and %s" % (filename, index)
+
+    if options.near:
+        try:
+            lat, lng = map(float, options.near.split(','))
+        except ValueError:
+            print "Bad input format. Must be lat,lng"
+            sys.exit(1)
+        for dist, stid in get_nearest_stations(lat, lng, options.count, c):
+            c.execute("SELECT s.name, c.name FROM station AS s, city AS c WHERE s.id=? AND s.city_id=c.id", (stid,))
+            st = c.fetchone()
+            print "%6dm  %s, %s" % (dist, st[0].encode('utf-8'), st[1].encode('utf-8'))
+
     # Graph line ID
     if options.graphline:
         graph_line(options.graphline, c)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python2
+# -*- coding: latin-1 -*-
+
+"""
+Synthetic bus networks generator.
+
+Writes a tree of bus networks that can be used in place of the real
+line schedules (see lines.dir in local.properties) to measure the
+build reproducibly: a networks.json file, a filter.map file, gps.csv
+and stations-gps.csv caches and one directory of .txt line files per network, in the format
+expected by makeres.parse() (i.e. as compiled by bsc).
+
+Default sizes are in the range of our largest real network, use
+--scale to grow every dimension (--scale 10 for a 10x network).
+"""
+
+import sys, os, os.path, json, random
+from optparse import OptionParser
+from makeres import smart_capitalize, to_hhmm
+
+SYLLABLES = ('mont', 'pel', 'lier', 'la', 'tes', 'cas', 'tel', 'nau', 'gran', 'ges', 'bé',
+    'ziers', 'lu', 'nel', 'pé', 'rols', 'mau', 'guio', 'sè', 'te', 'vé', 'das', 'ja', 'cou',
+    'fa', 'bré', 'gues', 'pi', 'gnan', 'cla', 'piers', 'ma', 'rseil', 'lan')
+# Station name prefixes. Misspelled ones are fixed by the generated filter.map
+PREFIXES = ('Place', 'Avenue', 'Rue', 'Gare', 'Mairie', 'Eglise', 'Colege', 'Ecole', 'Stade',
+    'Lycée', 'Route de', 'Zone', 'Pont', 'Quai', 'Chemin du')
+FILTERS = (('Eglise', 'Église'), ('Colege', 'Collège'), ('Ecole', 'École'))
+CIRC_PATTERNS = ('1-6', '1-6', '1-6', '1-6', '1-5', '1-5S', '6', '7', '7,r')
+NETWORK_COLORS = ('#e2001a', '#0069b4', '#f39200', '#009640', '#662483', '#5b5b5b')
+
+# Default sizes
+NETWORKS = 3
+LINES = 20              # per network
+CITIES = 15             # per network
+STATIONS = 12           # per city
+TRIPS = 24              # per direction
+
+def make_name(rnd, used, minsyl=2, maxsyl=4):
+    """
+    Returns a new pronounceable name, unique among used.
+    """
+    while True:
+        name = ''.join([rnd.choice(SYLLABLES) for k in range(rnd.randint(minsyl, maxsyl))])
+        if name not in used:
+            used.add(name)
+            return name
+
+def make_line(rnd, name, circpat, cities, stations, trips):
+    """
+    Returns the content of a .txt line file. cities is the list of
+    cities served by the line (in order), stations a dictionnary of
+    city -> list of stations served.
+    """
+    out = []
+    out.append("# Generated by the gensynth.py script. DO NOT EDIT!")
+    out.append("name=%s" % name)
+    out.append("circulation=%s" % circpat)
+    out.append("color=#%06x" % rnd.randint(0, 0xffffff))
+    out.append("from=2014-09-01")
+    out.append("to=2015-07-04")
+
+    route = []
+    for city in cities:
+        for st in stations[city]:
+            route.append((city, st))
+    # Running time (minutes) from the previous station
+    runs = [0] + [rnd.randint(1, 4) for k in range(len(route) - 1)]
+
+    for direct in range(2):
+        if direct == 1:
+            route.reverse()
+            runs = [0] + list(reversed(runs[1:]))
+        # Departures: a regular block at a constant headway then irregular runs
+        # within a 05:00-23:00 service day
+        deps = []
+        regular = trips / 2
+        headway = min(rnd.choice((10, 15, 20, 30)), max(1, 8 * 60 / max(1, regular)))
+        start = rnd.randint(5 * 60, 7 * 60)
+        for k in range(regular):
+            deps.append(start + k * headway)
+        dep = deps[-1] if deps else start
+        for k in range(trips - regular):
+            avg = max(1, (23 * 60 - dep) / (trips - regular - k))
+            dep += rnd.randint(1, 2 * avg)
+            deps.append(dep)
+        pats = []
+        for k in range(trips):
+            if k < regular:
+                pats.append(circpat)
+            else:
+                pats.append(rnd.choice(CIRC_PATTERNS))
+
+        out.append('')
+        out.append('direction=')
+        curcity = None
+        elapsed = 0
+        for j, (city, st) in enumerate(route):
+            elapsed += runs[j]
+            if city != curcity:
+                out.append('')
+                out.append('city=%s' % city)
+                curcity = city
+            times = []
+            for k, dep in enumerate(deps):
+                # Some runs skip intermediate stations
+                if 0 < j < len(route) - 1 and rnd.random() < 0.05:
+                    times.append('-')
+                else:
+                    times.append("%s*%s*" % (to_hhmm(dep + elapsed), pats[k]))
+            out.append("%s;%s" % (st, ';'.join(times)))
+
+    return '\n'.join(out) + '\n'
+
+def generate(outdir, networks=NETWORKS, lines=LINES, cities=CITIES, stations=STATIONS, trips=TRIPS, seed=0):
+    """
+    Generates a synthetic tree in outdir. Returns the number of line
+    files written.
+    """
+    rnd = random.Random(seed)
+    # Stations coordinates (keeps lines the same for a given seed)
+    georand = random.Random(seed)
+    used = set()
+    nets = {}
+    gps = []
+    stgps = []
+    count = 0
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    for n in range(networks):
+        netname = "Réseau %s" % make_name(rnd, used).capitalize()
+        path = "net%02d" % (n + 1)
+        nets[netname] = {'path': path, 'color': NETWORK_COLORS[n % len(NETWORK_COLORS)]}
+        netdir = os.path.join(outdir, path)
+        if not os.path.exists(netdir):
+            os.makedirs(netdir)
+
+        # City -> stations pool
+        pool = {}
+        for k in range(cities):
+            city = make_name(rnd, used).upper()
+            pool[city] = []
+            for j in range(stations):
+                pool[city].append("%s %s" % (rnd.choice(PREFIXES), make_name(rnd, used, 1, 3).capitalize()))
+            cityname = smart_capitalize(unicode(city, 'utf-8')).encode('utf-8')
+            lat, lng = 43 + rnd.random(), 3 + rnd.random()
+            gps.append("%s;%f;%f" % (cityname, lat, lng))
+            for st in pool[city]:
+                # Named as in the database, once filtered
+                for old, new in FILTERS:
+                    st = st.replace(old, new)
+                stgps.append("%s;%s;%f;%f" % (smart_capitalize(unicode(st, 'utf-8')).encode('utf-8'), cityname,
+                    lat + (georand.random() - 0.5) / 50, lng + (georand.random() - 0.5) / 50))
+
+        names = sorted(pool.keys())
+
+        for k in range(lines):
+            served = rnd.sample(names, rnd.randint(2, min(5, len(names))))
+            sts = {}
+            for city in served:
+                sts[city] = sorted(rnd.sample(pool[city], rnd.randint(2, min(8, len(pool[city])))))
+            name = "%d" % (100 * (n + 1) + k + 1)
+            f = open(os.path.join(netdir, "%s.txt" % name), 'w')
+            f.write(make_line(rnd, name, rnd.choice(('1-6', '1-5')), served, sts, trips))
+            f.close()
+            count += 1
+
+    f = open(os.path.join(outdir, 'networks.json'), 'w')
+    f.write(json.dumps(nets, indent=2))
+    f.close()
+
+    f = open(os.path.join(outdir, 'filter.map'), 'w')
+    f.write("# Generated by the gensynth.py script. DO NOT EDIT!\n")
+    for old, new in FILTERS:
+        f.write("%s;%s\n" % (old, new))
+    f.close()
+
+    f = open(os.path.join(outdir, 'gps.csv'), 'w')
+    f.write('\n'.join(gps) + '\n')
+    f.close()
+
+    f = open(os.path.join(outdir, 'stations-gps.csv'), 'w')
+    f.write('\n'.join(stgps) + '\n')
+    f.close()
+
+    return count
+
+def main():
+    parser = OptionParser(usage="""%prog [options] outdir""")
+    parser.add_option("-n", '--networks', type="int", dest="networks", default=NETWORKS, help="number of networks [default: %default]")
+    parser.add_option("-l", '--lines', type="int", dest="lines", default=LINES, help="lines per network [default: %default]")
+    parser.add_option("-c", '--cities', type="int", dest="cities", default=CITIES, help="cities per network [default: %default]")
+    parser.add_option("-s", '--stations', type="int", dest="stations", default=STATIONS, help="stations per city [default: %default]")
+    parser.add_option("-t", '--trips', type="int", dest="trips", default=TRIPS, help="trips per line direction [default: %default]")
+    parser.add_option("", '--scale', type="float", dest="scale", default=1, help="multiplies lines, cities and trips [default: %default]")
+    parser.add_option("", '--seed', type="int", dest="seed", default=0, help="random seed [default: %default]")
+    options, args = parser.parse_args()
+
+    if len(args) != 1:
+        parser.print_usage()
+        sys.exit(2)
+
+    scale = lambda x: max(1, int(round(x * options.scale)))
+    count = generate(args[0], options.networks, scale(options.lines), scale(options.cities),
+        options.stations, scale(options.trips), options.seed)
+    print "Wrote %d lines in %s" % (count, args[0])
+
+if __name__ == '__main__':
+    main()
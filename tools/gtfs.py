@@ -0,0 +1,400 @@
+#!/usr/bin/env python2
+# -*- coding: latin-1 -*-
+
+"""
+GTFS feed importer.
+
+Converts a GTFS feed (directory of routes.txt, trips.txt, stops.txt,
+stop_times.txt, calendar.txt... files) into .txt line files, in the
+format expected by makeres.parse() (i.e. as compiled by bsc), so that
+the lines of other operators can be merged in our database. makeres.py
+imports the feed of every network with a "gtfs" entry (feed directory,
+relative to lines.dir) in networks.json:
+
+    "Réseau TaM": {"path": "tam", "color": "#0069b4", "gtfs": "feeds/tam"}
+
+stop_times.txt is streamed in a single pass: its rows are spilled on
+disk per route (SPILL_ROWS rows at most in memory), then every route is
+processed on its own. Memory is bounded by the largest route, not by the
+size of the feed.
+
+GTFS has no notion of city: a stop belongs to the nearest city of the
+GPS cache (gps.csv) within CITY_RADIUS km, or else to a city named after
+the agency. Service exceptions (calendar_dates.txt) are ignored, trips
+get the days pattern of their calendar.txt service. Routes served in a
+single direction get a reverse direction listing their stations, with no
+runs.
+
+Running this module converts a feed offline:
+
+    python gtfs.py feeds/tam raw/tam
+"""
+
+import sys, os, os.path, csv, json, glob, math, hashlib, shutil, tempfile
+from optparse import OptionParser
+
+# Rows of stop_times.txt kept in memory before being spilled on disk
+SPILL_ROWS = 100000
+CITY_RADIUS = 10 # km
+STAMP_FILE = '.gtfs'
+# First line of the line files, only those are removed from outdir
+HEADER = "# Generated by the gtfs.py script. DO NOT EDIT!"
+FEED_FILES = ('agency.txt', 'routes.txt', 'trips.txt', 'stops.txt', 'stop_times.txt', 'calendar.txt')
+DAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+def read_csv(filename):
+    """
+    Yields the rows of a GTFS file as dictionaries (empty if the file is
+    missing). Values are UTF-8 strings.
+    """
+    if not os.path.exists(filename):
+        return
+    f = open(filename, 'rb')
+    reader = csv.reader(f)
+    header = None
+    for row in reader:
+        if header is None:
+            # Some feeds start with a BOM
+            header = [h.strip().lstrip('\xef\xbb\xbf') for h in row]
+            continue
+        if row:
+            yield dict(zip(header, [v.strip() for v in row]))
+    f.close()
+
+def read_cities(cache_file):
+    """
+    Returns a list of (city, lat, lng) of the GPS cache (city;lat;lng).
+    """
+    cities = []
+    if not cache_file or not os.path.exists(cache_file):
+        return cities
+    for line in open(cache_file):
+        k = line.strip().split(';')
+        if len(k) != 3 or k[0].startswith('#'):
+            continue
+        lat, lng = float(k[1]), float(k[2])
+        if lat or lng:
+            cities.append((k[0], lat, lng))
+    return cities
+
+def nearest_city(cities, lat, lng):
+    """
+    Nearest city within CITY_RADIUS km, or None.
+    """
+    best, dist = None, CITY_RADIUS
+    for city, clat, clng in cities:
+        # Equirectangular approximation, fine at city scale
+        x = math.radians(lng - clng) * math.cos(math.radians((lat + clat) / 2))
+        y = math.radians(lat - clat)
+        d = math.sqrt(x * x + y * y) * 6371
+        if d < dist:
+            best, dist = city, d
+    return best
+
+def clean_name(name):
+    """
+    Station or line name safe for the line format: ';' separates stops
+    and '/' splits station names (see makeres.parse()).
+    """
+    return name.replace(';', ',').replace('/', '-').lstrip('#').strip()
+
+def days_pattern(days):
+    """
+    Circulation pattern of a list of 7 days flags (monday first), i.e.
+    1-5 for week days or 6,7 for week ends.
+    """
+    out = []
+    k = 0
+    while k < 7:
+        if not days[k]:
+            k += 1
+            continue
+        j = k
+        while j + 1 < 7 and days[j + 1]:
+            j += 1
+        if j - k >= 2:
+            out.append("%d-%d" % (k + 1, j + 1))
+        else:
+            out.extend([str(d + 1) for d in range(k, j + 1)])
+        k = j + 1
+    return ','.join(out)
+
+def gtfs_date(value):
+    """
+    YYYYMMDD to YYYY-MM-DD.
+    """
+    if len(value) != 8:
+        return ''
+    return "%s-%s-%s" % (value[:4], value[4:6], value[6:])
+
+def to_minutes(value):
+    """
+    Minutes past midnight of a GTFS H:MM:SS time (can be over 24:00:00),
+    None if empty.
+    """
+    if not value:
+        return None
+    h, m = value.split(':')[:2]
+    return int(h) * 60 + int(m)
+
+def merge_patterns(patterns):
+    """
+    Merges stop patterns (lists of keys) in a single sequence keeping
+    the order of every pattern, the longest one first.
+    """
+    seq = []
+    for pattern in sorted(patterns, key=lambda p: (-len(p), p)):
+        pos = -1
+        for key in pattern:
+            if key in seq:
+                pos = seq.index(key)
+            else:
+                pos += 1
+                seq.insert(pos, key)
+    return seq
+
+def make_route(route, trips, stations, services):
+    """
+    Returns the content of the .txt line file of route, trips being a
+    dictionary of trip_id -> list of (stop_sequence, station index,
+    minutes) of the route. A route served in a single direction gets a
+    reverse direction (stations in reverse order, no runs) since line
+    files have two directions.
+    """
+    directions = {}
+    for trip_id, times in trips.iteritems():
+        trip = route['trips'][trip_id]
+        times.sort()
+        # (station, occurrence) keys: loops serve a station twice
+        seen = {}
+        keys = []
+        for seq, station, minutes in times:
+            seen[station] = seen.get(station, 0) + 1
+            keys.append(((station, seen[station]), minutes))
+        first = min([m for k, m in keys if m is not None] or [0])
+        directions.setdefault(trip['direction'], []).append((first, trip_id, trip['service'], keys))
+
+    # Default pattern: the most common one
+    counts = {}
+    dates = []
+    for trip in route['trips'].values():
+        if services.has_key(trip['service']):
+            pat, start, end = services[trip['service']]
+            counts[pat] = counts.get(pat, 0) + 1
+            dates.append((start, end))
+    dflt = max(counts.keys(), key=lambda p: (counts[p], p)) if counts else ''
+
+    out = []
+    out.append(HEADER)
+    out.append("name=%s" % route['name'])
+    out.append("circulation=%s" % dflt)
+    if route['color']:
+        out.append("color=#%s" % route['color'])
+    if dates:
+        out.append("from=%s" % gtfs_date(min([d[0] for d in dates])))
+        out.append("to=%s" % gtfs_date(max([d[1] for d in dates])))
+
+    # (stations, columns, patterns) of every direction
+    blocks = []
+    for direction in sorted(directions.keys()):
+        runs = sorted(directions[direction])
+        seq = merge_patterns(set([tuple([k for k, m in keys]) for first, trip_id, service, keys in runs]))
+        columns = [dict(keys) for first, trip_id, service, keys in runs]
+        pats = [services.get(service, (dflt,))[0] for first, trip_id, service, keys in runs]
+        blocks.append((seq, columns, pats))
+    if len(blocks) == 1:
+        blocks.append((blocks[0][0][::-1], [], []))
+
+    for seq, columns, pats in blocks:
+        out.append('')
+        out.append('direction=')
+        curcity = None
+        for key in seq:
+            name, city = stations[key[0]]
+            if city != curcity:
+                out.append('')
+                out.append('city=%s' % city)
+                curcity = city
+            cells = []
+            for k, column in enumerate(columns):
+                minutes = column.get(key)
+                if minutes is None:
+                    cells.append('-')
+                    continue
+                hhmm = "%02d:%02d" % ((minutes / 60) % 24, minutes % 60)
+                if pats[k] == dflt:
+                    cells.append(hhmm)
+                else:
+                    cells.append("%s*%s*" % (hhmm, pats[k]))
+            out.append("%s;%s" % (name, ';'.join(cells)))
+
+    return '\n'.join(out) + '\n'
+
+def feed_stamp(feeddir):
+    """
+    Size and modification time of the files of the feed.
+    """
+    stamp = {}
+    for name in FEED_FILES:
+        filename = os.path.join(feeddir, name)
+        if os.path.exists(filename):
+            st = os.stat(filename)
+            stamp[name] = [st.st_size, st.st_mtime]
+    return stamp
+
+def import_feed(feeddir, outdir, gps_cache=None, force=False):
+    """
+    Writes a .txt line file per route of the GTFS feed of feeddir in
+    outdir. Files are only written when their content changed, stale
+    ones are removed. Nothing is done if the feed did not change since
+    the previous import, unless force is set.
+
+    Returns the number of lines, None if the feed did not change.
+    """
+    if not os.path.exists(os.path.join(feeddir, 'stop_times.txt')):
+        raise ValueError, "%s is not a GTFS feed (missing stop_times.txt)" % feeddir
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    stamp = feed_stamp(feeddir)
+    stampname = os.path.join(outdir, STAMP_FILE)
+    if not force and os.path.exists(stampname):
+        f = open(stampname)
+        old = json.loads(f.read())
+        f.close()
+        if old == stamp:
+            return None
+
+    agencies = [a.get('agency_name', '') for a in read_csv(os.path.join(feeddir, 'agency.txt'))]
+    fallback = (agencies and agencies[0] or os.path.basename(os.path.normpath(feeddir))).upper()
+
+    # Stations: stops are merged into their parent station, named
+    # stations are indexes in the stations list of (name, city)
+    cities = read_cities(gps_cache)
+    stops = {}
+    parents = {}
+    for stop in read_csv(os.path.join(feeddir, 'stops.txt')):
+        try:
+            lat, lng = float(stop.get('stop_lat') or 0), float(stop.get('stop_lon') or 0)
+        except ValueError:
+            lat = lng = 0
+        city = (lat or lng) and nearest_city(cities, lat, lng) or fallback
+        stops[stop['stop_id']] = (clean_name(stop.get('stop_name', '')), city)
+        if stop.get('parent_station'):
+            parents[stop['stop_id']] = stop['parent_station']
+    stations = []
+    index = {}
+    stop_station = {}
+    for stop_id, station in stops.iteritems():
+        station = stops.get(parents.get(stop_id), station)
+        if not index.has_key(station):
+            index[station] = len(stations)
+            stations.append(station)
+        stop_station[stop_id] = index[station]
+    stops = parents = index = None
+
+    services = {}
+    for cal in read_csv(os.path.join(feeddir, 'calendar.txt')):
+        days = [cal.get(d) == '1' for d in DAYS]
+        services[cal['service_id']] = (days_pattern(days), cal.get('start_date', ''), cal.get('end_date', ''))
+
+    # Names are unique in a network
+    routes = {}
+    names = {}
+    for r in read_csv(os.path.join(feeddir, 'routes.txt')):
+        name = clean_name(r.get('route_short_name') or r.get('route_long_name') or r['route_id'])
+        names[name] = names.get(name, 0) + 1
+        routes[r['route_id']] = {'name': name, 'color': r.get('route_color', '').lower(), 'trips': {}}
+    for route_id, route in routes.iteritems():
+        if names[route['name']] > 1:
+            route['name'] = "%s (%s)" % (route['name'], clean_name(route_id))
+    trip_route = {}
+    for t in read_csv(os.path.join(feeddir, 'trips.txt')):
+        if not routes.has_key(t['route_id']):
+            continue
+        routes[t['route_id']]['trips'][t['trip_id']] = {'direction': t.get('direction_id') or '0',
+            'service': t['service_id']}
+        trip_route[t['trip_id']] = t['route_id']
+
+    # Single pass on stop_times.txt, spilling rows per route
+    spilldir = tempfile.mkdtemp(prefix='gtfs')
+    spills = {}
+    buffered = {}
+    count = skipped = 0
+    def spill():
+        for route_id, rows in buffered.iteritems():
+            if not spills.has_key(route_id):
+                spills[route_id] = os.path.join(spilldir, "%d.tsv" % len(spills))
+            f = open(spills[route_id], 'a')
+            f.write(''.join(rows))
+            f.close()
+        buffered.clear()
+    try:
+        for st in read_csv(os.path.join(feeddir, 'stop_times.txt')):
+            route_id = trip_route.get(st['trip_id'])
+            if route_id is None or not stop_station.has_key(st['stop_id']):
+                skipped += 1
+                continue
+            minutes = to_minutes(st.get('departure_time') or st.get('arrival_time'))
+            buffered.setdefault(route_id, []).append("%s\t%s\t%d\t%s\n" % (st['trip_id'],
+                st['stop_sequence'], stop_station[st['stop_id']], '' if minutes is None else minutes))
+            count += 1
+            if count % SPILL_ROWS == 0:
+                spill()
+        spill()
+        trip_route = None
+
+        written = set()
+        single = 0
+        for route_id in sorted(spills.keys()):
+            trips = {}
+            for line in open(spills[route_id]):
+                trip_id, seq, station, minutes = line.rstrip('\n').split('\t')
+                trips.setdefault(trip_id, []).append((int(seq), int(station), int(minutes) if minutes else None))
+            content = make_route(routes[route_id], trips, stations, services)
+            if len(set([routes[route_id]['trips'][t]['direction'] for t in trips])) == 1:
+                single += 1
+            filename = os.path.join(outdir, "%s.txt" % clean_name(route_id).replace(' ', '_'))
+            written.add(filename)
+            if os.path.exists(filename) and open(filename).read() == content:
+                continue
+            f = open(filename, 'w')
+            f.write(content)
+            f.close()
+    finally:
+        shutil.rmtree(spilldir)
+
+    # Stale line files, other files are left alone
+    for filename in glob.glob(os.path.join(outdir, '*.txt')):
+        if filename in written:
+            continue
+        f = open(filename)
+        header = f.readline().rstrip('\r\n')
+        f.close()
+        if header == HEADER:
+            os.remove(filename)
+    f = open(stampname, 'w')
+    f.write(json.dumps(stamp))
+    f.close()
+    print "[%-18s] %s: %d stop times, %d lines (%d skipped stop times, %d single direction routes)" % ('gtfs',
+        feeddir, count, len(written), skipped, single)
+    return len(written)
+
+def main():
+    parser = OptionParser(usage="""%prog [options] feeddir outdir
+
+Converts the GTFS feed of feeddir into line files (.txt) in outdir.""")
+    parser.add_option("", '--gps-cache', action="store", dest="gpscache", default=None, help="cities GPS cache (city;lat;lng), to find the city of stops")
+    parser.add_option("-f", '--force', action="store_true", dest="force", default=False, help="imports the feed even if unchanged")
+    options, args = parser.parse_args()
+
+    if len(args) != 2:
+        parser.print_usage()
+        sys.exit(2)
+    count = import_feed(args[0], args[1], options.gpscache, options.force)
+    if count is None:
+        print "%s did not change" % args[0]
+    else:
+        print "Wrote %d lines in %s" % (count, args[1])
+
+if __name__ == '__main__':
+    main()
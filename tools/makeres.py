@@ -10,16 +10,19 @@ Raw text is a copy of the PDF content using Acrobat Reader
 """
 
 import sys, re, types, os.path, glob, tempfile
-import hashlib, shutil, os
-import json, subprocess
+import hashlib, shutil, os, math, zlib, heapq
+import json, subprocess, time, fnmatch, unicodedata, difflib
+import cPickle
 from optparse import OptionParser
 #
 # Local import of DBSTRUCT
-import sqlitedb, mysqldb
+import sqlitedb, mysqldb, psqldb
 
 DBSTRUCT = None
 #
 DFLT_CIRC_POLICY = '1-6'
+# Minimum number of regular runs collapsed to a frequency row
+MIN_HEADWAY_RUNS = 3
 TIME_PAT = r'^\d{1,2}:\d{2}$'
 CIRC_PAT = r'^\*(.*)\*$'
 STOP_CIRC_PAT = r'^(\d{1,2}:\d{2})\*(.*)\*$'
@@ -33,18 +36,73 @@ TMP_DIR = os.path.join(tempfile.gettempdir(), "businfo")
 #
 FETCH_GPS_URL = """http://maps.googleapis.com/maps/api/geocode/json?address=%s&sensor=false"""
 GPS_CACHE_FILE = 'gps.csv'
+STATIONS_GPS_CACHE_FILE = 'stations-gps.csv' # station;city;lat;lng
 GPS_RSRC_FILE = 'gps.xml'
 g_cities = []
 g_prefilter = None
+# Timetable tables to emit: 'stop' (legacy, every run), 'trip' (trip,
+# stop_time and frequency tables, regular runs being collapsed) or 'both'.
+# Also written in the checksum file. The Android app only reads the stop
+# table: keep 'stop' as the default until it reads the trip tables
+g_timetable = 'stop'
+# Build stages profiler (--profile)
+g_profiler = None
+# Cache of compiled and pre-filtered lines
+g_cache = None
+# Stations of the build: (name, city) -> number of lines
+g_stations = {}
+# Validity window (first, last day as YYYY-MM-DD, '' when open) of the 
+# lines to emit, None for all lines (--valid-on, --valid-between)
+g_valid = None
+# Memory ceiling (MB) of bounded-memory streaming builds, 0 when not 
+# streaming (--streaming, --max-memory)
+g_streaming = 0
 SELF_SUFFIX = '_Self'
 #
 RAW_DB_FILE = 'htdb.sql'
+MYSQL_DB_FILE = 'htdb-mysql.sql' # When built along with SQLite
+PSQL_DB_FILE = 'htdb-psql.sql'   # Ditto
 CHKSUM_FILE = '.checksum'
+# Cache of source files digests
+FINGERPRINT_FILE = '.fingerprints'
+HASH_BUFSIZE = 1024 * 1024
+# Incremental builds: stable ids, build manifest and SQL fragments of lines
+IDS_FILE = 'ids.json'
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 4 # Bumped when the content of entries changes
+AGGREGATE_TABLES = ('station_line', 'line_service', 'counts')
+FRAGMENTS_DIR = 'fragments'
+SHARDS_DIR = 'shards'
+SHARD_FILE = 'shard.pickle'
+SEASONS_DIR = 'seasons'
+# Lines compiled by bsc, in the work directory
+COMPILED_DIR = 'raw'
+# Streaming builds: in-memory sorts get 1/SPILL_SHARE of the memory 
+# ceiling, a row being about SORT_ROW_BYTES
+MAX_MEMORY = 512 # MB
+SPILL_SHARE = 4
+SORT_ROW_BYTES = 128
+# Near-duplicate stations (--duplicates)
+DUP_THRESHOLD = 0.9     # Minimum similarity of names
+DUP_MIN_DICE = 0.7      # Minimum n-grams similarity (Dice) of candidates
+DUP_NGRAM = 3
+DUP_ABBREVIATIONS = {'st': 'saint', 'ste': 'sainte', 'av': 'avenue', 'bd': 'boulevard', 'pl': 'place', 
+    'ch': 'chemin', 'rte': 'route', 'imp': 'impasse', 'r': 'rue'}
 CHKSUM_DB_FILE = 'dbversion.xml'
 DB_STATS_FILE = 'dbstats.xml'
 CHUNK_DB_FILE = 'htdb-chunks.xml'
 CHUNK_PREFIX = 'htdb_chunk'
 CHUNK_SIZE = 64 * 1024
+# Content-defined chunks (see content_boundary) are between chunk size
+# / CDC_MIN_RATIO and chunk size * CDC_MAX_RATIO bytes
+CDC_MIN_RATIO = 4
+CDC_MAX_RATIO = 4
+# Template-plus-rows chunks (see make_row_chunks)
+ROWS_CHUNK_PREFIX = 'htdb_rows'
+# Per-line chunks (see make_line_chunks)
+LINES_DIR = 'lines'
+LINES_MANIFEST_FILE = 'htdb-lines.xml'
+LINE_CHUNK_TABLES = ('line_station', 'stop', 'trip', 'stop_time', 'frequency')
 # Networks definition file
 NETWORKS_FILE = 'networks.json'
 LCOMPILER = "../bin/bsc/bsc" # Line compiler
@@ -53,6 +111,302 @@ CONFIG_FILE = '../local.properties'
 # Absolute path to lines definition
 LINES_SRC_DIR = None
 UPDATE_TARBALL = "update.tar.bz2"
+PROFILE_FILE = 'profile.json'
+CACHE_DIR = 'cache'
+COLUMNS_DIR = 'columns'
+COLUMNS_META_FILE = 'meta.json'
+CACHE_SIZE = 256 # MB
+SQLITE_DB_FILE = 'ht.sqlite'
+# Watch mode: delay between two scans of the sources (polling) and time 
+# to wait for a burst of changes to settle (seconds)
+POLL_INTERVAL = 0.5
+DEBOUNCE_DELAY = 0.3
+
+class Profiler(object):
+    """
+    Records wall time, CPU time and peak memory of build stages, plus 
+    row and byte counts of every table written and the wall and CPU 
+    time of its writer (see TableTimer). Stages are sequential: starting 
+    a stage ends the current one. Peak memory of a stage comes from 
+    tracemalloc when available (Python 3.4+ or the pytracemalloc 
+    backport), otherwise the peak RSS of the process so far is reported 
+    (process_maxrss_kb), which is not the one of the stage.
+
+    A cProfile dump can be written for the stage named cprofile_stage.
+    """
+    def __init__(self, cprofile_stage=None):
+        self.stages = []
+        self.tables = {}
+        self.cur = None
+        self.cprofile_stage = cprofile_stage
+        self.cprofile = None
+        try:
+            import tracemalloc
+            self.tracemalloc = tracemalloc
+            tracemalloc.start()
+        except ImportError:
+            self.tracemalloc = None
+
+    def begin(self, name):
+        self.end()
+        self.cur = {'name': name, 'wall': time.time(), 'cpu': cpu_time()}
+        if self.tracemalloc:
+            if hasattr(self.tracemalloc, 'reset_peak'):
+                self.tracemalloc.reset_peak()
+            else:
+                self.tracemalloc.stop()
+                self.tracemalloc.start()
+        if name == self.cprofile_stage:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def end(self):
+        if not self.cur:
+            return
+        self.cur['wall'] = time.time() - self.cur['wall']
+        self.cur['cpu'] = cpu_time() - self.cur['cpu']
+        if self.tracemalloc:
+            self.cur['peak_bytes'] = self.tracemalloc.get_traced_memory()[1]
+        else:
+            import resource
+            self.cur['process_maxrss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if self.cprofile:
+            self.cprofile.disable()
+            name = os.path.join(TMP_DIR, "profile-%s.prof" % re.sub(r'\W', '_', self.cur['name']))
+            self.cprofile.dump_stats(name)
+            self.cur['cprofile'] = name
+            self.cprofile = None
+        self.stages.append(self.cur)
+        self.cur = None
+
+    def count(self, out):
+        """
+        Wraps the out file object to count rows and bytes written per 
+        table.
+        """
+        return TableCounter(out, self.tables)
+
+    def time_tables(self, out):
+        """
+        Wraps the out file object to time the writer of every table.
+        """
+        return TableTimer(out, self.tables)
+
+    def write(self, filename):
+        self.end()
+        f = open(filename, 'w')
+        f.write(json.dumps({'stages': self.stages, 'tables': self.tables}, indent=2, sort_keys=True))
+        f.close()
+        print "[%-18s] wrote %s" % ('profile', filename)
+
+class TableCounter(object):
+    """
+    File-like object counting rows and bytes of the INSERT statements 
+    written into out.
+    """
+    INSERT_PAT = re.compile(r'^INSERT INTO (\w+)')
+
+    def __init__(self, out, tables):
+        self.out = out
+        self.tables = tables
+
+    def write(self, data):
+        self.out.write(data)
+        m = self.INSERT_PAT.match(data)
+        if m:
+            t = self.tables.setdefault(m.group(1), {'rows': 0, 'bytes': 0})
+            t['rows'] += 1
+            t['bytes'] += len(data)
+
+class TableTimer(object):
+    """
+    File-like object charging the time spent up to every INSERT statement 
+    written into out, since the previous one, to the table of the 
+    statement: rows of a table are built then written, this is the time 
+    of the table's writer.
+    """
+    def __init__(self, out, tables):
+        self.out = out
+        self.tables = tables
+        self.wall, self.cpu = time.time(), cpu_time()
+
+    def write(self, data):
+        self.out.write(data)
+        wall, cpu = time.time(), cpu_time()
+        m = TableCounter.INSERT_PAT.match(data)
+        if m:
+            t = self.tables.setdefault(m.group(1), {'rows': 0, 'bytes': 0})
+            t['wall'] = t.get('wall', 0) + wall - self.wall
+            t['cpu'] = t.get('cpu', 0) + cpu - self.cpu
+        self.wall, self.cpu = wall, cpu
+
+class FanOut(object):
+    """
+    File-like object writing the same content into several files, each 
+    one written concurrently by its own thread. Data is buffered and 
+    handed over to writers by blocks of BUFSIZE bytes.
+
+    The first exception raised by a writer is raised again in the 
+    calling thread by write(), flush() or close(); the queue of a failed 
+    writer is still drained so that nothing blocks.
+    """
+    BUFSIZE = 256 * 1024
+    # Seconds between checks for a failed writer while a queue is full
+    POLL = 0.5
+
+    def __init__(self, outs):
+        import threading, Queue
+        self.Full = Queue.Full
+        self.buf = []
+        self.size = 0
+        self.queues = []
+        self.threads = []
+        # sys.exc_info() of the first failed writer
+        self.error = None
+        for out in outs:
+            q = Queue.Queue(maxsize=16)
+            t = threading.Thread(target=self._writer, args=(q, out))
+            t.daemon = True
+            t.start()
+            self.queues.append(q)
+            self.threads.append(t)
+
+    def _writer(self, q, out):
+        failed = False
+        while True:
+            data = q.get()
+            if data is None:
+                break
+            if failed:
+                continue
+            try:
+                out.write(data)
+            except:
+                failed = True
+                if self.error is None:
+                    self.error = sys.exc_info()
+
+    def check(self):
+        """
+        Raises the exception of a failed writer, if any.
+        """
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def _put(self, q, data):
+        while True:
+            try:
+                q.put(data, timeout=self.POLL)
+                return
+            except self.Full:
+                self.check()
+
+    def write(self, data):
+        self.buf.append(data)
+        self.size += len(data)
+        if self.size >= self.BUFSIZE:
+            self.flush()
+
+    def flush(self):
+        self.check()
+        if self.buf:
+            data = ''.join(self.buf)
+            for q in self.queues:
+                self._put(q, data)
+            self.buf = []
+            self.size = 0
+
+    def close(self):
+        """
+        Waits for all writers. Files are not closed.
+        """
+        try:
+            self.flush()
+        finally:
+            # Failed writers drain their queue, this never blocks
+            for q in self.queues:
+                q.put(None)
+            for t in self.threads:
+                t.join()
+        self.check()
+
+class CopyWriter(object):
+    """
+    File-like object turning the INSERT statements written into it into 
+    PostgreSQL COPY ... FROM STDIN blocks, one per table (see psqldb). 
+    Rows are spilled to temporary files until close() writes all blocks 
+    into out, in load order.
+    """
+    INSERT_PAT = re.compile(r'^INSERT INTO (\w+) VALUES\((.*)\);$')
+    VALUE_PAT = re.compile(r'NULL|"([^"]*)"|([^,\s]+)')
+
+    def __init__(self, out):
+        self.out = out
+        self.rest = ''
+        self.tables = {}
+
+    def write(self, data):
+        lines = (self.rest + data).split('\n')
+        self.rest = lines.pop()
+        for line in lines:
+            self.write_line(line)
+
+    def write_line(self, line):
+        m = self.INSERT_PAT.match(line)
+        if not m:
+            self.out.write(line + '\n')
+            return
+        table = m.group(1)
+        values = []
+        for v in self.VALUE_PAT.finditer(m.group(2)):
+            if v.group(0) == 'NULL':
+                values.append(None)
+            elif v.group(0).startswith('"'):
+                values.append(v.group(1))
+            else:
+                values.append(v.group(2))
+        values = psqldb.null_dates(table, values)
+        if table in psqldb.SERIAL_TABLES:
+            values = values[1:]
+        if not self.tables.has_key(table):
+            self.tables[table] = tempfile.TemporaryFile(dir=TMP_DIR)
+        self.tables[table].write(psqldb.copy_row(values))
+
+    def close(self):
+        """
+        Writes COPY blocks. out is not closed.
+        """
+        if self.rest:
+            self.write_line(self.rest)
+            self.rest = ''
+        for table, cols in psqldb.COLUMNS:
+            if not self.tables.has_key(table):
+                continue
+            f = self.tables.pop(table)
+            f.seek(0)
+            self.out.write(psqldb.copy_header(table))
+            shutil.copyfileobj(f, self.out)
+            self.out.write("\\.\n")
+            f.close()
+
+def cpu_time():
+    """
+    User + system CPU time of the process.
+    """
+    t = os.times()
+    return t[0] + t[1]
+
+def begin_stage(name):
+    """
+    Starts profiling a build stage (if --profile is used).
+    """
+    if g_profiler:
+        g_profiler.begin(name)
+
+def end_stage():
+    if g_profiler:
+        g_profiler.end()
 
 def read_config():
     global LINES_SRC_DIR
@@ -100,6 +454,24 @@ def get_gps_coords_from_cache(city, cache_file):
         print 'No cache found'
         sys.exit(1)
 
+def get_stations_coords_from_cache(cache_file):
+    """
+    Returns a dictionary of (station, city) -> (lat, lng) of stations 
+    coordinates found in cache_file (possibly empty).
+    """
+    coords = {}
+    try:
+        f = open(cache_file)
+        for line in f:
+            k = line.strip().split(';')
+            if len(k) != 4 or k[0].startswith('#'):
+                continue
+            coords[(k[0], k[1])] = (float(k[2]), float(k[3]))
+        f.close()
+    except IOError:
+        pass
+    return coords
+
 def fetch_gps_coords(city):
     """
     Uses Google Geocoding API.
@@ -118,29 +490,236 @@ def fetch_gps_coords(city):
 
     return lat, lng
 
-def makeSQL(networks, sources, out):
+def u8(s):
+    """
+    Returns s as an UTF-8 encoded string.
+    """
+    if type(s) == types.UnicodeType:
+        return s.encode('utf-8')
+    return s
+
+class IdRegistry(object):
+    """
+    Stable row ids, derived from the natural keys of rows (i.e the name 
+    of a city, a station name and its city name...).
+
+    Ids are kept in TMP_DIR between builds: a key keeps its id from a 
+    build to another and new keys get new ids. Keys added in a single 
+    call to assign() are allocated ids in keys order, so that a fresh 
+    build is deterministic.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.tables = {}
+        self.last = {}
+        # Identifies this set of ids, see BuildManifest
+        self.serial = None
+        try:
+            f = open(filename)
+            data = json.loads(f.read())
+            f.close()
+            for table, ids in data['tables'].iteritems():
+                self.tables[table] = dict([(u8(k), v) for k, v in ids.iteritems()])
+                self.last[table] = max(ids.values() or [0])
+            self.serial = data['serial']
+        except (IOError, ValueError, KeyError):
+            self.tables = {}
+            self.last = {}
+        if not self.serial:
+            self.serial = "%.6f" % time.time()
+
+    def assign(self, table, keys):
+        ids = self.tables.setdefault(table, {})
+        for key in sorted([k for k in set(keys) if k not in ids]):
+            self.last[table] = self.last.get(table, 0) + 1
+            ids[key] = self.last[table]
+
+    def get(self, table, key):
+        ids = self.tables.setdefault(table, {})
+        if key not in ids:
+            self.assign(table, [key])
+        return ids[key]
+
+    def save(self):
+        f = open(self.filename, 'w')
+        f.write(json.dumps({'serial': self.serial, 'tables': self.tables}))
+        f.close()
+
+class BuildManifest(object):
+    """
+    Build state of every source (line): digest of its content, network 
+    id, the dimension rows it needs (cities, stations, line) and the 
+    name of the fragment file holding its SQL rows.
+
+    In streaming builds, the DETAILS fields of entries (which grow with 
+    the number of stations of lines) are kept in a file next to the 
+    fragment instead of memory, see details().
+
+    The whole manifest is discarded if the build configuration changed 
+    (including the set of ids it relies on).
+    """
+    DETAILS = ('cities', 'stations', 'stations_served', 'service')
+
+    def __init__(self, filename, config, streaming=False):
+        self.filename = filename
+        self.config = config
+        self.streaming = streaming
+        self.lines = {}
+        try:
+            f = open(filename)
+            data = json.loads(f.read())
+            f.close()
+            if data['config'] == config:
+                self.lines = dict([(u8(k), v) for k, v in data['lines'].iteritems()])
+        except (IOError, ValueError, KeyError):
+            pass
+        self.fragdir = os.path.join(os.path.dirname(filename), FRAGMENTS_DIR)
+        if not os.path.exists(self.fragdir):
+            os.mkdir(self.fragdir)
+
+    def fragment(self, src):
+        return os.path.join(self.fragdir, hashlib.md5(u8(src)).hexdigest() + '.sql')
+
+    def details_file(self, src):
+        return os.path.join(self.fragdir, hashlib.md5(u8(src)).hexdigest() + '.json')
+
+    def get(self, src, md5, network_id):
+        """
+        Returns the build entry of src if it is up to date.
+        """
+        entry = self.lines.get(u8(src))
+        if entry and entry['md5'] == md5 and entry['network_id'] == network_id \
+            and os.path.exists(self.fragment(src)) \
+            and (not self.streaming or os.path.exists(self.details_file(src))):
+            return entry
+        return None
+
+    def set(self, src, entry):
+        """
+        Sets the entry of src. DETAILS fields are moved to its details 
+        file in streaming builds.
+        """
+        if self.streaming:
+            fields = dict([(k, entry.pop(k)) for k in self.DETAILS if entry.has_key(k)])
+            if fields:
+                details = {}
+                if os.path.exists(self.details_file(src)):
+                    details = self.details(src, entry)
+                details.update(fields)
+                f = open(self.details_file(src), 'w')
+                f.write(json.dumps(details))
+                f.close()
+        self.lines[u8(src)] = entry
+
+    def details(self, src, entry):
+        """
+        Returns the DETAILS fields of the entry of src (the entry itself 
+        if not streaming).
+        """
+        if not self.streaming:
+            return entry
+        f = open(self.details_file(src))
+        details = json.loads(f.read())
+        f.close()
+        return details
+
+    def save(self, sources):
+        """
+        Saves the manifest of sources, removing fragments of former ones.
+        """
+        keep = set([u8(src) for src in sources])
+        for src in self.lines.keys():
+            if src not in keep:
+                for name in (self.fragment(src), self.details_file(src)):
+                    if os.path.exists(name):
+                        os.remove(name)
+                del self.lines[src]
+        f = open(self.filename, 'w')
+        f.write(json.dumps({'config': self.config, 'lines': self.lines}))
+        f.close()
+
+class BuildState(object):
+    """
+    State of incremental builds: stable ids and build manifest. Parsed 
+    lines are also kept in memory with keep_parsed (i.e in watch mode) 
+    so that a line is only parsed once as long as it does not change.
+    """
+    def __init__(self, keep_parsed=False):
+        self.ids = IdRegistry(os.path.join(TMP_DIR, IDS_FILE))
+        config = {
+            'serial': self.ids.serial, 
+            'timetable': g_timetable, 
+            'headway_runs': MIN_HEADWAY_RUNS,
+            'version': MANIFEST_VERSION,
+        }
+        if g_streaming:
+            config['streaming'] = True
+        self.manifest = BuildManifest(os.path.join(TMP_DIR, MANIFEST_FILE), config, streaming=bool(g_streaming))
+        self.keep_parsed = keep_parsed
+        # Source -> (md5, parsed line)
+        self.parsed = {}
+
+    def parse(self, src, md5):
+        if self.parsed.has_key(src) and self.parsed[src][0] == md5:
+            return self.parsed[src][1]
+        parsed = parse(src)
+        if self.keep_parsed:
+            self.parsed[src] = (md5, parsed)
+        return parsed
+
+def makeSQL(networks, sources, out, state=None):
     """
     Generates the SQL data. Networks is a dictionary of available bus networks, sources
     is list of the .txt files (lines) to process.
+
+    Builds are incremental: ids are stable between builds (see IdRegistry) and the 
+    rows of every line (line, line_station and timetable tables) are kept in a 
+    fragment file listed in a build manifest (see BuildManifest). Only lines whose 
+    source changed since the previous build are parsed and emitted again, then 
+    spliced with the fragments of the other lines. state is the BuildState to 
+    use (loaded from TMP_DIR if None).
+
+    Only lines valid in the g_valid window are written, along with their 
+    cities and stations.
+
+    Streaming builds (see g_streaming) keep memory bounded: lines are 
+    parsed one at a time, a first pass collecting dimension rows 
+    (cities and stations) and a second one writing the rows of every 
+    line as soon as it is parsed. Line summaries are kept on disk (see 
+    BuildManifest) and aggregate rows are sorted in temporary files 
+    (see RowSorter). Cities and stations are kept in memory: the build 
+    is aborted once memory goes over the ceiling (see check_memory()).
+
+    Returns the set of sources emitted again.
     """
     global dfltCirculationPolicy
-    global db_network_count, db_city_count, db_line_count, db_station_count
+    global db_network_count, db_city_count, db_line_count, db_station_count, db_trip_count
+    global db_stop_duplicates
     global g_cities
-    db_network_count = db_city_count = db_line_count = db_station_count = 0
+    db_network_count = db_city_count = db_line_count = db_station_count = db_trip_count = 0
+    # (line, number of duplicate stop rows dropped)
+    db_stop_duplicates = []
+    if g_profiler:
+        out = g_profiler.count(out)
 
-    pathnet = {}
-    n = 0
-    for network, v in networks.iteritems():
-        # n+1 holds the network_id in the line table
-        pathnet[v['path']] = [network, n+1]
-        out.write("INSERT INTO network VALUES(%d, \"%s\", \"%s\");\n" % (n+1, network.encode('utf-8'), v['color'].encode('utf-8')))
-        n += 1
-    db_network_count = n
+    if state is None:
+        state = BuildState()
+    ids, manifest = state.ids, state.manifest
 
-    cities = set()
-    stations = set()
-    lines = set()
-    lines_stations = set()
+    begin_stage('sql network')
+    pathnet = {}
+    ids.assign('network', [u8(n) for n in networks.keys()])
+    for network in sorted(networks.keys(), key=lambda n: ids.get('network', u8(n))):
+        v = networks[network]
+        network_id = ids.get('network', u8(network))
+        pathnet[v['path']] = [network, network_id]
+        out.write("INSERT INTO network VALUES(%d, \"%s\", \"%s\");\n" % (network_id, u8(network), u8(v['color'])))
+        db_network_count += 1
+
+    begin_stage('parse')
+    sources = sorted(sources)
+    entries = []
+    changed = set()
     for src in sources:
         # Compute network_id
         network_id = 0
@@ -151,147 +730,407 @@ def makeSQL(networks, sources, out):
         if network_id == 0:
             raise ValueError, "wrong network_id 0"
 
-        try:
-            busline, directions, linecolor, dfltCirculationPolicy, from_date, to_date = parse(src)
-            lines.add((busline, directions[0][-1]['city'], directions[1][-1]['city'], 
-                linecolor, dfltCirculationPolicy, from_date, to_date, network_id))
-            k = 0
-            for direct in directions:
-                rank = 1
-                for data in direct:
-                    cities.add(data['city'])
-                    stations.add((data['station'], data['city']))
-                    lines_stations.add((busline, data['station'], rank, directions[k][-1]['city'], data['city']))
-                    rank += 1
-                k += 1
-        except Exception, e:
-            print
-            print "ERROR: processing line %s" % busline
-            raise
-
-    # Build cities IDs
-    pk = 1
-    cs = []
-    for city in cities:
-        cs.append((pk, unicode(city).encode('utf-8')))
-        pk += 1
-
-    for city in cs:
-        lat, lng = get_gps_coords_from_cache(city[1], os.path.join(LINES_SRC_DIR, GPS_CACHE_FILE))
-        out.write("INSERT INTO city VALUES(%d, \"%s\", %d, %d);\n" % (city[0], city[1], lat*10**6, lng*10**6))
+        md5 = get_md5(src)
+        entry = manifest.get(src, md5, network_id)
+        if not entry:
+            busline = src
+            try:
+                busline, directions, linecolor, dfltCirculationPolicy, from_date, to_date = state.parse(src, md5)
+                entry = {
+                    'md5': md5,
+                    'network_id': network_id,
+                    'line_id': ids.get('line', "%s\t%d" % (busline, network_id)),
+                    'line': [busline, u8(directions[0][-1]['city']), u8(directions[1][-1]['city']), 
+                        linecolor, dfltCirculationPolicy, from_date, to_date],
+                    'cities': [],
+                    'stations': [],
+                }
+                stations = set()
+                for direct in directions:
+                    for data in direct:
+                        stations.add((u8(data['station']), u8(data['city'])))
+                entry['stations'] = sorted(stations)
+                entry['cities'] = sorted(set([st[1] for st in stations]))
+            except Exception, e:
+                print
+                print "ERROR: processing line %s" % busline
+                raise
+            manifest.set(src, entry)
+            changed.add(src)
+        entries.append((src, entry))
+        check_memory('parsing %s' % src)
+
+    # Fragments of all lines are kept up to date, whatever the window
+    valid = [(src, entry) for src, entry in entries if is_valid(entry['line'][5], entry['line'][6], g_valid)]
+    valid_sources = set([src for src, entry in valid])
+
+    begin_stage('sql city')
+    cities = set()
+    stations = set()
+    served = {}
+    for src, entry in valid:
+        details = manifest.details(src, entry)
+        cities.update([u8(c) for c in details['cities']])
+        stations.update([(u8(st), u8(c)) for st, c in details['stations']])
+        for st, c in details['stations']:
+            served[(u8(st), u8(c))] = served.get((u8(st), u8(c)), 0) + 1
+    for st, count in served.iteritems():
+        g_stations[st] = max(g_stations.get(st, 0), count)
+    ids.assign('city', cities)
+    for city in sorted(cities, key=lambda c: ids.get('city', c)):
+        lat, lng = get_gps_coords_from_cache(city, os.path.join(LINES_SRC_DIR, GPS_CACHE_FILE))
+        out.write("INSERT INTO city VALUES(%d, \"%s\", %d, %d);\n" % (ids.get('city', city), city, lat*10**6, lng*10**6))
         db_city_count += 1
-        g_cities.append(city[1])
-
-    pk = 1
-    pk_city = 0
-    pk_stations = {}
-    for st in stations:
-        for city in cs:
-            if city[1] == st[1].encode('utf-8'):
-                pk_city = city[0]
-                break
-        if pk_city == 0:
-            print "Error: city id not found!"
-            sys.exit(1)
-        out.write("INSERT INTO station VALUES(%d, \"%s\", 0, 0, %d);\n" % (pk, st[0].encode('utf-8'), pk_city))
-        pk_stations[(st[0].encode('utf-8'), pk_city)] = pk
+        if city not in g_cities:
+            g_cities.append(city)
+
+    begin_stage('sql station')
+    # Same scale as cities, (0, 0) when unknown
+    coords = get_stations_coords_from_cache(os.path.join(LINES_SRC_DIR, STATIONS_GPS_CACHE_FILE))
+    ids.assign('station', ["%s\t%s" % st for st in stations])
+    for st in sorted(stations, key=lambda st: ids.get('station', "%s\t%s" % st)):
+        lat, lng = coords.get(st, (0, 0))
+        out.write("INSERT INTO station VALUES(%d, \"%s\", %d, %d, %d);\n" % (
+            ids.get('station', "%s\t%s" % st), st[0], lat*10**6, lng*10**6, ids.get('city', st[1])))
         db_station_count += 1
-        pk += 1
-
-    pk_from = pk_to = 0
-    pk = 1
-    for line in lines:
-        for city in cs:
-            if city[1] == line[1].encode('utf-8'):
-                pk_from = city[0]
-                break
-        for city in cs:
-            if city[1] == line[2].encode('utf-8'):
-                pk_to = city[0]
-                break
-        if pk_from == 0 or pk_to == 0:
-            print "Error: pk_from(%d) or pk_to(%d) id not found!" % (pk_from, pk_to)
-            print "Line: " + str(line)
-            sys.exit(1)
-        out.write("INSERT INTO line VALUES(%d, %d, \"%s\", \"%s\", \"%s\", %d, %d, \"%s\", \"%s\");\n" % (
-            pk, line[7], line[0], line[3], line[4], pk_from, pk_to, line[5], line[6]))
+    check_memory('cities and stations')
+
+    begin_stage('sql lines')
+    for src, entry in entries:
+        fragment = manifest.fragment(src)
+        if src in changed:
+            parsed = state.parse(src, entry['md5'])
+            f = open(fragment, 'w')
+            if g_profiler:
+                # Times line_station, stop, trip, stop_time... writers
+                entry.update(emit_line(g_profiler.time_tables(f), parsed, entry['network_id'], ids))
+            else:
+                entry.update(emit_line(f, parsed, entry['network_id'], ids))
+            f.close()
+            manifest.set(src, entry)
+        if src not in valid_sources:
+            continue
+        f = open(fragment)
+        if g_profiler:
+            # Counts rows
+            for line in f:
+                out.write(line)
+        else:
+            shutil.copyfileobj(f, out)
+        f.close()
         db_line_count += 1
-        pk += 1
+        db_trip_count += entry['trips']
+        if entry['duplicates']:
+            db_stop_duplicates.append((entry['line'][0], entry['duplicates']))
+        check_memory('writing %s' % src)
 
-    pk_line = pk_station = pk_direction = pk_city = 0
-    pk = 1
-    for ls in lines_stations:
-        j = 1
-        h = 1
-        for line in lines:
-            if ls[0] == line[0]:
-                pk_line = j
-                break
-            j += 1
-        if pk_line == 0:
-            print "Error: pk_line is 0!"
-            sys.exit(1)
-        for city in cs:
-            if city[1] == ls[3].encode('utf-8'):
-                pk_direction = city[0]
-                break
-        if pk_direction == 0:
-            print "Error: pk_direction is 0!"
-            sys.exit(1)
-        for city in cs:
-            if city[1] == ls[4].encode('utf-8'):
-                pk_city = city[0]
-                break
-        if pk_city == 0:
-            print "Error: pk_city is 0!"
-            sys.exit(1)
-        out.write("INSERT INTO line_station VALUES(%d, %d, %d, %d, %d);\n" % (
-            pk, pk_line, pk_stations[(ls[1].encode('utf-8'), pk_city)], ls[2], pk_direction))
-        pk += 1
-
-    # Handle stops
-    k = 1
-    for src in sources:
-        busline, directions, linecolor, dfltCirculationPolicy, from_date, to_date = parse(src)
-        for direct in directions:
+    begin_stage('sql aggregates')
+    emit_aggregates(out, ((entry['line_id'], manifest.details(src, entry)) for src, entry in valid))
+
+    manifest.save(sources)
+    ids.save()
+    end_stage()
+    return changed
+
+def is_valid(from_date, to_date, window):
+    """
+    Does the validity period of a line (from= and to= fields, empty when 
+    open) overlap window (see g_valid)?
+    """
+    if window is None:
+        return True
+    first, last = window
+    return (not to_date or not first or to_date >= first) and (not from_date or not last or from_date <= last)
+
+def parse_window(value):
+    """
+    Returns the (first, last) window of a FIRST,LAST or DATE value, 
+    dates as YYYY-MM-DD. Raises ValueError if malformed.
+    """
+    bounds = value.split(',')
+    if len(bounds) == 1:
+        bounds = bounds * 2
+    if len(bounds) != 2:
+        raise ValueError, "expected FIRST,LAST dates"
+    for date in bounds:
+        if date:
+            time.strptime(date, '%Y-%m-%d')
+    if bounds[0] and bounds[1] and bounds[0] > bounds[1]:
+        raise ValueError, "%s is after %s" % tuple(bounds)
+    return tuple(bounds)
+
+def season_name(window):
+    """
+    Name of the database of a validity window.
+    """
+    first, last = window
+    if first and first == last:
+        return first
+    return "%s_%s" % (first or 'open', last or 'open')
+
+def emit_aggregates(out, summaries):
+    """
+    Writes the rows of the aggregate tables, from the (line id, summary) 
+    of lines (see emit_line()): station_line (lines serving a station), 
+    line_service (service span of every line direction) and counts.
+    """
+    maxrows = 0
+    if g_streaming:
+        maxrows = g_streaming * 1024 * 1024 / SPILL_SHARE / SORT_ROW_BYTES
+    rows = RowSorter(maxrows)
+    services = RowSorter(maxrows)
+    for line_id, summary in summaries:
+        for station_id, rank, direction_id in summary['stations_served']:
+            rows.add((station_id, line_id, rank, direction_id))
+        for k, service in enumerate(summary['service']):
+            services.add((line_id, k) + tuple(service))
+    # Grouped by station
+    for row in rows:
+        out.write("INSERT INTO station_line VALUES(%d, %d, %d, %d);\n" % row)
+    for row in services:
+        out.write("INSERT INTO line_service VALUES(%d, %d, %d, %d, %d);\n" % (row[:1] + row[2:]))
+    check_memory('aggregate tables')
+    for name, count in db_counts():
+        out.write("INSERT INTO counts VALUES(\"%s\", %d);\n" % (name, count))
+
+def db_counts():
+    """
+    Returns the (name, count) rows of the counts table, also used for 
+    the DB stats file.
+    """
+    return [('networks', db_network_count), ('cities', db_city_count), ('stations', db_station_count), 
+        ('lines', db_line_count), ('trips', db_trip_count)]
+
+def check_memory(where):
+    """
+    Streaming builds: exits with an error as soon as the peak memory of 
+    the process goes over the ceiling (see g_streaming), where being the 
+    current build step.
+    """
+    if not g_streaming:
+        return
+    import resource
+    # Linux reports kB
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if peak > g_streaming:
+        print
+        print "Error: peak memory %d MB over the %d MB ceiling while %s (see --max-memory)" % (peak, g_streaming, where)
+        sys.exit(1)
+
+class RowSorter(object):
+    """
+    Sorts rows (tuples of integers). Rows are sorted in memory by runs 
+    of maxrows rows (all of them if maxrows is null), runs being spilled 
+    to temporary files then merged when iterating.
+    """
+    def __init__(self, maxrows=0):
+        self.maxrows = maxrows
+        self.rows = []
+        self.runs = []
+
+    def add(self, row):
+        self.rows.append(row)
+        if self.maxrows and len(self.rows) >= self.maxrows:
+            self.spill()
+
+    def spill(self):
+        f = tempfile.TemporaryFile(dir=TMP_DIR)
+        for row in sorted(self.rows):
+            f.write('\t'.join([str(v) for v in row]) + '\n')
+        f.seek(0)
+        self.runs.append(f)
+        self.rows = []
+
+    def read(self, f):
+        for line in f:
+            yield tuple([int(v) for v in line.split('\t')])
+        f.close()
+
+    def __iter__(self):
+        if not self.runs:
+            return iter(sorted(self.rows))
+        if self.rows:
+            self.spill()
+        runs, self.runs = self.runs, []
+        return heapq.merge(*[self.read(f) for f in runs])
+
+def emit_line(out, parsed, network_id, ids):
+    """
+    Writes the SQL rows of a parsed line: line, line_station and 
+    timetable (stop and/or trip, stop_time, frequency) tables. Duplicate
+    stop rows (i.e. station names split on '/' or repeated rows) and
+    trips (repeated columns) are dropped.
+
+    Returns a summary of the line for the aggregate tables (see
+    emit_aggregates()): the number of trips written, stations served
+    (station id, rank, direction id), service span of every direction
+    (direction id, first and last departures in minutes, number of runs)
+    and the number of duplicate stop (or stop_time, without the stop
+    table) rows dropped.
+    """
+    busline, directions, linecolor, circpat, from_date, to_date = parsed
+    line_id = ids.get('line', "%s\t%d" % (busline, network_id))
+    out.write("INSERT INTO line VALUES(%d, %d, \"%s\", \"%s\", \"%s\", %d, %d, \"%s\", \"%s\");\n" % (
+        line_id, network_id, busline, linecolor, circpat, 
+        ids.get('city', u8(directions[0][-1]['city'])), ids.get('city', u8(directions[1][-1]['city'])), 
+        from_date, to_date))
+
+    num_trips = 0
+    stations_served = []
+    service = []
+    # Rows of the stop table already written, duplicates are dropped
+    stops = set()
+    duplicates = 0
+    for k, direct in enumerate(directions):
+        direction_id = ids.get('city', u8(direct[-1]['city']))
+        rank = 1
+        for data in direct:
+            station_id = ids.get('station', "%s\t%s" % (u8(data['station']), u8(data['city'])))
+            out.write("INSERT INTO line_station VALUES(NULL, %d, %d, %d, %d);\n" % (
+                line_id, station_id, rank, direction_id))
+            stations_served.append((station_id, rank, direction_id))
+            rank += 1
+        trips, dropped = unique_trips(make_trips(direct))
+        departures = [trip['times'][0][1] for trip in trips if trip['times']]
+        if departures:
+            service.append((direction_id, min(departures), max(departures), len(departures)))
+
+        if g_timetable in ('trip', 'both'):
+            if g_timetable == 'trip':
+                duplicates += dropped
+            n = 0
+            for trip, freq in collapse_headways(trips):
+                trip_id = ids.get('trip', "%d\t%d\t%d" % (line_id, k, n))
+                out.write("INSERT INTO trip VALUES(%d, %d, %d, \"%s\");\n" % (
+                    trip_id, line_id, direction_id, trip['circpat']))
+                for seq, minutes in trip['times']:
+                    out.write("INSERT INTO stop_time VALUES(%d, %d, %d);\n" % (trip_id, seq, minutes))
+                if freq:
+                    out.write("INSERT INTO frequency VALUES(%d, %d, %d, %d);\n" % ((trip_id,) + freq))
+                n += 1
+            num_trips += n
+
+        if g_timetable in ('stop', 'both'):
             for data in direct:
+                city_id = ids.get('city', u8(data['city']))
+                s_id = ids.get('station', "%s\t%s" % (u8(data['station']), u8(data['city'])))
                 for stop in data['stops']:
-                    # City id
-                    city_id = 0
-                    for c in cs:
-                        if data['city'].encode('utf-8') == c[1]:
-                            city_id = c[0]
-                            break
-                    if city_id == 0:
-                        print "Error: city_id is 0!"
-                    # Station id
-                    s_id = pk_stations[data['station'].encode('utf-8'), city_id]
                     if type(stop) == types.TupleType:
                         st, pat = stop[0], stop[1]
                     else:
                         st, pat = stop, ''
-                    # Direction id
-                    direction_id = 0
-                    for c in cs:
-                        if direct[-1]['city'].encode('utf-8') == c[1]:
-                            direction_id = c[0]
-                            break
-                    if direction_id == 0:
-                        print "Error: direction_id is 0!"
-                    # Line id
-                    line_id = 0
-                    j = 1
-                    for line in lines:
-                        if busline == line[0]:
-                            line_id = j
-                            break
-                        j += 1
-                    if line_id == 0:
-                        print "Error: line_id is 0!"
-
-                    out.write("INSERT INTO stop VALUES(%d, \"%s\", \"%s\", %d, %d, %d, %d);\n" % 
-                        (k, st, pat, s_id, line_id, direction_id, city_id))
-                    k += 1
+                    # Same key as the UNIQUE constraint of the stop table (line_id 
+                    # is constant here)
+                    key = (s_id, direction_id, st, pat, city_id)
+                    if key in stops:
+                        duplicates += 1
+                        continue
+                    stops.add(key)
+                    out.write("INSERT INTO stop VALUES(NULL, \"%s\", \"%s\", %d, %d, %d, %d);\n" % 
+                        (st, pat, s_id, line_id, direction_id, city_id))
+
+    return {'trips': num_trips, 'stations_served': stations_served, 'service': service, 'duplicates': duplicates}
+
+def to_minutes(hhmm):
+    """
+    Converts a HH:MM time to a number of minutes past midnight.
+    """
+    h, m = hhmm.split(':')
+    return int(h) * 60 + int(m)
+
+def to_hhmm(minutes):
+    """
+    Converts a number of minutes past midnight to a HH:MM time.
+    """
+    return "%02d:%02d" % ((minutes / 60) % 24, minutes % 60)
+
+def make_trips(direct):
+    """
+    Groups the stops of a parsed direction by column: every column is a 
+    bus run (trip). Returns a list of trips ordered by column, each one 
+    being a dictionnary with a circulation pattern and a list of 
+    (seq, minutes) tuples. seq is the station's rank in the direction, 
+    as in the line_station table. Times past midnight are kept increasing 
+    (i.e 00:10 after 23:50 is 1450).
+    """
+    trips = {}
+    rank = 1
+    for data in direct:
+        for stop, col in zip(data['stops'], data['cols']):
+            if type(stop) == types.TupleType:
+                st, pat = stop[0], stop[1]
+            else:
+                st, pat = stop, ''
+            if not trips.has_key(col):
+                trips[col] = {'circpat': pat, 'times': []}
+            minutes = to_minutes(st)
+            times = trips[col]['times']
+            if times and minutes < times[-1][1]:
+                minutes += 24 * 60
+            times.append((rank, minutes))
+        rank += 1
+
+    return [trips[col] for col in sorted(trips.keys())]
+
+def unique_trips(trips):
+    """
+    Drops repeated trips of make_trips() (same circulation pattern and 
+    times, i.e. repeated columns). Returns the remaining trips and the 
+    number of stop_time rows dropped.
+    """
+    seen = set()
+    res = []
+    dropped = 0
+    for trip in trips:
+        key = (trip['circpat'], tuple(trip['times']))
+        if key in seen:
+            dropped += len(trip['times'])
+            continue
+        seen.add(key)
+        res.append(trip)
+    return res, dropped
+
+def collapse_headways(trips):
+    """
+    Headway detection. Trips serving the same stations with the same 
+    circulation pattern and the same running times, and departing at 
+    a constant interval, are collapsed to their first trip (the 
+    template) and a (start, end, headway) frequency tuple. At least 
+    MIN_HEADWAY_RUNS such trips are required.
+
+    Returns a list of (trip, frequency) tuples, frequency being None 
+    for trips which are not part of a regular run.
+    """
+    # Group trips (indexes) by shape
+    shapes = {}
+    for k, trip in enumerate(trips):
+        first = trip['times'][0][1]
+        shape = (trip['circpat'], tuple([(seq, minutes - first) for seq, minutes in trip['times']]))
+        shapes.setdefault(shape, []).append(k)
+
+    freqs = {}
+    collapsed = set()
+    for group in shapes.values():
+        group.sort(key=lambda k: trips[k]['times'][0][1])
+        deps = [trips[k]['times'][0][1] for k in group]
+        i = 0
+        while i < len(group) - 1:
+            headway = deps[i+1] - deps[i]
+            j = i + 1
+            while j + 1 < len(group) and deps[j+1] - deps[j] == headway:
+                j += 1
+            if headway > 0 and j - i + 1 >= MIN_HEADWAY_RUNS:
+                freqs[group[i]] = (deps[i], deps[j], headway)
+                collapsed.update(group[i+1:j+1])
+                i = j + 1
+            else:
+                i += 1
+
+    res = []
+    for k, trip in enumerate(trips):
+        if k not in collapsed:
+            res.append((trip, freqs.get(k)))
+    return res
 
 def parse(infile):
     """
@@ -326,15 +1165,19 @@ def parse(infile):
     TO_PAT = 'to='
     COLOR_PAT = 'color='
     UPDATED_PAT = 'updated=' # Date of last line update
+    FREQUENCY_PAT = 'frequency=' # COL;HH:MM;HEADWAY, see expand_frequencies()
 
     k = -1
     curCity = None
     curLines = None
     linecolor = ""
     from_date = to_date = ""
+    # Frequency directives of every direction
+    frequencies = []
     for line in data:
         if line.startswith(DIRECTION_PAT):
             directions.append([])
+            frequencies.append([])
             k += 1
         elif line.startswith(CIRCULATION_PAT):
             dfltCirculationPolicy = re.sub(CIRCULATION_PAT, '', line).encode('utf-8')
@@ -351,6 +1194,13 @@ def parse(infile):
         elif line.startswith(UPDATED_PAT):
             # FIXME
             pass
+        elif line.startswith(FREQUENCY_PAT):
+            freq = re.sub(FREQUENCY_PAT, '', line).split(';')
+            if len(freq) != 3 or not re.match(TIME_PAT, freq[1]):
+                raise ValueError, "Bad frequency definition: %s" % line
+            if k < 0:
+                raise ValueError, "Frequency definition before any direction: %s" % line
+            frequencies[k].append((int(freq[0]), to_minutes(freq[1]), int(freq[2])))
         else:
             # This is a station line
             sts = line.split(';')
@@ -359,6 +1209,10 @@ def parse(infile):
                 raise ValueError, "Not a station line: %s" % line
             stops = sts[1:]
             allstops = []
+            # Column index of every stop: all stops sharing the same column
+            # in a direction belong to the same bus run (trip)
+            cols = []
+            col = 0
             nextPolicy = dfltCirculationPolicy
             for stop in stops:
                 m = re.match(CIRC_PAT, stop)
@@ -376,9 +1230,12 @@ def parse(infile):
                             allstops.append(stop)
                         else:
                             allstops.append((stop, nextPolicy))
+                        cols.append(col)
                     elif re.match(STOP_CIRC_PAT, stop):
                         m = re.match(STOP_CIRC_PAT, stop)
                         allstops.append((m.group(1), m.group(2)))
+                        cols.append(col)
+                col += 1
 
             # Split all station names with one or more '/' as a unique station name
             for stname in map(lambda x: x.strip(), sts[0].split('/')):
@@ -386,10 +1243,57 @@ def parse(infile):
                     'city': smart_capitalize(curCity),
                     'station': smart_capitalize(stname),
                     'stops': allstops,
+                    'cols': cols,
                 })
 
+    for k in range(len(directions)):
+        if frequencies[k]:
+            expand_frequencies(directions[k], frequencies[k])
+
     return (busline, directions, linecolor, dfltCirculationPolicy, from_date, to_date)
 
+def expand_frequencies(direct, frequencies):
+    """
+    Expands frequency directives of a parsed direction into new columns. 
+    A 'frequency=3;20:00;10' directive means that the bus run of column 
+    3 (first column is 1) is repeated every 10 minutes, the last 
+    departure being at 20:00 or before.
+
+    Expanded runs are regular columns, so that the legacy stop table 
+    keeps every single time; trip emission collapses them back to 
+    frequency rows (see collapse_headways()).
+    """
+    maxcol = max([max(data['cols'] + [-1]) for data in direct])
+    for col, end, headway in frequencies:
+        col -= 1
+        if headway <= 0:
+            raise ValueError, "Bad headway %d for column %d" % (headway, col + 1)
+        # Template departure time (first station served by the run)
+        start = None
+        for data in direct:
+            if col in data['cols']:
+                stop = data['stops'][data['cols'].index(col)]
+                if type(stop) == types.TupleType:
+                    stop = stop[0]
+                start = to_minutes(stop)
+                break
+        if start is None:
+            raise ValueError, "No run in column %d for frequency" % (col + 1)
+        runs = range(headway, end - start + 1, headway)
+        # Station entries split on '/' share the same lists: always build new ones
+        for data in direct:
+            stops, cols = list(data['stops']), list(data['cols'])
+            if col in data['cols']:
+                stop = data['stops'][data['cols'].index(col)]
+                for n, offset in enumerate(runs):
+                    if type(stop) == types.TupleType:
+                        stops.append((to_hhmm(to_minutes(stop[0]) + offset), stop[1]))
+                    else:
+                        stops.append(to_hhmm(to_minutes(stop) + offset))
+                    cols.append(maxcol + 1 + n)
+            data['stops'], data['cols'] = stops, cols
+        maxcol += len(runs)
+
 def smart_capitalize(name):
     """
     Try to apply a simple smart capitilazitation algorithm.
@@ -423,22 +1327,197 @@ def smart_capitalize(name):
 
     return ''.join(clname)
 
+def fold_name(name):
+    """
+    Returns the utf-8 name without accents, case, punctuation and common 
+    abbreviations, to compare spelling variants.
+    """
+    name = unicodedata.normalize('NFKD', unicode(name, 'utf-8')).encode('ascii', 'ignore').lower()
+    words = re.sub(r'[^a-z0-9]+', ' ', name).split()
+    return ' '.join([DUP_ABBREVIATIONS.get(w, w) for w in words])
+
+def name_grams(folded):
+    """
+    Set of character n-grams of a folded name.
+    """
+    padded = " %s " % folded
+    return set([padded[k:k + DUP_NGRAM] for k in range(max(1, len(padded) - DUP_NGRAM + 1))])
+
+def find_duplicate_stations(stations, threshold=DUP_THRESHOLD):
+    """
+    Finds near-duplicate names among stations, a dictionary of (name, 
+    city) -> number of lines. Candidate pairs of a city share enough 
+    n-grams of their folded names (see fold_name()) to be DUP_MIN_DICE 
+    similar. They are found with an inverted index of the rarest n-grams 
+    of every name (prefix filtering) instead of comparing all pairs, 
+    then scored by the similarity ratio of their folded names. Names 
+    with different numbers are never duplicates.
+
+    Returns a list of (score, city, name, canonical name) sorted by 
+    decreasing score. The canonical name is the one served by the most 
+    lines.
+    """
+    # Same Jaccard similarity
+    jaccard = DUP_MIN_DICE / (2 - DUP_MIN_DICE)
+    bycity = {}
+    for (name, city), count in stations.iteritems():
+        bycity.setdefault(city, []).append((name, count))
+
+    pairs = []
+    for city, names in bycity.iteritems():
+        names.sort()
+        folded = [fold_name(name) for name, count in names]
+        grams = [name_grams(f) for f in folded]
+        freq = {}
+        for gs in grams:
+            for g in gs:
+                freq[g] = freq.get(g, 0) + 1
+        # N-grams of every name, rarest first
+        rank = dict([(g, k) for k, g in enumerate(sorted(freq, key=lambda g: (freq[g], g)))])
+        ordered = [sorted(gs, key=rank.__getitem__) for gs in grams]
+        index = {}
+        # Smallest names first, candidates are never much smaller
+        for i in sorted(range(len(names)), key=lambda i: len(grams[i])):
+            size = len(ordered[i])
+            # Pairs sharing enough n-grams share one of their rarest ones
+            prefix = ordered[i][:size - int(math.ceil(jaccard * size)) + 1]
+            candidates = set()
+            for g in prefix:
+                candidates.update(index.get(g, ()))
+                index.setdefault(g, []).append(i)
+            for j in candidates:
+                if len(grams[j]) < jaccard * size:
+                    continue
+                if 2.0 * len(grams[i] & grams[j]) / (size + len(grams[j])) < DUP_MIN_DICE:
+                    continue
+                if re.findall(r'\d+', folded[i]) != re.findall(r'\d+', folded[j]):
+                    continue
+                matcher = difflib.SequenceMatcher(None, folded[i], folded[j])
+                if matcher.quick_ratio() < threshold:
+                    continue
+                score = matcher.ratio()
+                if score < threshold:
+                    continue
+                # Most served name first, then the longest (unabbreviated, accented) one
+                a, b = sorted((names[i], names[j]), key=lambda n: (-n[1], -len(n[0]), n[0]))
+                pairs.append((score, city, b[0], a[0]))
+    pairs.sort(key=lambda p: (-p[0], p[1], p[2]))
+    return pairs
+
+def write_duplicates(pairs, filename):
+    """
+    Writes suggested pre-filter entries (see --pre-filter) replacing 
+    near-duplicate station names (see find_duplicate_stations()) with 
+    their canonical name, to be reviewed before being added to 
+    filter.map. Entries only match whole station names of line files.
+    """
+    def escape(name, specials):
+        for c in '\\' + specials:
+            name = name.replace(c, '\\' + c)
+        return name
+
+    out = open(filename, 'w')
+    out.write("# Near-duplicate stations found by makeres.py --duplicates, review before use\n")
+    count = 0
+    for score, city, name, canonical in pairs:
+        if re.search(r'[";$`]', name + canonical):
+            # Can't be a sed expression of filter.map
+            continue
+        out.write("# %s: %.2f\n" % (city, score))
+        out.write("^%s\\x3b;%s\\x3b\n" % (escape(name, '.[]*^$,'), escape(canonical, '&,')))
+        count += 1
+    out.close()
+    return count
+
 def get_md5(filename):
-    ck = open(filename)
+    ck = open(filename, 'rb')
     m = hashlib.md5()
     while True:
-        data = ck.read(128)
+        data = ck.read(HASH_BUFSIZE)
         if not data:
             break
         m.update(data)
     ck.close()
     return m.hexdigest()
 
-def compute_db_checksum(srcdir):
+class FingerprintCache(object):
+    """
+    MD5 digests of files, cached on disk and keyed on the file path, 
+    size and modification time so that only changed files are hashed 
+    again.
+
+    Files modified less than RACY_DELAY seconds before being hashed are 
+    not cached: they could be modified again within the same mtime 
+    granularity without being noticed.
+    """
+    RACY_DELAY = 2
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.changed = False
+        try:
+            f = open(filename)
+            # JSON keys are unicode, paths from os.walk() are not
+            self.entries = dict([(self.key(k), v) for k, v in json.loads(f.read()).iteritems()])
+            f.close()
+        except (IOError, ValueError):
+            pass
+
+    def key(self, path):
+        if type(path) == types.UnicodeType:
+            return path.encode('utf-8')
+        return path
+
+    def digests(self, paths, jobs=1):
+        """
+        Returns the list of MD5 digests of paths. Stale files are hashed 
+        by jobs threads (hashlib releases the GIL while hashing).
+        """
+        res = {}
+        stale = []
+        entries = {}
+        now = time.time()
+        for path in paths:
+            st = os.stat(path)
+            entry = self.entries.get(self.key(path))
+            if entry and entry[0] == st.st_size and entry[1] == st.st_mtime:
+                res[path] = entry[2]
+                entries[self.key(path)] = entry
+            else:
+                stale.append((path, st))
+
+        if jobs > 1 and len(stale) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(jobs)
+            md5s = pool.map(get_md5, [path for path, st in stale])
+            pool.close()
+        else:
+            md5s = [get_md5(path) for path, st in stale]
+
+        for (path, st), md5 in zip(stale, md5s):
+            res[path] = md5
+            if now - st.st_mtime > self.RACY_DELAY:
+                entries[self.key(path)] = [st.st_size, st.st_mtime, md5]
+        if stale or len(entries) != len(self.entries):
+            self.changed = True
+        self.entries = entries
+
+        return [res[path] for path in paths]
+
+    def save(self):
+        if not self.changed:
+            return
+        f = open(self.filename, 'w')
+        f.write(json.dumps(self.entries))
+        f.close()
+        self.changed = False
+
+def compute_db_checksum(srcdir, jobs=1, windows=()):
     """
     Checksum of the database is performed using a global checksum of 
-    all the raw/*/*.in file, the DBSTRUCT content and the filter.map 
-    entries. 
+    all the lines to build (see find_lines(), lines must be compiled 
+    first), the DBSTRUCT content and the filter.map entries. 
     
     It's supposed to be a portable solution between different Python 
     versions. Indeed, different Python versions could handle ordering 
@@ -448,31 +1527,102 @@ def compute_db_checksum(srcdir):
 
     Furthermore, the computed checksum is used to check if database 
     rebuilding is needed by the build system.
+
+    Digests of files are cached in TMP_DIR (see FingerprintCache), jobs 
+    is the number of threads hashing changed files. Validity windows 
+    (see g_valid) also change the checksum.
     """
-    sources = []
-    for root, dirs, files in os.walk(srcdir):
-        linedefs = glob.glob(os.path.join(root, "*.txt"))
-        if len(linedefs) == 0: continue
-        sources.extend(linedefs)
-    sources.sort()
+    # Ordered by relative path, as when bsc compiled lines in srcdir
+    sources = [src for rel, src in sorted(find_lines(srcdir).iteritems())]
+
+    cache = FingerprintCache(os.path.join(TMP_DIR, FINGERPRINT_FILE))
+    md5s = cache.digests([os.path.join(LINES_SRC_DIR, 'filter.map')] + sources, jobs)
+    cache.save()
 
     final = hashlib.md5()
     final.update(DBSTRUCT)
-    final.update(get_md5(os.path.join(LINES_SRC_DIR, 'filter.map')))
-    for src in sources:
-        final.update(get_md5(src))
+    for md5 in md5s:
+        final.update(md5)
+    for window in windows:
+        final.update(season_name(window))
     return final.hexdigest()
 
-def make_chunks(rawname, chunksize=0):
+def chunk_statement(line):
+    """
+    Formats a line of raw SQL for chunks: comments are removed and 
+    every statement ends up on its own line, without its final ';'.
+    """
+    # Order matters
+    for pat, sub in (   (r'--.*$', ''), (r'$', ' '), 
+                        (r'IS NULL;', 'IS NULL## END;'), (r'^[ \t]*', ''), 
+                        (r'\n', ''), (r';', '\n'), (r'##', ';') ):
+        line = re.sub(pat, sub, line)
+    return line
+
+def content_boundary(data, seek, chunksize):
+    """
+    Content-defined chunk boundary: true if a chunk of seek bytes can end
+    with the data statement. The hash of the statement falls under its
+    length (out of chunksize) so that chunks are chunksize bytes long on
+    average, within CDC_MIN_RATIO and CDC_MAX_RATIO bounds. Boundaries
+    only depend on the statements around them: adding or removing rows
+    only changes the chunk they belong to.
+    """
+    if chunksize <= 0 or seek < chunksize / CDC_MIN_RATIO:
+        return False
+    if seek >= chunksize * CDC_MAX_RATIO:
+        return True
+    return (zlib.crc32(data) & 0xffffffff) % chunksize < len(data)
+
+class ChunkFile(object):
+    """
+    Chunk file of TMP_DIR, named after prefix and its number or, if
+    hashed, after the MD5 digest of its content (once closed).
     """
-    Only one chunk if chunksize is null.
+    def __init__(self, prefix, chunk, ext, hashed=False):
+        self.prefix, self.chunk, self.ext, self.hashed = prefix, chunk, ext, hashed
+        self.name = os.path.join(TMP_DIR, "%s_%s.%s" % (prefix, 'tmp' if hashed else chunk, ext))
+        self.out = open(self.name, 'w')
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        self.out.write(data)
+        if self.hashed:
+            self.md5.update(data)
+
+    def close(self):
+        """
+        Returns the name of the chunk (digest or number).
+        """
+        self.out.close()
+        if not self.hashed:
+            return str(self.chunk)
+        digest = self.md5.hexdigest()
+        name = os.path.join(TMP_DIR, "%s_%s.%s" % (self.prefix, digest, self.ext))
+        if os.path.exists(name):
+            os.remove(name)
+        os.rename(self.name, name)
+        self.name = name
+        return digest
+
+def make_chunks(rawname, chunksize=0, prefix=CHUNK_PREFIX, verbose=True, hashes=None):
+    """
+    Only one chunk if chunksize is null. Chunks are named after prefix 
+    (relative to TMP_DIR).
+
+    If hashes is a list, chunk boundaries are content defined (see 
+    content_boundary()) and chunks are named after the MD5 digest of 
+    their content, which is appended to hashes (in load order): 
+    unchanged parts of the database keep their chunk files across builds.
+
     Returns the number of chunks created.
     """
+    hashed = hashes is not None
     chunk = 1
-    outname = os.path.join(TMP_DIR, "%s_%d.xml" % (CHUNK_PREFIX, chunk))
+    out = ChunkFile(prefix, chunk, 'xml', hashed)
 
-    print "[%-18s] new chunk file %s..." % ("chunk %02d" % chunk, outname),
-    out = open(outname, 'w')
+    if verbose:
+        print "[%-18s] new chunk file %s..." % ("chunk %02d" % chunk, out.name),
     out.write(XML_HEADER)
     seek = 0
     out.write("""
@@ -481,26 +1631,25 @@ def make_chunks(rawname, chunksize=0):
     for line in open(rawname): 
         if line.startswith('BEGIN TRANSACTION;') or line.startswith('END TRANSACTION;') or line.startswith('END;'):
             continue
-        # Order matters
-        for pat, sub in (   (r'--.*$', ''), (r'$', ' '), 
-                            (r'IS NULL;', 'IS NULL## END;'), (r'^[ \t]*', ''), 
-                            (r'\n', ''), (r';', '\n'), (r'##', ';') ):
-            line = re.sub(pat, sub, line)
+        line = chunk_statement(line)
         out.write(line)
         seek += len(line)
-        if chunksize > 0 and seek > chunksize:
+        if content_boundary(line, seek, chunksize) if hashed else chunksize > 0 and seek > chunksize:
             seek = 0
             out.write("""
 </string>
 """)
-            out.close()
-            print "done."
+            name = out.close()
+            if hashed:
+                hashes.append(name)
+            if verbose:
+                print "done." if not hashed else "done, %s." % os.path.basename(out.name)
 
             # New chunk
             chunk += 1
-            outname = os.path.join(TMP_DIR, "%s_%d.xml" % (CHUNK_PREFIX, chunk))
-            print "[%-18s] new chunk file %s..." % ("chunk %02d" % chunk, outname),
-            out = open(outname, 'w')
+            out = ChunkFile(prefix, chunk, 'xml', hashed)
+            if verbose:
+                print "[%-18s] new chunk file %s..." % ("chunk %02d" % chunk, out.name),
             out.write(XML_HEADER)
             out.write("""
 <string name="ht_createdb">
@@ -510,33 +1659,286 @@ def make_chunks(rawname, chunksize=0):
     out.write("""
 </string>
 """)
-    out.close()
-    print "done."
+    name = out.close()
+    if hashed:
+        hashes.append(name)
+    if verbose:
+        print "done." if not hashed else "done, %s." % os.path.basename(out.name)
     return chunk
 
+def make_row_chunks(rawname, chunksize=0, prefix=ROWS_CHUNK_PREFIX, verbose=True, hashes=None):
+    """
+    Alternative payload of make_chunks(): for every table, one INSERT
+    template with ? parameters followed by its rows, in the COPY text
+    format of psqldb (tab separated, \\N for NULL), up to a \\. line.
+    Other lines are statements (schema). Files are plain text (to be
+    shipped as raw resources, no XML parsing on the device) and every
+    chunk can be loaded on its own (see load_row_chunks).
+
+    Only one chunk if chunksize is null. Chunks are content defined and
+    named after their digest if hashes is a list (see make_chunks()).
+    Returns the number of chunks created.
+    """
+    head, tail = '', ''
+    tables = []
+    rows = {}
+    for line in open(rawname):
+        if line.startswith('BEGIN TRANSACTION;') or line.startswith('END TRANSACTION;') or line.startswith('END;'):
+            continue
+        m = CopyWriter.INSERT_PAT.match(line.rstrip('\n'))
+        if not m:
+            if tables:
+                tail += chunk_statement(line)
+            else:
+                head += chunk_statement(line)
+            continue
+        table = m.group(1)
+        values = []
+        for v in CopyWriter.VALUE_PAT.finditer(m.group(2)):
+            if v.group(0) == 'NULL':
+                values.append(None)
+            elif v.group(0).startswith('"'):
+                values.append(v.group(1))
+            else:
+                values.append(v.group(2))
+        if not rows.has_key(table):
+            tables.append((table, len(values)))
+            rows[table] = tempfile.TemporaryFile(dir=TMP_DIR)
+        rows[table].write(psqldb.copy_row(values))
+
+    hashed = hashes is not None
+    chunk = 1
+    out = ChunkFile(prefix, chunk, 'txt', hashed)
+    if verbose:
+        print "[%-18s] new chunk file %s..." % ("rows %02d" % chunk, out.name),
+    # One statement per line
+    head = [st.strip() + '\n' for st in head.split('\n') if st.strip()]
+    tail = [st.strip() + '\n' for st in tail.split('\n') if st.strip()]
+    out.write(''.join(head))
+    seek = 0
+    cut = False
+    for table, numcols in tables:
+        template = "INSERT INTO %s VALUES (%s)\n" % (table, ', '.join(['?'] * numcols))
+        out.write(template)
+        f = rows.pop(table)
+        f.seek(0)
+        for line in f:
+            if cut:
+                seek = 0
+                out.write("\\.\n")
+                name = out.close()
+                if hashed:
+                    hashes.append(name)
+                if verbose:
+                    print "done." if not hashed else "done, %s." % os.path.basename(out.name)
+
+                # New chunk, same table
+                chunk += 1
+                out = ChunkFile(prefix, chunk, 'txt', hashed)
+                if verbose:
+                    print "[%-18s] new chunk file %s..." % ("rows %02d" % chunk, out.name),
+                out.write(template)
+            out.write(line)
+            seek += len(line)
+            cut = content_boundary(line, seek, chunksize) if hashed else chunksize > 0 and seek > chunksize
+        out.write("\\.\n")
+        f.close()
+    out.write(''.join(tail))
+    name = out.close()
+    if hashed:
+        hashes.append(name)
+    if verbose:
+        print "done." if not hashed else "done, %s." % os.path.basename(out.name)
+    return chunk
+
+def make_line_chunks(rawname, chunksize=0, payload='sql'):
+    """
+    Splits the raw SQL content in a base bundle (schema, network, city, 
+    station, line and aggregate tables) and one bundle per line with its 
+    LINE_CHUNK_TABLES rows, so that the Android application only fetches 
+    the lines it needs. Bundles are written in LINES_DIR as chunks of the 
+    payload format (base_N and line_<id>_N files, see make_chunks() and 
+    make_row_chunks()).
+
+    The LINES_MANIFEST_FILE manifest lists the number of chunks, checksum 
+    and version of every bundle. Versions are only incremented when the 
+    checksum of a bundle changed since the previous build.
+
+    Returns the number of lines.
+    """
+    outdir = os.path.join(TMP_DIR, LINES_DIR)
+    if not os.path.exists(outdir):
+        os.mkdir(outdir)
+    manifest = os.path.join(outdir, LINES_MANIFEST_FILE)
+    versions = {}
+    if os.path.exists(manifest):
+        for m in re.finditer(r'<item>([^;<]+);(\d+);\d+;(\w+)</item>', open(manifest).read()):
+            versions[m.group(1)] = (int(m.group(2)), m.group(3))
+    for name in glob.glob(os.path.join(outdir, '*_*.xml')) + glob.glob(os.path.join(outdir, '*_*.txt')):
+        if os.path.basename(name) != LINES_MANIFEST_FILE:
+            os.remove(name)
+
+    # Rows of a line follow its line row (see makeSQL())
+    insert_pat = re.compile(r'^INSERT INTO (\w+) VALUES\((\d+)?')
+    bundles = ['base']
+    base = tempfile.NamedTemporaryFile(dir=TMP_DIR, suffix='.sql', delete=False)
+    names = {'base': base.name}
+    out = None
+    for line in open(rawname):
+        m = insert_pat.match(line)
+        if m and m.group(1) == 'line':
+            if out:
+                out.close()
+            bundle = "line_%s" % m.group(2)
+            out = tempfile.NamedTemporaryFile(dir=TMP_DIR, suffix='.sql', delete=False)
+            bundles.append(bundle)
+            names[bundle] = out.name
+        if m and m.group(1) in LINE_CHUNK_TABLES:
+            out.write(line)
+        else:
+            base.write(line)
+    if out:
+        out.close()
+    base.close()
+
+    items = []
+    for bundle in bundles:
+        prefix = os.path.join(LINES_DIR, bundle)
+        if payload == 'rows':
+            num_chunks = make_row_chunks(names[bundle], chunksize, prefix, verbose=False)
+            files = chunk_files(prefix, 'txt')
+        else:
+            num_chunks = make_chunks(names[bundle], chunksize, prefix, verbose=False)
+            files = chunk_files(prefix, 'xml')
+        os.remove(names[bundle])
+        md5 = hashlib.md5()
+        for name in files:
+            md5.update(open(name, 'rb').read())
+        chksum = md5.hexdigest()
+        version, old = versions.get(bundle, (0, None))
+        if old != chksum:
+            version += 1
+        items.append("    <item>%s;%d;%d;%s</item>\n" % (bundle, version, num_chunks, chksum))
+
+    out = open(manifest, 'w')
+    out.write(XML_HEADER)
+    out.write("""
+<resources>
+  <string name="payload">%s</string>
+  <!-- bundle;version;chunks;checksum -->
+  <string-array name="bundles">
+%s  </string-array>
+</resources>
+""" % (payload, ''.join(items)))
+    out.close()
+    return len(bundles) - 1
+
+def chunk_files(prefix, ext):
+    """
+    Chunk files of TMP_DIR, in load order. Chunks named after their
+    digest come last, their order is only known from the checksum file
+    (see write_android()).
+    """
+    def key(name):
+        m = re.search(r'_(\d+)\.%s$' % ext, name)
+        return (0, int(m.group(1)), name) if m else (1, 0, name)
+    names = glob.glob(os.path.join(TMP_DIR, "%s_*.%s" % (prefix, ext)))
+    return sorted(names, key=key)
+
+def load_chunks(names, dbname):
+    """
+    Replays XML chunks in a new SQLite database the way the Android 
+    application does: one statement at a time, in a single transaction.
+    """
+    import sqlite3
+    if os.path.exists(dbname):
+        os.remove(dbname)
+    conn = sqlite3.connect(dbname)
+    conn.isolation_level = None
+    c = conn.cursor()
+    c.execute("BEGIN")
+    for name in names:
+        f = open(name)
+        data = f.read()
+        f.close()
+        data = data[data.index('<string name="ht_createdb">') + 27:data.rindex('</string>')]
+        for line in data.split('\n'):
+            if line.strip():
+                c.execute(unicode(line, 'utf-8'))
+    c.execute("COMMIT")
+    c.close()
+    conn.close()
+
+def load_row_chunks(names, dbname):
+    """
+    Reference loader of row chunks (see make_row_chunks): rows are bound
+    to the prepared INSERT template of their table, in a single 
+    transaction.
+    """
+    def read_rows(f):
+        for line in f:
+            if line == '\\.\n':
+                return
+            yield [unicode(v, 'utf-8') if v is not None else None for v in psqldb.copy_values(line)]
+        raise ValueError, "unterminated rows block in %s" % name
+
+    import sqlite3
+    if os.path.exists(dbname):
+        os.remove(dbname)
+    conn = sqlite3.connect(dbname)
+    conn.isolation_level = None
+    c = conn.cursor()
+    c.execute("BEGIN")
+    for name in names:
+        f = open(name)
+        for line in f:
+            if not line.strip():
+                continue
+            if line.startswith('INSERT INTO ') and line.rstrip().endswith('?)'):
+                c.executemany(line, read_rows(f))
+            else:
+                c.execute(unicode(line, 'utf-8'))
+        f.close()
+    c.execute("COMMIT")
+    c.close()
+    conn.close()
+
+def make_tarball(chkname):
+    """
+    Makes a tarball of schedules (chunks and checksum file chkname) that 
+    can be served over HTTP to upgrade the Android client.
+    """
+    import tarfile
+    with tarfile.open(os.path.join(TMP_DIR, UPDATE_TARBALL), 'w:bz2') as tar:
+        chunkfiles = glob.glob(os.path.join(TMP_DIR, "%s_*.xml" % CHUNK_PREFIX))
+        chunkfiles.extend(glob.glob(os.path.join(TMP_DIR, "%s_*.txt" % ROWS_CHUNK_PREFIX)))
+        for name in chunkfiles:
+            tar.add(name, os.path.basename(name))
+        tar.add(chkname, os.path.basename(chkname))
+
 def check_up_to_date(chksum):
     """
     Are the source files in sync with the current SQL and DB?
-    Exits gracefully if nothing to do at all.
+    Exits gracefully if nothing to do at all. The checksum is only 
+    written once the build succeeded (see save_checksum()).
     """
-    # Write checksum for later comparison
-    if not os.path.exists(os.path.join(TMP_DIR, CHKSUM_FILE)):
-        f = open(os.path.join(TMP_DIR, CHKSUM_FILE), 'w')
-        f.write(chksum)
-        f.close()
-    else:
+    if os.path.exists(os.path.join(TMP_DIR, CHKSUM_FILE)):
         # Nothing to do?
         f = open(os.path.join(TMP_DIR, CHKSUM_FILE))
         if f.read() == chksum:
            print "Nothing to do. Exiting."
            f.close()
            sys.exit(0)
-        else:
-            p = open(os.path.join(TMP_DIR, CHKSUM_FILE), 'w')
-            p.write(chksum)
-            p.close()
         f.close()
 
+def save_checksum(chksum):
+    """
+    Writes the checksum of a successful build for later comparison.
+    """
+    f = open(os.path.join(TMP_DIR, CHKSUM_FILE), 'w')
+    f.write(chksum)
+    f.close()
+
 def init_networks(srcdir):
     """
     Find available bus networks. networks.json is a static file edited
@@ -559,59 +1961,203 @@ def init_networks(srcdir):
     for k, v in nets.iteritems():
         lines = glob.glob(os.path.join(module_path(), srcdir, v['path'], '*.in'))
         if not lines:
-            print "[%s] Warning: missing line definitions (*.in)" % k
+            # Lines of GTFS networks are imported (see import_gtfs())
+            if not v.get('gtfs'):
+                print "[%s] Warning: missing line definitions (*.in)" % u8(k)
         else:
             nets[k]["lines"].extend(map(lambda x: os.path.basename(x), lines))
             print "[%s] Found %d lines" % (unicode(k).encode('utf-8'), len(lines))
 
     return nets
 
-def bsc_compile(srcdir):
+def import_gtfs(infile):
+    """
+    Imports the GTFS feed of every network with a "gtfs" entry (feed 
+    directory, relative to LINES_SRC_DIR) in the networks file: lines 
+    are written in infile, in the network path, in place of compiled 
+    lines (see gtfs.import_feed()). Feeds are only imported again when 
+    they changed.
+    """
+    import gtfs
+    netfile = os.path.join(LINES_SRC_DIR, NETWORKS_FILE)
+    if not os.path.isfile(netfile):
+        return
+    with open(netfile) as f:
+        nets = json.loads(f.read())
+    for net, data in sorted(nets.iteritems()):
+        if not data.get('gtfs'):
+            continue
+        count = gtfs.import_feed(os.path.join(LINES_SRC_DIR, u8(data['gtfs'])), os.path.join(infile, u8(data['path'])), 
+            os.path.join(LINES_SRC_DIR, GPS_CACHE_FILE))
+        if count is None:
+            print "[%-18s] %s: feed unchanged" % ('gtfs', u8(net))
+
+def bsc_compile(srcdir, jobs=1):
     """
     Runs the bsc compiler on *.in bus lines definitions. Returns the list of
     available bus networks.
+
+    Compiled lines are taken from the build cache (if any) when neither 
+    the line definition nor the compiler changed. With more than one job, 
+    networks are compiled by up to jobs processes at a time.
     """
     # Find available networks
     networks = init_networks(srcdir)
-    bsc = os.path.join(module_path(), LCOMPILER)
+    if jobs > 1:
+        import multiprocessing
+        tasks = [(srcdir, data) for net, data in sorted(networks.iteritems())]
+        pool = multiprocessing.Pool(jobs)
+        try:
+            pool.map(compile_network, tasks)
+        finally:
+            pool.close()
+            pool.join()
+        print "[%-18s] compiled %d network(s)" % ('bsc', len(networks))
+        return networks
     # Compile every lines
     for net, data in networks.iteritems():
         if len(data["lines"]) == 0: continue
         print "[%s] Compiling lines" % unicode(net).encode('utf-8'),
-        destdir = os.path.join(module_path(), '..', "raw", data["path"])
+        destdir = compiled_dir(data["path"])
         if not os.path.exists(destdir):
             os.makedirs(destdir)
         for line in data["lines"]:
             print line,
             sys.stdout.flush()
-            cmd = "%s %s > %s" % (bsc, os.path.join(module_path(), '..', srcdir, data["path"], line),
+            bsc_compile_line(os.path.join(module_path(), '..', srcdir, data["path"], line),
                 os.path.join(destdir, re.sub('\.in$', '.txt', line)))
-            r = subprocess.call(cmd, shell=True)
-            if r != 0:
-                sys.exit(r)
         print
 
     return networks
 
+def compile_network(args):
+    """
+    Compiles the lines of a single bus network, in its own process (see 
+    bsc_compile()).
+    """
+    srcdir, data = args
+    path = u8(data["path"])
+    destdir = compiled_dir(path)
+    if not os.path.exists(destdir):
+        os.makedirs(destdir)
+    for line in data["lines"]:
+        bsc_compile_line(os.path.join(module_path(), '..', srcdir, path, line),
+            os.path.join(destdir, re.sub('\.in$', '.txt', line)))
+
+def bsc_compile_line(src, dest):
+    """
+    Compiles the src line definition (.in) into dest, using the build 
+    cache if any.
+    """
+    bsc = os.path.join(module_path(), LCOMPILER)
+    if g_cache:
+        key = g_cache.key('bsc', get_md5(src), g_cache.digest(bsc))
+        if g_cache.fetch(key, dest):
+            return
+    # Never write through a link to a cache entry
+    if os.path.exists(dest):
+        os.remove(dest)
+    cmd = "%s %s > %s" % (bsc, src, dest)
+    r = subprocess.call(cmd, shell=True)
+    if r != 0:
+        sys.exit(r)
+    if g_cache:
+        g_cache.store(key, dest)
+
+def read_prefilter(prefilter):
+    """
+    Returns the list of sed expressions of the prefilter file and their
+    digest.
+    """
+    pf = open(prefilter)
+    filters = pf.readlines()
+    pf.close()
+    exprs = []
+    for pmap in filters:
+        pmap = pmap.replace('\n', '')
+        if pmap.strip().startswith('#') or len(pmap.strip()) == 0:
+            continue
+        # Old entry, new entry
+        oe, ne = pmap.split(';')
+        exprs.append("s,%s,%s,gI" % (oe, ne))
+    return exprs, hashlib.md5('\n'.join(exprs)).hexdigest()
+
+def prefilter_files(exprs, digest, linedefs):
+    """
+    Applies the sed expressions exprs (with digest, see read_prefilter()) 
+    to linedefs files, in place, using the build cache if any.
+    """
+    keys = {}
+    if g_cache:
+        for linedef in linedefs:
+            key = g_cache.key('pre-filter', get_md5(linedef), digest)
+            if not g_cache.fetch(key, linedef):
+                keys[linedef] = key
+        linedefs = keys.keys()
+    if linedefs and exprs:
+        # All substitutions in a row, sed -i replaces files (never writes 
+        # through links to cache entries)
+        cmd = "sed -i %s %s" % (' '.join(["-e \"%s\"" % e for e in exprs]), 
+            ' '.join(["\"%s\"" % l for l in linedefs]))
+        subprocess.call(cmd, shell=True)
+    for linedef in linedefs:
+        if keys.has_key(linedef):
+            g_cache.store(keys[linedef], linedef)
+
+def find_sources(srcdir):
+    """
+    Returns the list of lines (.txt files) found in srcdir.
+    """
+    sources = []
+    for root, dirs, files in os.walk(srcdir):
+        linedefs = glob.glob(os.path.join(root, "*.txt"))
+        if len(linedefs) == 0: continue
+        sources.extend(linedefs)
+    return sources
+
+def compiled_dir(path=''):
+    """
+    Directory of the lines compiled by bsc (network path), in the work 
+    directory so that builds never write in the source tree.
+    """
+    return os.path.join(TMP_DIR, COMPILED_DIR, path)
+
+def find_lines(infile, path=''):
+    """
+    Returns a dictionary of relative path -> name of the lines to build 
+    (of the network path, all of them if empty): .txt files of infile 
+    (i.e. GTFS imports) and lines compiled by bsc, which replace the 
+    lines of infile of the same name.
+    """
+    lines = {}
+    for srcdir in (infile, compiled_dir()):
+        for src in find_sources(os.path.join(srcdir, path)):
+            lines[os.path.relpath(src, srcdir)] = src
+    return lines
+
 def apply_prefilter(prefilter, infile):
     """
     Apply any substitutions by using regexps defined in the prefilter
     file.
+
+    Filtered lines are taken from the build cache (if any) when neither 
+    the compiled line nor the filter rules changed.
     """
     if not os.path.exists(prefilter):
         raise ValueError, "pre filter not a file"
     filter_dir = os.path.join(TMP_DIR, 'pre-filter')
     # Clean up target
-    if not os.path.exists(filter_dir):
-        os.mkdir(filter_dir)
-    shutil.rmtree(filter_dir)
-    shutil.copytree(infile, filter_dir)
+    if os.path.exists(filter_dir):
+        shutil.rmtree(filter_dir)
+    for rel, src in find_lines(infile).iteritems():
+        dest = os.path.join(filter_dir, rel)
+        if not os.path.exists(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        shutil.copyfile(src, dest)
 
-    import string
     subs = 0
-    pf = open(prefilter)
-    filters = pf.readlines()
-    pf.close()
+    exprs, digest = read_prefilter(prefilter)
+
     sources = []
     for root, dirs, files in os.walk(filter_dir):
         linedefs = glob.glob(os.path.join(root, "*.txt"))
@@ -619,46 +2165,798 @@ def apply_prefilter(prefilter, infile):
         sources.extend(linedefs)
         print "[%-18s] applying %s to %s ..." % ('pre-filter', prefilter, root),
         sys.stdout.flush()
-        for pmap in filters:
-            pmap = pmap.replace('\n', '')
-            if pmap.strip().startswith('#') or len(pmap.strip()) == 0:
-                continue
-            # Old entry, new entry
-            oe, ne = pmap.split(';')
-            cmd = "sed -i \"s,%s,%s,gI\" %s" % (oe, ne, os.path.join(root, '*.txt'))
-            subprocess.call(cmd, shell=True)
-            subs += 1
+        prefilter_files(exprs, digest, linedefs)
+        subs += len(exprs)
         print "%d entries" % subs
 
     return sources
 
+def build_shard(args):
+    """
+    Builds the shard of a single bus network, in its own process and 
+    work directory (TMP_DIR/shards/<network path>): pre-filters and 
+    parses its lines, compiled beforehand by bsc_compile(). Parsed lines 
+    are saved in the shard file, whose name is returned. See 
+    merge_shards().
+    """
+    network, data, infile = args
+    path = u8(data["path"])
+    workdir = os.path.join(TMP_DIR, SHARDS_DIR, path)
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+
+    lines = find_lines(infile, path)
+    sources = sorted(lines.values())
+    if g_prefilter:
+        filter_dir = os.path.join(workdir, 'pre-filter')
+        if os.path.exists(filter_dir):
+            shutil.rmtree(filter_dir)
+        sources = []
+        for rel, src in sorted(lines.iteritems()):
+            dest = os.path.join(filter_dir, rel)
+            if not os.path.exists(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            shutil.copyfile(src, dest)
+            sources.append(dest)
+    if g_prefilter:
+        exprs, digest = read_prefilter(os.path.join(LINES_SRC_DIR, g_prefilter))
+        prefilter_files(exprs, digest, sources)
+
+    parsed = {}
+    for src in sources:
+        md5 = get_md5(src)
+        parsed[src] = (md5, parse(src))
+
+    shard = os.path.join(workdir, SHARD_FILE)
+    tmp = "%s.%d.tmp" % (shard, os.getpid())
+    f = open(tmp, 'wb')
+    cPickle.dump(parsed, f, cPickle.HIGHEST_PROTOCOL)
+    f.close()
+    os.rename(tmp, shard)
+    print "[%-18s] %s: %d lines" % ('shard', u8(network), len(sources))
+    return shard
+
+def build_shards(networks, infile, jobs=1):
+    """
+    Builds a shard per bus network, running up to jobs processes at a 
+    time. Returns the list of shard files.
+    """
+    import multiprocessing
+    tasks = [(net, data, infile) for net, data in sorted(networks.iteritems())]
+    pool = multiprocessing.Pool(max(1, jobs))
+    try:
+        shards = pool.map(build_shard, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    return shards
+
+def merge_shards(shards):
+    """
+    Merges shard files into a new build state. Global ids are assigned 
+    by makeSQL() exactly as for a monolithic build, which gets the same 
+    SQL content. Returns the build state and the list of sources.
+    """
+    state = BuildState(keep_parsed=True)
+    sources = []
+    for shard in shards:
+        f = open(shard, 'rb')
+        parsed = cPickle.load(f)
+        f.close()
+        state.parsed.update(parsed)
+        sources.extend(parsed.keys())
+    return state, sources
+
+class ContentCache(object):
+    """
+    Content-addressed cache of build outputs (compiled and pre-filtered 
+    lines). Entries are named after a hash of everything the output 
+    depends on, so that a cache directory can be shared between build 
+    hosts and branches.
+
+    Hits are hard linked (or copied) to their destination. Once the 
+    build is done, least recently used entries are evicted until the 
+    cache fits in maxsize bytes. Use times are those of an empty .used 
+    file next to every entry: touching the entry itself would touch its 
+    hard links too (see FingerprintCache).
+    """
+    USED_SUFFIX = '.used'
+
+    def __init__(self, cachedir, maxsize):
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self.digests = {}
+        if not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+
+    def key(self, *parts):
+        return hashlib.sha1('\0'.join(parts)).hexdigest()
+
+    def digest(self, filename):
+        """
+        MD5 digest of filename, computed once (i.e for the compiler).
+        """
+        if not self.digests.has_key(filename):
+            self.digests[filename] = get_md5(filename)
+        return self.digests[filename]
+
+    def path(self, key):
+        return os.path.join(self.cachedir, key[:2], key)
+
+    def fetch(self, key, dest):
+        """
+        Links the cache entry key to dest. Returns False on cache miss.
+        """
+        entry = self.path(key)
+        if not os.path.exists(entry):
+            self.misses += 1
+            return False
+        # Most recently used
+        used = entry + self.USED_SUFFIX
+        open(used, 'a').close()
+        os.utime(used, None)
+        if os.path.exists(dest):
+            os.remove(dest)
+        try:
+            os.link(entry, dest)
+        except OSError:
+            shutil.copyfile(entry, dest)
+        self.hits += 1
+        return True
+
+    def store(self, key, src):
+        entry = self.path(key)
+        if not os.path.exists(os.path.dirname(entry)):
+            os.makedirs(os.path.dirname(entry))
+        # Atomic, the cache may be shared
+        tmp = "%s.%d.tmp" % (entry, os.getpid())
+        shutil.copyfile(src, tmp)
+        os.rename(tmp, entry)
+
+    def evict(self):
+        """
+        Removes least recently used entries. Returns the number of entries 
+        removed.
+        """
+        entries = []
+        size = 0
+        for root, dirs, files in os.walk(self.cachedir):
+            for name in files:
+                if name.endswith(self.USED_SUFFIX):
+                    continue
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                mtime = st.st_mtime
+                if name + self.USED_SUFFIX in files:
+                    mtime = max(mtime, os.stat(path + self.USED_SUFFIX).st_mtime)
+                entries.append((mtime, st.st_size, path))
+                size += st.st_size
+        entries.sort()
+        removed = 0
+        while size > self.maxsize and entries:
+            mtime, esize, path = entries.pop(0)
+            os.remove(path)
+            if os.path.exists(path + self.USED_SUFFIX):
+                os.remove(path + self.USED_SUFFIX)
+            size -= esize
+            removed += 1
+        return removed
+
+def write_sqlite(networks, sources, outname, state=None):
+    """
+    Writes the raw SQL content for SQLite in outname. Returns the set of 
+    sources emitted again (see makeSQL()).
+    """
+    # Grouping all INSERTs in a single transaction really 
+    # speeds up the whole thing
+    out = open(outname, 'w')
+    out.write("BEGIN TRANSACTION;\n")
+    out.write(DBSTRUCT)
+    changed = makeSQL(networks, sources, out, state)
+    out.write(sqlitedb.SPATIAL_INDEX)
+    out.write("END TRANSACTION;\n")
+    out.close()
+    return changed
+
+def write_sql(networks, sources, targets, state=None, spatial=True):
+    """
+    Writes the raw SQL content of every target backend (sqlite, mysql, 
+    psql) in a single pass: lines are parsed once and rows written to all 
+    outputs at the same time (see FanOut). Returns a dictionary of 
+    target -> output file name.
+
+    The SQLite content ends with the stations spatial index (R*Tree) 
+    if spatial is True.
+    """
+    backends = {
+        'sqlite': (RAW_DB_FILE, "BEGIN TRANSACTION;\n", sqlitedb.DBSTRUCT, 
+            (sqlitedb.SPATIAL_INDEX if spatial else '') + "END TRANSACTION;\n"),
+        'mysql': (RAW_DB_FILE if targets == ['mysql'] else MYSQL_DB_FILE, 
+            "SET autocommit=0;\nBEGIN;\n", mysqldb.DBSTRUCT, "COMMIT;\nSET autocommit=1;\n"),
+        'psql': (RAW_DB_FILE if targets == ['psql'] else PSQL_DB_FILE, 
+            "SET client_encoding = 'UTF8';\nBEGIN;\n", psqldb.DBSTRUCT, psqldb.DBINDEXES + "COMMIT;\n"),
+    }
+    outnames = {}
+    files = []
+    outs = []
+    for target in targets:
+        name, begin, struct, end = backends[target]
+        outnames[target] = os.path.join(TMP_DIR, name)
+        f = open(outnames[target], 'w')
+        f.write(begin)
+        f.write(struct)
+        files.append(f)
+        if target == 'psql':
+            outs.append(CopyWriter(f))
+        else:
+            outs.append(f)
+    if len(outs) == 1:
+        makeSQL(networks, sources, outs[0], state)
+    else:
+        fan = FanOut(outs)
+        try:
+            makeSQL(networks, sources, fan, state)
+        finally:
+            fan.close()
+    for target, out, f in zip(targets, outs, files):
+        if out is not f:
+            out.close()
+        f.write(backends[target][3])
+        f.close()
+    return outnames
+
+def export_columns(rawname, outdir):
+    """
+    Writes the stops of the rawname SQL content as columnar NumPy arrays 
+    in outdir: station, line, direction, run, minutes and pattern (index 
+    in the patterns list of the meta.json file, which also names lines 
+    and cities). Empty patterns are replaced by the default one of their 
+    line. Arrays can be memory mapped with numpy.load(name, mmap_mode='r').
+
+    Stops are every run of the trip, stop_time and frequency tables (one 
+    direction at a time), which rawname must hold: unlike the stop table, 
+    they tell runs apart. Runs are numbered from 0 and their minutes past 
+    midnight keep increasing past 24 * 60 (i.e. 00:10 after 23:50 is 1450).
+
+    Returns the number of rows written.
+    """
+    import numpy, array
+    line_pat = re.compile(r'^INSERT INTO line VALUES\((\d+), \d+, "([^"]*)", "[^"]*", "([^"]*)"')
+    city_pat = re.compile(r'^INSERT INTO city VALUES\((\d+), "([^"]*)"')
+    line_station_pat = re.compile(r'^INSERT INTO line_station VALUES\(NULL, (\d+), (\d+), (\d+), (\d+)\);$')
+    trip_pat = re.compile(r'^INSERT INTO trip VALUES\((\d+), (\d+), (\d+), "([^"]*)"\);$')
+    stop_time_pat = re.compile(r'^INSERT INTO stop_time VALUES\((\d+), (\d+), (\d+)\);$')
+    frequency_pat = re.compile(r'^INSERT INTO frequency VALUES\((\d+), (\d+), (\d+), (\d+)\);$')
+    cols = dict([(name, array.array('i')) for name in ('station', 'line', 'direction', 'run', 'minutes', 'pattern')])
+    patterns = {}
+    lines = {}
+    cities = {}
+    runs = [0]
+
+    def add(station_id, line_id, direction_id, minutes, pat):
+        if not pat:
+            pat = lines[line_id][1]
+        cols['station'].append(station_id)
+        cols['line'].append(line_id)
+        cols['direction'].append(direction_id)
+        cols['run'].append(runs[0])
+        cols['minutes'].append(minutes)
+        cols['pattern'].append(patterns.setdefault(pat, len(patterns)))
+
+    # Trips of the current direction: (direction, rank) -> station id 
+    # and trip id -> [line id, direction id, pattern, times, frequencies]
+    ranks = {}
+    trips = {}
+    def add_trips():
+        for trip_id in sorted(trips.keys()):
+            line_id, direction_id, pat, times, freqs = trips[trip_id]
+            if not times:
+                continue
+            first = times[0][1]
+            deps = [first]
+            if freqs:
+                deps = [dep for start, end, headway in freqs for dep in xrange(start, end + 1, headway)]
+            for dep in deps:
+                for seq, minutes in times:
+                    add(ranks[(direction_id, seq)], line_id, direction_id, minutes - first + dep, pat)
+                runs[0] += 1
+        ranks.clear()
+        trips.clear()
+
+    f = open(rawname)
+    for row in f:
+        m = stop_time_pat.match(row)
+        if m:
+            trip_id, seq, minutes = map(int, m.groups())
+            trips[trip_id][3].append((seq, minutes))
+            continue
+        m = frequency_pat.match(row)
+        if m:
+            trip_id, start, end, headway = map(int, m.groups())
+            trips[trip_id][4].append((start, end, headway))
+            continue
+        m = trip_pat.match(row)
+        if m:
+            trips[int(m.group(1))] = [int(m.group(2)), int(m.group(3)), m.group(4), [], []]
+            continue
+        m = line_station_pat.match(row)
+        if m:
+            if trips:
+                # Next direction, which may have the same direction id
+                add_trips()
+            line_id, station_id, rank, direction_id = map(int, m.groups())
+            ranks[(direction_id, rank)] = station_id
+            continue
+        m = line_pat.match(row)
+        if m:
+            add_trips()
+            lines[int(m.group(1))] = (m.group(2), m.group(3))
+            continue
+        m = city_pat.match(row)
+        if m:
+            cities[int(m.group(1))] = m.group(2)
+    f.close()
+    add_trips()
+
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    dtypes = {'minutes': numpy.int16, 'pattern': numpy.int16}
+    for name, data in cols.iteritems():
+        numpy.save(os.path.join(outdir, name + '.npy'), 
+            numpy.frombuffer(data, dtype=numpy.int32).astype(dtypes.get(name, numpy.int32)))
+    f = open(os.path.join(outdir, COLUMNS_META_FILE), 'w')
+    f.write(json.dumps({
+        'patterns': [p for p, k in sorted(patterns.iteritems(), key=lambda x: x[1])],
+        'lines': dict([(k, v[0]) for k, v in lines.iteritems()]),
+        'cities': cities,
+    }))
+    f.close()
+    return len(cols['minutes'])
+
+def load_sqlite(sqlname, dbname):
+    """
+    Loads the raw SQL content sqlname into a new SQLite database. dbname 
+    is replaced atomically, readers never see a partial database.
+    """
+    import sqlite3
+    tmpname = "%s.%d.tmp" % (dbname, os.getpid())
+    if os.path.exists(tmpname):
+        os.remove(tmpname)
+    conn = sqlite3.connect(tmpname)
+    f = open(sqlname)
+    conn.executescript(f.read())
+    f.close()
+    conn.close()
+    os.rename(tmpname, dbname)
+
+def refresh_sqlite(sqlname, dbname, state, changed, stale):
+    """
+    Updates the dbname SQLite database in place, in a single transaction: 
+    dimension rows (network, city, station), aggregate tables and the 
+    stations spatial index are replaced by the ones of sqlname, rows of stale line ids are 
+    deleted and rows of changed sources inserted again from their fragment.
+    """
+    import sqlite3
+    conn = sqlite3.connect(dbname)
+    conn.text_factory = str
+    c = conn.cursor()
+    try:
+        for table in ('network', 'city', 'station') + AGGREGATE_TABLES:
+            c.execute("DELETE FROM %s" % table)
+        f = open(sqlname)
+        dims = True
+        for line in f:
+            if not line.startswith('INSERT INTO '):
+                continue
+            table = line.split(' ', 3)[2]
+            if table == 'line':
+                dims = False
+            if dims or table in AGGREGATE_TABLES:
+                c.execute(line)
+        f.close()
+        if c.execute("SELECT name FROM sqlite_master WHERE name='station_rtree'").fetchone():
+            c.execute("DELETE FROM station_rtree")
+            c.execute(sqlitedb.SPATIAL_INDEX_ROWS)
+        for line_id in stale:
+            for table in ('stop_time', 'frequency'):
+                c.execute("DELETE FROM %s WHERE trip_id IN (SELECT id FROM trip WHERE line_id=?)" % table, (line_id,))
+            for table in ('trip', 'stop', 'line_station'):
+                c.execute("DELETE FROM %s WHERE line_id=?" % table, (line_id,))
+            c.execute("DELETE FROM line WHERE id=?", (line_id,))
+        for src in sorted(changed):
+            f = open(state.manifest.fragment(src))
+            for line in f:
+                c.execute(line)
+            f.close()
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        c.close()
+        conn.close()
+
+class Watcher(object):
+    """
+    Watches the lines source directory for changes to line definitions 
+    (.in), networks and pre-filter files. Uses inotify when pyinotify is 
+    available, periodic scans of the directory otherwise.
+    """
+    PATTERNS = ('*.in', NETWORKS_FILE, 'filter.map')
+
+    def __init__(self, srcdir, patterns=PATTERNS):
+        self.srcdir = srcdir
+        self.patterns = patterns
+        self.notifier = None
+        try:
+            import pyinotify
+            self.events = []
+            wm = pyinotify.WatchManager()
+            self.notifier = pyinotify.Notifier(wm, self.events.append, timeout=int(POLL_INTERVAL * 1000))
+            mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM | \
+                pyinotify.IN_DELETE | pyinotify.IN_CREATE
+            wm.add_watch(srcdir, mask, rec=True, auto_add=True)
+        except ImportError:
+            self.snap = self.snapshot()
+
+    def method(self):
+        if self.notifier:
+            return 'inotify'
+        return 'polling'
+
+    def matches(self, path):
+        for pat in self.patterns:
+            if fnmatch.fnmatch(os.path.basename(path), pat):
+                return True
+        return False
+
+    def snapshot(self):
+        """
+        Returns a dictionary of path -> (size, mtime) of watched files.
+        """
+        snap = {}
+        for root, dirs, files in os.walk(self.srcdir):
+            for name in files:
+                path = os.path.join(root, name)
+                if self.matches(path):
+                    try:
+                        st = os.stat(path)
+                        snap[path] = (st.st_size, st.st_mtime)
+                    except OSError:
+                        pass
+        return snap
+
+    def poll(self):
+        """
+        Returns the set of paths changed since the last call (possibly 
+        empty), waiting up to POLL_INTERVAL seconds.
+        """
+        changes = set()
+        if self.notifier:
+            if self.notifier.check_events():
+                self.notifier.read_events()
+                self.notifier.process_events()
+            for event in self.events:
+                if self.matches(event.pathname):
+                    changes.add(event.pathname)
+            del self.events[:]
+        else:
+            time.sleep(POLL_INTERVAL)
+            snap = self.snapshot()
+            for path in set(snap.keys()) | set(self.snap.keys()):
+                if snap.get(path) != self.snap.get(path):
+                    changes.add(path)
+            self.snap = snap
+        return changes
+
+    def wait(self):
+        """
+        Blocks until some files changed. Returns the set of changed paths 
+        once no more changes happened for DEBOUNCE_DELAY seconds.
+        """
+        changes = set()
+        while not changes:
+            changes = self.poll()
+        last = time.time()
+        while time.time() - last < DEBOUNCE_DELAY:
+            more = self.poll()
+            if more:
+                changes |= more
+                last = time.time()
+        return changes
+
+def watch(infile, dbname):
+    """
+    Watch mode: builds the SQLite database dbname then monitors 
+    LINES_SRC_DIR, rebuilding only what changed. A line definition change 
+    only compiles, pre-filters and parses that line; the database is 
+    updated in place. Changes to the networks or pre-filter files trigger 
+    a full build. Parsed lines are kept in memory between builds.
+    """
+    state = BuildState(keep_parsed=True)
+    srcdir = os.path.join(module_path(), '..', LINES_SRC_DIR)
+    sqlname = os.path.join(TMP_DIR, RAW_DB_FILE)
+    filter_dir = os.path.join(TMP_DIR, 'pre-filter')
+    networks = sources = None
+
+    def full_build():
+        networks = bsc_compile(LINES_SRC_DIR)
+        if g_prefilter:
+            sources = apply_prefilter(os.path.join(LINES_SRC_DIR, g_prefilter), infile)
+        else:
+            sources = find_lines(infile).values()
+        write_sqlite(networks, sources, sqlname, state)
+        load_sqlite(sqlname, dbname)
+        return networks, sources
+
+    def update_line(path):
+        """
+        Compiles and pre-filters a single line definition. Returns the 
+        source to parse (None if the line was removed) and the former one.
+        """
+        rel = re.sub('\.in$', '.txt', os.path.relpath(path, srcdir))
+        txt = os.path.join(compiled_dir(), rel)
+        src = txt
+        if g_prefilter:
+            src = os.path.join(filter_dir, rel)
+        if not os.path.exists(path):
+            for name in (txt, src):
+                if os.path.exists(name):
+                    os.remove(name)
+            return None, src
+        for name in (txt, src):
+            if not os.path.exists(os.path.dirname(name)):
+                os.makedirs(os.path.dirname(name))
+        bsc_compile_line(path, txt)
+        if g_prefilter:
+            # Never write through a link to a cache entry
+            if os.path.exists(src):
+                os.remove(src)
+            shutil.copyfile(txt, src)
+            exprs, digest = read_prefilter(os.path.join(LINES_SRC_DIR, g_prefilter))
+            prefilter_files(exprs, digest, [src])
+        return src, src
+
+    watcher = Watcher(srcdir)
+    print "[%-18s] building %s ..." % ('watch', dbname)
+    networks, sources = full_build()
+    while True:
+        print "[%-18s] watching %s (%s), ^C to stop" % ('watch', srcdir, watcher.method())
+        try:
+            changes = watcher.wait()
+        except KeyboardInterrupt:
+            print
+            break
+        t0 = time.time()
+        try:
+            full = [p for p in changes if not p.endswith('.in')]
+            if full:
+                print "[%-18s] %s changed, full build" % ('watch', ', '.join([os.path.basename(p) for p in full]))
+                networks, sources = full_build()
+            else:
+                before = dict([(src, e.get('line_id')) for src, e in state.manifest.lines.iteritems()])
+                sources = set(sources)
+                for path in sorted(changes):
+                    print "[%-18s] %s changed" % ('watch', os.path.relpath(path, srcdir))
+                    src, former = update_line(path)
+                    sources.discard(former)
+                    if src:
+                        sources.add(src)
+                sources = sorted(sources)
+                changed = write_sqlite(networks, sources, sqlname, state)
+                # Rows of changed or removed lines are replaced
+                keep = set([u8(src) for src in sources]) - set([u8(src) for src in changed])
+                stale = set([line_id for src, line_id in before.iteritems() if src not in keep and line_id])
+                stale.update([state.manifest.lines[u8(src)]['line_id'] for src in changed])
+                if os.path.exists(dbname):
+                    refresh_sqlite(sqlname, dbname, state, changed, stale)
+                else:
+                    load_sqlite(sqlname, dbname)
+        except (Exception, SystemExit), e:
+            print "[%-18s] build failed: %s" % ('watch', e)
+            continue
+        print "[%-18s] %s updated in %.3fs" % ('watch', dbname, time.time() - t0)
+
 def module_path():
     encoding = sys.getfilesystemencoding()
     return os.path.dirname(unicode(__file__, encoding))
 
+def write_android(chksum, options):
+    """
+    Writes the Android resources of the raw SQLite content of TMP_DIR: 
+    chunks, stats and checksum files and the update tarball.
+    """
+    rawname = os.path.join(TMP_DIR, RAW_DB_FILE)
+    print "[%-18s] XML DB resource for Android..." % 'chunks'
+    sys.stdout.flush()
+    for name in chunk_files(CHUNK_PREFIX, 'xml') + chunk_files(ROWS_CHUNK_PREFIX, 'txt'):
+        os.remove(name)
+    # Only one chunk
+    hashes = [] if options.chunking == 'content' else None
+    begin_stage('chunks')
+    if options.payload == 'rows':
+        num_chunks = make_row_chunks(rawname, options.chunksize, hashes=hashes)
+        names = chunk_files(ROWS_CHUNK_PREFIX, 'txt')
+    else:
+        num_chunks = make_chunks(rawname, options.chunksize, hashes=hashes)
+        names = chunk_files(CHUNK_PREFIX, 'xml')
+    end_stage()
+    print "[%-18s] done, wrote %d chunk(s), %d bytes" % ('chunks', num_chunks, 
+        sum([os.path.getsize(name) for name in names]))
+
+    if options.linechunks:
+        begin_stage('line chunks')
+        num_lines = make_line_chunks(rawname, options.chunksize, options.payload)
+        end_stage()
+        print "[%-18s] wrote a base bundle and %d line bundle(s) in %s" % ('line chunks', num_lines, 
+            os.path.join(TMP_DIR, LINES_DIR))
+
+    # Writing DB stats file resource
+    statsname = os.path.join(TMP_DIR, DB_STATS_FILE)
+    print "[%-18s] making DB stats file..." % statsname,
+    sys.stdout.flush()
+    out = open(statsname, 'w')
+    counts = dict(db_counts())
+    out.write(XML_HEADER)
+    out.write("""
+<resources>
+  <string name="num_networks">%(networks)d</string>
+  <string name="num_lines">%(lines)d</string>
+  <string name="num_cities">%(cities)d</string>
+  <string name="num_stations">%(stations)d</string>
+</resources>
+""" % counts)
+    out.close()
+    print "done."
+
+    # Writing checksum and version file
+    chkname = os.path.join(TMP_DIR, CHKSUM_DB_FILE)
+    out = open(chkname, 'w')
+    out.write(XML_HEADER)
+    print "[%-18s] making checksum file..." % chkname,
+    sys.stdout.flush()
+    chunklist = ''
+    if hashes is not None:
+        # Content-defined chunks, in load order
+        chunklist = """  <string-array name="chunks">
+%s  </string-array>
+""" % ''.join(["    <item>%s</item>\n" % h for h in hashes])
+    out.write("""
+<resources>
+  <string name="dbchecksum">%s</string>
+  <string name="numchunks">%d</string>
+  <string name="payload">%s</string>
+  <string name="chunking">%s</string>
+  <string name="timetable">%s</string>
+%s</resources>
+""" % (chksum, num_chunks, options.payload, options.chunking, g_timetable, chunklist))
+    out.close()
+    print "done."
+
+    # Check database version against an external XML file?
+    if options.dbcompare:
+        if not os.path.exists(options.dbcompare):
+            print "[%-18s] external XML file not found, copying current checksum file..." % 'dbcompare',
+            sys.stdout.flush()
+            out = open(options.dbcompare, 'w')
+            out.write(XML_HEADER)
+            out.write("""
+<resources>
+  <string name="numchunks">%d</string>
+  <string name="dbchecksum">%s</string>
+  <string name="dbversion">1</string>
+</resources>
+""" % (num_chunks, chksum))
+            out.close()
+            print "done."
+        else:
+            print "[%-18s] found external XML file, checking DB version..." % 'dbcompare'
+            old_chksum = old_version = None
+            for line in open(options.dbcompare):
+                m = re.search(r'"dbchecksum">(.*?)</string>', line)
+                if m:
+                    old_chksum = m.group(1)
+                m = re.search(r'"dbversion">(.*?)</string>', line)
+                if m:
+                    old_version = m.group(1)
+            if old_version == None:
+                print "Error: dbversion is None"
+                sys.exit(1)
+            if old_chksum == None:
+                print "Error: dbchecksum is None"
+                sys.exit(1)
+
+            if chksum != old_chksum:
+                print "[%-18s] database changed, incrementing version..." % 'UPGRADE',
+                new_version = int(old_version) + 1
+                sys.stdout.flush()
+                out = open(options.dbcompare, 'w')
+                out.write(XML_HEADER)
+                out.write("""
+<resources>
+  <string name="numchunks">%d</string>
+  <string name="dbchecksum">%s</string>
+  <string name="dbversion">%d</string>
+</resources>
+""" % (num_chunks, chksum, new_version))
+                out.close()
+                print "to v%d. Done." % new_version
+            else:
+                print "[%-18s] database NOT updated" % 'IDEM'
+            print "[%-18s] done." % 'dbcompare'
+
+    begin_stage('tarball')
+    make_tarball(chkname)
+    end_stage()
+    print "[%-18s] wrote bzip2 tarball" % 'network update'
+
 def main():
     global DEBUG
-    global g_prefilter, GPS_CACHE_FILE, DBSTRUCT
+    global g_prefilter, g_timetable, g_profiler, g_cache, g_valid, g_streaming, GPS_CACHE_FILE, STATIONS_GPS_CACHE_FILE, DBSTRUCT, TMP_DIR
 
     parser = OptionParser(usage="""
-%prog [--android|-d|-g|--gps|--gps-cache file] action (raw_line.txt|dir)
+%prog [--android|-d|-g|--gps|--gps-cache file] action[,action...] (raw_line.txt|dir)
 
 where action is one of:
   psql    generates SQL content for PostgreSQL
   sqlite  generates SQL content for SQLite
   mysql   generates SQL content for MySQL
+  android generates SQL content for SQLite and Android resources (same as --android sqlite)
+  watch   builds the SQLite database then rebuilds it when lines change
+
+Several SQL actions (i.e sqlite,mysql,psql,android) are built in a single pass.
   """)
+    parser.add_option("", '--valid-on', action="append", dest="validon", default=[], metavar="DATE", 
+        help="only builds lines valid on DATE (YYYY-MM-DD) [action: sql]")
+    parser.add_option("", '--valid-between', action="append", dest="validbetween", default=[], metavar="FIRST,LAST", 
+        help="only builds lines valid between FIRST and LAST dates (either can be empty). Several windows "
+             "(--valid-on or --valid-between) build a database per season in %s [action: sql]" % os.path.join('<work dir>', SEASONS_DIR, '<season>'))
+    parser.add_option("", '--duplicates', action="store", dest="duplicates", default=None, metavar="FILE", 
+        help="writes pre-filter entries merging near-duplicate station names in FILE [action: sql]")
     parser.add_option("", '--android', action="store_true", dest="android", default=False, help='SQL resource formatting for Android [action: sql]')
     parser.add_option("", '--use-chunks', action="store_true", dest="chunks", default=False, help='Split data in several chunks [action: sql]')
+    parser.add_option("", '--payload', type="choice", choices=('sql', 'rows'), dest="payload", default='sql', 
+        help="Android chunks format: sql (XML resources of SQL statements) or rows (INSERT templates and rows) [default: %default, action: sql]")
+    parser.add_option("", '--chunking', type="choice", choices=('fixed', 'content'), dest="chunking", default='fixed', 
+        help="Android chunk boundaries: fixed (every chunk size bytes) or content (content defined, chunks named after "
+             "their MD5 digest and listed in %s) [default: %%default, action: sql]" % CHKSUM_DB_FILE)
+    parser.add_option("", '--line-chunks', action="store_true", dest="linechunks", default=False, 
+        help="also writes a base bundle and a bundle per line, downloadable on demand, in %s [action: sql]" % os.path.join('<work dir>', LINES_DIR))
     parser.add_option("", '--db-compare-with', action="store", dest="dbcompare", default=False, help="compares current database checksum with an external XML file [action: sql]")
     parser.add_option("", '--pre-filter', action="store", dest="prefilter", default=None, help="applies a filter mapping on all raw input (useful to substitute content)")
     parser.add_option("", '--chunk-size', type="int", action="store", dest="chunksize", default=CHUNK_SIZE, help="set chunk size in kB [default: %d, action: sql]" % CHUNK_SIZE)
+    parser.add_option("", '--timetable', type="choice", choices=('stop', 'trip', 'both'), dest="timetable", default=g_timetable,
+        help="timetable tables to generate: stop (legacy stop table read by the Android app, every run), trip (trip, stop_time and frequency tables) or both [default: %s]" % g_timetable)
+    parser.add_option("", '--profile', action="store_true", dest="profile", default=False, 
+        help="records time, memory and table sizes of every build stage in %s" % os.path.join(TMP_DIR, PROFILE_FILE))
+    parser.add_option("", '--profile-stage', action="store", dest="profilestage", default=None, metavar="STAGE",
+        help="writes a cProfile dump of a build stage (implies --profile)")
+    parser.add_option("", '--cache-dir', action="store", dest="cachedir", default=None, 
+        help="cache of compiled and pre-filtered lines, can be shared between hosts [default: %s in work dir]" % CACHE_DIR)
+    parser.add_option("", '--cache-size', type="int", dest="cachesize", default=CACHE_SIZE, 
+        help="cache size limit in MB, 0 disables the cache [default: %default]")
+    parser.add_option("", '--sqlite-db', action="store", dest="sqlitedb", default=os.path.join(os.getenv('HOME', TMP_DIR), SQLITE_DB_FILE), 
+        help="SQLite database kept up to date [default: %default, action: watch]")
+    parser.add_option("", '--columns', action="store_true", dest="columns", default=False, 
+        help="also writes the stops of every run as NumPy arrays in %s (needs NumPy and --timetable trip or both) [action: sqlite, mysql]" % os.path.join('<work dir>', COLUMNS_DIR))
+    parser.add_option("-j", '--jobs', type="int", dest="jobs", default=1, help="number of parallel jobs [default: %default]")
+    parser.add_option("", '--shards', action="store_true", dest="shards", default=False, 
+        help="builds every network in its own process (see -j) then merges them")
+    parser.add_option("", '--streaming', action="store_true", dest="streaming", default=False, 
+        help="bounded-memory build: line summaries are kept on disk, aggregate rows are sorted in temporary files [action: sql]")
+    parser.add_option("", '--max-memory', type="int", dest="maxmemory", default=None, metavar="MB", 
+        help="memory ceiling of streaming builds: sizes the in-memory sorts of aggregate rows, the SQL build stops with an error once peak memory goes over it (cities and stations are kept in memory) [default: %d]" % MAX_MEMORY)
+    parser.add_option("-w", '--work-dir', action="store", dest="workdir", default=TMP_DIR, 
+        help="work and output directory, one per concurrent build [default: %default]")
     parser.add_option("-d", action="store_true", dest="debug", default=False, help='more debugging')
     parser.add_option("-v", '--verbose', action="store_true", dest="verbose", default=False, help='verbose output')
     parser.add_option("-g", action="store_true", dest="globalxml", default=False, help='generates global lines.xml [action: sql]')
     parser.add_option("", '--gps', action="store_true", dest="getgps", default=False, help='retreives cities GPS coordinates')
     parser.add_option("", '--gps-cache', action="store", dest="gpscache", default=GPS_CACHE_FILE, 
         help="use gps cache file [default: %s]" % GPS_CACHE_FILE)
+    parser.add_option("", '--stations-gps-cache', action="store", dest="stgpscache", default=STATIONS_GPS_CACHE_FILE, 
+        help="stations coordinates cache file (station;city;lat;lng) [default: %s]" % STATIONS_GPS_CACHE_FILE)
     options, args = parser.parse_args()
 
     read_config()
@@ -667,181 +2965,191 @@ where action is one of:
         parser.print_usage()
         sys.exit(2)
 
+    TMP_DIR = os.path.abspath(options.workdir)
     if not os.path.exists(TMP_DIR):
-        os.mkdir(TMP_DIR)
+        os.makedirs(TMP_DIR)
 
     DEBUG = options.debug
     action, infile = args
-    action = action.lower()
-    if action not in ('sqlite', 'mysql'):
-        parser.error("Unsupported action '%s'." % action)
-
-    if options.globalxml and action == 'sqlite':
+    targets = []
+    for target in action.lower().split(','):
+        if target not in ('sqlite', 'mysql', 'psql', 'android', 'watch'):
+            parser.error("Unsupported action '%s'." % target)
+        if target == 'android':
+            options.android = True
+            target = 'sqlite'
+        if target not in targets:
+            targets.append(target)
+    if 'watch' in targets and len(targets) > 1:
+        parser.error("watch action can't be combined with other actions!")
+    action = targets[0]
+
+    if options.globalxml and 'sqlite' in targets:
         parser.error("-g and sql action are mutually exclusive!")
 
     if options.chunks and not options.android:
         parser.error("--use-chunks requires the --android option!")
 
+    if options.linechunks and not options.android:
+        parser.error("--line-chunks requires the --android option!")
+
+    if options.payload != 'sql' and not options.android:
+        parser.error("--payload requires the --android option!")
+
+    if options.chunking != 'fixed' and not options.android:
+        parser.error("--chunking requires the --android option!")
+
     if options.dbcompare and not options.android:
         parser.error("--db-compare-with requires the --android option!")
 
+    if options.columns and 'sqlite' not in targets and 'mysql' not in targets:
+        parser.error("--columns requires the sqlite or mysql action!")
+
+    if options.columns and options.timetable == 'stop':
+        parser.error("--columns requires the trip timetable (--timetable trip or both)!")
+
+    windows = []
+    for value in options.validon + options.validbetween:
+        if value in options.validon and ',' in value:
+            parser.error("--valid-on expects a single date")
+        try:
+            windows.append(parse_window(value))
+        except ValueError, e:
+            parser.error("invalid validity window '%s': %s" % (value, e))
+    if windows and action == 'watch':
+        parser.error("--valid-on, --valid-between and watch action are mutually exclusive!")
+    if len(windows) > 1 and options.dbcompare:
+        parser.error("--db-compare-with requires a single validity window!")
+
+    if options.shards and action == 'watch':
+        parser.error("--shards and watch action are mutually exclusive!")
+
+    if options.streaming and (options.shards or action == 'watch'):
+        parser.error("--streaming, --shards and watch action are mutually exclusive!")
+
+    if options.maxmemory is not None and not options.streaming:
+        parser.error("--max-memory requires the --streaming option!")
+
     g_prefilter = options.prefilter
+    if options.cachesize > 0:
+        g_cache = ContentCache(options.cachedir or os.path.join(TMP_DIR, CACHE_DIR), options.cachesize * 1024 * 1024)
+    if options.profile or options.profilestage:
+        import atexit
+        g_profiler = Profiler(options.profilestage)
+        # Also written when exiting early (i.e nothing to do)
+        atexit.register(g_profiler.write, os.path.join(TMP_DIR, PROFILE_FILE))
+    g_timetable = options.timetable
+    if options.streaming:
+        g_streaming = options.maxmemory or MAX_MEMORY
     GPS_CACHE_FILE = options.gpscache
+    STATIONS_GPS_CACHE_FILE = options.stgpscache
 
-    if action == 'sqlite':
+    if action in ('sqlite', 'watch'):
         DBSTRUCT = sqlitedb.DBSTRUCT
     elif action == 'mysql':
         DBSTRUCT = mysqldb.DBSTRUCT
-
-    if os.path.isdir(infile):
-        # Applies pre-filter before parsing any raw content
-        chksum = compute_db_checksum(infile)
+    elif action == 'psql':
+        DBSTRUCT = psqldb.DBSTRUCT
+
+    if action == 'watch':
+        if not os.path.isdir(infile):
+            parser.error("watch action requires a directory")
+        watch(infile, options.sqlitedb)
+    elif os.path.isdir(infile):
+        # GTFS feeds are imported first, the checksum covers their lines
+        begin_stage('gtfs')
+        import_gtfs(infile)
+        end_stage()
+        # Run the compiler to convert .in to .txt files (in the work directory), 
+        # the checksum covers the compiled lines
+        begin_stage('bsc')
+        networks = bsc_compile(LINES_SRC_DIR, options.shards and options.jobs or 1)
+        end_stage()
+        begin_stage('checksum')
+        chksum = compute_db_checksum(infile, options.jobs, windows)
+        end_stage()
         check_up_to_date(chksum)
-        # Run the compiler to convert .in to .txt files
-        # FIXME: replace 'src' with infile (move raw/ away)
-        networks = bsc_compile(LINES_SRC_DIR)
-
-        # sources are used to generate the database information. They can be altered with
-        # the prefilter option which acts like a preprocessing hook.
-        sources = []
-        for root, dirs, files in os.walk(infile):
-            linedefs = glob.glob(os.path.join(root, "*.txt"))
-            if len(linedefs) == 0: continue
-            sources.extend(linedefs)
-
-        if options.prefilter:
-            sources = apply_prefilter(os.path.join(LINES_SRC_DIR, g_prefilter), infile)
-
-        if action == 'sqlite':
-            # Grouping all INSERTs in a single transaction really 
-            # speeds up the whole thing
-            outname = os.path.join(TMP_DIR, RAW_DB_FILE)
-            print "[%-18s] raw SQL content (for SQLite)..." % outname,
+        state = None
+        if options.shards:
+            # Pre-filters and parses every network separately
+            begin_stage('shards')
+            shards = build_shards(networks, infile, options.jobs)
+            state, sources = merge_shards(shards)
+            end_stage()
+        else:
+            # sources are used to generate the database information. They can be altered with
+            # the prefilter option which acts like a preprocessing hook.
+            sources = find_lines(infile).values()
+
+            if options.prefilter:
+                begin_stage('prefilter')
+                sources = apply_prefilter(os.path.join(LINES_SRC_DIR, g_prefilter), infile)
+                end_stage()
+
+        if g_cache:
+            removed = g_cache.evict()
+            print "[%-18s] %d hits, %d misses, %d evicted" % ('cache', g_cache.hits, g_cache.misses, removed)
+
+        if state is None:
+            state = BuildState()
+        workdir = TMP_DIR
+        for window in windows or [None]:
+            g_valid = window
+            if len(windows) > 1:
+                # One database per season, lines are only parsed for the first one
+                TMP_DIR = os.path.join(workdir, SEASONS_DIR, season_name(window))
+                if not os.path.exists(TMP_DIR):
+                    os.makedirs(TMP_DIR)
+                print "[%-18s] building %s" % ('season', TMP_DIR)
+
+            print "[%-18s] raw SQL content (for %s)..." % ('sql', ', '.join(targets)),
             sys.stdout.flush()
-            out = open(outname, 'w')
-            out.write("BEGIN TRANSACTION;\n")
-            out.write(DBSTRUCT)
-            makeSQL(networks, sources, out)
-            out.write("END TRANSACTION;\n")
-            out.close()
+            # Android's SQLite may lack the R*Tree module
+            outnames = write_sql(networks, sources, targets, state, spatial=not options.android)
             print "done."
+            if window:
+                print "[%-18s] %d line(s) valid between %s and %s" % ('validity', db_line_count, window[0] or '-', window[1] or '-')
+            for line, count in db_stop_duplicates:
+                print "[%-18s] line %s: dropped %d duplicate stop row(s)" % ('stop rows', line, count)
+            if db_stop_duplicates:
+                print "[%-18s] dropped %d duplicate stop row(s) in %d line(s)" % ('stop rows', 
+                    sum([count for line, count in db_stop_duplicates]), len(db_stop_duplicates))
+            for target in targets:
+                print "[%-18s] wrote %s" % (target, outnames[target])
+
+            if options.columns:
+                begin_stage('columns')
+                coldir = os.path.join(TMP_DIR, COLUMNS_DIR)
+                rows = export_columns(outnames.get('sqlite', outnames.get('mysql')), coldir)
+                end_stage()
+                print "[%-18s] wrote %d stops in %s" % ('columns', rows, coldir)
+
+            if 'sqlite' in targets and options.android:
+                if len(windows) > 1:
+                    write_android(hashlib.md5(chksum + season_name(window)).hexdigest(), options)
+                else:
+                    write_android(chksum, options)
+        TMP_DIR = workdir
+        save_checksum(chksum)
+
+        if options.duplicates:
+            begin_stage('duplicates')
+            pairs = find_duplicate_stations(g_stations)
+            count = write_duplicates(pairs, options.duplicates)
+            end_stage()
+            print "[%-18s] %d near-duplicate station(s) out of %d, wrote %s" % ('duplicates', count, 
+                len(g_stations), options.duplicates)
+
+        if g_streaming:
+            import resource
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            print "[%-18s] peak %d MB, ceiling %d MB" % ('memory', peak, g_streaming)
+            if peak > g_streaming:
+                print "Warning: peak memory is over the ceiling (see --max-memory)"
 
-            if options.android:
-                rawname = os.path.join(TMP_DIR, RAW_DB_FILE)
-                print "[%-18s] XML DB resource for Android..." % 'chunks'
-                sys.stdout.flush()
-                # Only one chunk
-                num_chunks = make_chunks(rawname, options.chunksize)
-                print "[%-18s] done, wrote %d chunk(s)" % ('chunks', num_chunks)
-
-                # Writing DB stats file resource
-                statsname = os.path.join(TMP_DIR, DB_STATS_FILE)
-                print "[%-18s] making DB stats file..." % statsname,
-                sys.stdout.flush()
-                out = open(statsname, 'w')
-                out.write(XML_HEADER)
-                out.write("""
-<resources>
-  <string name="num_networks">%d</string>
-  <string name="num_lines">%d</string>
-  <string name="num_cities">%d</string>
-  <string name="num_stations">%d</string>
-</resources>
-""" % (db_network_count, db_line_count, db_city_count, db_station_count))
-                out.close()
-                print "done."
-
-                # Writing checksum and version file
-                chkname = os.path.join(TMP_DIR, CHKSUM_DB_FILE)
-                out = open(chkname, 'w')
-                out.write(XML_HEADER)
-                print "[%-18s] making checksum file..." % chkname,
-                sys.stdout.flush()
-                out.write("""
-<resources>
-  <string name="dbchecksum">%s</string>
-  <string name="numchunks">%d</string>
-</resources>
-""" % (chksum, num_chunks))
-                out.close()
-                print "done."
-
-                # Check database version against an external XML file?
-                if options.dbcompare:
-                    if not os.path.exists(options.dbcompare):
-                        print "[%-18s] external XML file not found, copying current checksum file..." % 'dbcompare',
-                        sys.stdout.flush()
-                        out = open(options.dbcompare, 'w')
-                        out.write(XML_HEADER)
-                        out.write("""
-<resources>
-  <string name="numchunks">%d</string>
-  <string name="dbchecksum">%s</string>
-  <string name="dbversion">1</string>
-</resources>
-""" % (num_chunks, chksum))
-                        out.close()
-                        print "done."
-                    else:
-                        print "[%-18s] found external XML file, checking DB version..." % 'dbcompare'
-                        old_chksum = old_version = None
-                        for line in open(options.dbcompare):
-                            m = re.search(r'"dbchecksum">(.*?)</string>', line)
-                            if m:
-                                old_chksum = m.group(1)
-                            m = re.search(r'"dbversion">(.*?)</string>', line)
-                            if m:
-                                old_version = m.group(1)
-                        if old_version == None:
-                            print "Error: dbversion is None"
-                            sys.exit(1)
-                        if old_chksum == None:
-                            print "Error: dbchecksum is None"
-                            sys.exit(1)
-
-                        if chksum != old_chksum:
-                            print "[%-18s] database changed, incrementing version..." % 'UPGRADE',
-                            new_version = int(old_version) + 1
-                            sys.stdout.flush()
-                            out = open(options.dbcompare, 'w')
-                            out.write(XML_HEADER)
-                            out.write("""
-<resources>
-  <string name="numchunks">%d</string>
-  <string name="dbchecksum">%s</string>
-  <string name="dbversion">%d</string>
-</resources>
-""" % (num_chunks, chksum, new_version))
-                            out.close()
-                            print "to v%d. Done." % new_version
-                        else:
-                            print "[%-18s] database NOT updated" % 'IDEM'
-                        print "[%-18s] done." % 'dbcompare'
-
-                # Make a tarball of schedules that can be served over HTTP to upgrade the Android client
-                import tarfile
-                with tarfile.open(os.path.join(TMP_DIR, UPDATE_TARBALL), 'w:bz2') as tar:
-                    chunkfiles = glob.glob(os.path.join(TMP_DIR, "%s_*.xml" % CHUNK_PREFIX))
-                    for name in chunkfiles:
-                        tar.add(name, os.path.basename(name))
-                    tar.add(chkname, os.path.basename(chkname))
-                print "[%-18s] wrote bzip2 tarball" % 'network update'
-
-        elif action == 'mysql':
-            outname = os.path.join(TMP_DIR, RAW_DB_FILE)
-            print "[%-18s] raw SQL content (for MySQL)..." % outname,
-            sys.stdout.flush()
-            out = open(outname, 'w')
-            out.write("SET autocommit=0;\nBEGIN;\n")
-            out.write(DBSTRUCT)
-            makeSQL(networks, sources, out)
-            out.write("COMMIT;\n")
-            out.write("SET autocommit=1;\n")
-            out.close()
-            print "done."
     else:
         # File target
-        if action == 'sqlite':
+        if 'sqlite' in targets:
             print "Error: does not support one file, only full parent directory"
             sys.exit(2)
         else:
@@ -35,7 +35,7 @@ log "Deleting old tables and pushing new content"
 
 if [ $TARGET = "local" ]; then
     test -r "$2" || error "can't access $2 for reading"
-    for TABLE in stop line_station station line city network; do
+    for TABLE in counts line_service station_line frequency stop_time trip stop line_station station line city network; do
         ${MYSQL} ${MYSQLOPTS} ${MYSQLDB} -e "DROP TABLE IF EXISTS $TABLE"
     done
     ${MYSQL} ${MYSQLOPTS} ${MYSQLDB} < ${SQLDB}
@@ -51,7 +51,7 @@ if [ ! -r \$PFILE ]; then
 fi
 PWD=\$(cat \$PFILE)
 EOF
-    for TABLE in stop line_station station line city network; do
+    for TABLE in counts line_service station_line frequency stop_time trip stop line_station station line city network; do
         echo "${MYSQL} -u businfo --password=\$PWD ${MYSQLDB} -e \"DROP TABLE IF EXISTS $TABLE\"" >> $CMD
     done
     echo "${MYSQL} -u businfo --password=\$PWD ${MYSQLDB} < ${SQLDB}" >> $CMD
@@ -66,8 +66,38 @@ CREATE TABLE stop (
     FOREIGN KEY (station_id) REFERENCES station(id), 
     FOREIGN KEY (line_id) REFERENCES line(id), 
     FOREIGN KEY (direction_id) REFERENCES city(id),
-    FOREIGN KEY (city_id) REFERENCES city(id)
--- TODO: UNIQUE (time, circpat, station_id, line_id, direction_id, city_id)
+    FOREIGN KEY (city_id) REFERENCES city(id),
+    UNIQUE (station_id, line_id, direction_id, time, circpat, city_id)
+) ENGINE=INNODB DEFAULT CHARSET=latin1;
+
+DROP TABLE IF EXISTS frequency;
+DROP TABLE IF EXISTS stop_time;
+DROP TABLE IF EXISTS trip;
+CREATE TABLE trip (
+    id INTEGER PRIMARY KEY AUTO_INCREMENT,
+    line_id INTEGER NOT NULL,
+    direction_id INTEGER NOT NULL,  -- city
+    circpat VARCHAR(255),           -- circulation pattern
+    INDEX trip_line (line_id, direction_id),
+    FOREIGN KEY (line_id) REFERENCES line(id), 
+    FOREIGN KEY (direction_id) REFERENCES city(id)
+) ENGINE=INNODB DEFAULT CHARSET=latin1;
+
+CREATE TABLE stop_time (
+    trip_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,           -- station's rank on line (see line_station)
+    minutes SMALLINT NOT NULL,      -- minutes past midnight
+    PRIMARY KEY (trip_id, seq),
+    FOREIGN KEY (trip_id) REFERENCES trip(id)
+) ENGINE=INNODB DEFAULT CHARSET=latin1;
+
+CREATE TABLE frequency (
+    trip_id INTEGER NOT NULL,       -- template trip, departing at start_time
+    start_time SMALLINT NOT NULL,   -- minutes past midnight
+    end_time SMALLINT NOT NULL,     -- last departure, minutes past midnight
+    headway SMALLINT NOT NULL,      -- minutes between two departures
+    INDEX frequency_trip_id (trip_id),
+    FOREIGN KEY (trip_id) REFERENCES trip(id)
 ) ENGINE=INNODB DEFAULT CHARSET=latin1;
 
 DROP TABLE IF EXISTS line_station;
@@ -78,8 +108,40 @@ CREATE TABLE line_station (
     rank INTEGER,			                -- station's rank order on line
     direction_id INTEGER NOT NULL,			        -- city id for direction
     UNIQUE(line_id, station_id, rank, direction_id),
+    INDEX line_station_station_id (station_id),
     FOREIGN KEY (line_id) REFERENCES line(id), 
     FOREIGN KEY (station_id) REFERENCES station(id), 
     FOREIGN KEY (direction_id) REFERENCES city(id)
 ) ENGINE=INNODB DEFAULT CHARSET=latin1;
+
+--
+-- Aggregate tables, computed at build time
+--
+DROP TABLE IF EXISTS station_line;
+CREATE TABLE station_line (
+    station_id INTEGER NOT NULL,
+    line_id INTEGER NOT NULL,
+    rank INTEGER NOT NULL,          -- station's rank order on line
+    direction_id INTEGER NOT NULL,  -- city id for direction
+    PRIMARY KEY (station_id, line_id, direction_id, rank),
+    FOREIGN KEY (station_id) REFERENCES station(id), 
+    FOREIGN KEY (line_id) REFERENCES line(id)
+) ENGINE=INNODB DEFAULT CHARSET=latin1;
+
+DROP TABLE IF EXISTS line_service;
+CREATE TABLE line_service (
+    line_id INTEGER NOT NULL,
+    direction_id INTEGER NOT NULL,  -- city
+    first_departure SMALLINT,       -- minutes past midnight
+    last_departure SMALLINT,        -- minutes past midnight
+    runs INTEGER,                   -- number of runs (all patterns)
+    PRIMARY KEY (line_id, direction_id),
+    FOREIGN KEY (line_id) REFERENCES line(id)
+) ENGINE=INNODB DEFAULT CHARSET=latin1;
+
+DROP TABLE IF EXISTS counts;
+CREATE TABLE counts (
+    name VARCHAR(32) PRIMARY KEY,   -- networks, cities, stations, lines, trips
+    value INTEGER
+) ENGINE=INNODB DEFAULT CHARSET=latin1;
 """
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+
+"""
+Database structure for PostgreSQL engine
+
+Data is loaded with COPY ... FROM STDIN blocks (see makeres.CopyWriter),
+tables are created without any constraint. Primary keys, unique and
+foreign key constraints and indexes (DBINDEXES) are created once all
+rows are loaded, which is much faster.
+
+Running this module checks a COPY dump offline:
+
+    python psqldb.py /tmp/businfo/htdb-psql.sql
+"""
+
+import sys, re
+
+DBSTRUCT = """
+DROP TABLE IF EXISTS counts, line_service, station_line, frequency, stop_time, trip, stop, line_station, station, line, city, network CASCADE;
+
+CREATE TABLE network (
+    id INTEGER NOT NULL,
+    name VARCHAR(255),
+    color VARCHAR(255)
+);
+
+CREATE TABLE city (
+    id INTEGER NOT NULL,
+    name VARCHAR(255),
+    latitude INTEGER,
+    longitude INTEGER
+);
+
+CREATE TABLE station (
+    id INTEGER NOT NULL,
+    name VARCHAR(255),
+    latitude REAL,
+    longitude REAL,
+    city_id INTEGER NOT NULL
+);
+
+CREATE TABLE line (
+    id INTEGER NOT NULL,
+    network_id INTEGER NOT NULL,
+    name VARCHAR(255),
+    color VARCHAR(255),
+    dflt_circpat VARCHAR(255),
+    from_city_id INTEGER NOT NULL,
+    to_city_id INTEGER NOT NULL,
+    from_date DATE,
+    to_date DATE
+);
+
+CREATE TABLE line_station (
+    id SERIAL,
+    line_id INTEGER NOT NULL,
+    station_id INTEGER NOT NULL,
+    rank INTEGER,                   -- station's rank order on line
+    direction_id INTEGER NOT NULL   -- city id for direction
+);
+
+CREATE TABLE trip (
+    id INTEGER NOT NULL,
+    line_id INTEGER NOT NULL,
+    direction_id INTEGER NOT NULL,  -- city
+    circpat VARCHAR(255)            -- circulation pattern
+);
+
+CREATE TABLE stop_time (
+    trip_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,           -- station's rank on line (see line_station)
+    minutes SMALLINT NOT NULL       -- minutes past midnight
+);
+
+CREATE TABLE frequency (
+    trip_id INTEGER NOT NULL,       -- template trip, departing at start_time
+    start_time SMALLINT NOT NULL,   -- minutes past midnight
+    end_time SMALLINT NOT NULL,     -- last departure, minutes past midnight
+    headway SMALLINT NOT NULL       -- minutes between two departures
+);
+
+CREATE TABLE stop (
+    id SERIAL,
+    time TIME,
+    circpat VARCHAR(255),           -- circulation pattern
+    station_id INTEGER NOT NULL,
+    line_id INTEGER NOT NULL,
+    direction_id INTEGER NOT NULL,  -- city
+    city_id INTEGER NOT NULL        -- location of station
+);
+
+CREATE TABLE station_line (
+    station_id INTEGER NOT NULL,
+    line_id INTEGER NOT NULL,
+    rank INTEGER NOT NULL,          -- station's rank order on line
+    direction_id INTEGER NOT NULL   -- city id for direction
+);
+
+CREATE TABLE line_service (
+    line_id INTEGER NOT NULL,
+    direction_id INTEGER NOT NULL,  -- city
+    first_departure SMALLINT,       -- minutes past midnight
+    last_departure SMALLINT,        -- minutes past midnight
+    runs INTEGER                    -- number of runs (all patterns)
+);
+
+CREATE TABLE counts (
+    name VARCHAR(32) NOT NULL,      -- networks, cities, stations, lines, trips
+    value INTEGER
+);
+"""
+
+# Created after load
+DBINDEXES = """
+ALTER TABLE network ADD PRIMARY KEY (id), ADD UNIQUE (name);
+ALTER TABLE city ADD PRIMARY KEY (id), ADD UNIQUE (name);
+ALTER TABLE station ADD PRIMARY KEY (id), ADD UNIQUE (name, city_id),
+    ADD FOREIGN KEY (city_id) REFERENCES city(id);
+ALTER TABLE line ADD PRIMARY KEY (id), ADD UNIQUE (name, network_id),
+    ADD FOREIGN KEY (network_id) REFERENCES network(id),
+    ADD FOREIGN KEY (from_city_id) REFERENCES city(id),
+    ADD FOREIGN KEY (to_city_id) REFERENCES city(id);
+ALTER TABLE line_station ADD PRIMARY KEY (id), ADD UNIQUE (line_id, station_id, rank, direction_id),
+    ADD FOREIGN KEY (line_id) REFERENCES line(id),
+    ADD FOREIGN KEY (station_id) REFERENCES station(id),
+    ADD FOREIGN KEY (direction_id) REFERENCES city(id);
+ALTER TABLE trip ADD PRIMARY KEY (id),
+    ADD FOREIGN KEY (line_id) REFERENCES line(id),
+    ADD FOREIGN KEY (direction_id) REFERENCES city(id);
+ALTER TABLE stop_time ADD PRIMARY KEY (trip_id, seq),
+    ADD FOREIGN KEY (trip_id) REFERENCES trip(id);
+ALTER TABLE frequency ADD FOREIGN KEY (trip_id) REFERENCES trip(id);
+ALTER TABLE stop ADD PRIMARY KEY (id), ADD UNIQUE (station_id, line_id, direction_id, time, circpat, city_id),
+    ADD FOREIGN KEY (station_id) REFERENCES station(id),
+    ADD FOREIGN KEY (line_id) REFERENCES line(id),
+    ADD FOREIGN KEY (direction_id) REFERENCES city(id),
+    ADD FOREIGN KEY (city_id) REFERENCES city(id);
+ALTER TABLE station_line ADD PRIMARY KEY (station_id, line_id, direction_id, rank),
+    ADD FOREIGN KEY (station_id) REFERENCES station(id),
+    ADD FOREIGN KEY (line_id) REFERENCES line(id);
+ALTER TABLE line_service ADD PRIMARY KEY (line_id, direction_id),
+    ADD FOREIGN KEY (line_id) REFERENCES line(id);
+ALTER TABLE counts ADD PRIMARY KEY (name);
+
+CREATE INDEX line_station_station_id ON line_station (station_id);
+CREATE INDEX trip_line ON trip (line_id, direction_id);
+CREATE INDEX frequency_trip_id ON frequency (trip_id);
+"""
+
+# Columns of every table, in load order. Rows whose id is NULL get it
+# from their SERIAL column.
+COLUMNS = (
+    ('network', ('id', 'name', 'color')),
+    ('city', ('id', 'name', 'latitude', 'longitude')),
+    ('station', ('id', 'name', 'latitude', 'longitude', 'city_id')),
+    ('line', ('id', 'network_id', 'name', 'color', 'dflt_circpat', 'from_city_id', 'to_city_id', 'from_date', 'to_date')),
+    ('line_station', ('id', 'line_id', 'station_id', 'rank', 'direction_id')),
+    ('trip', ('id', 'line_id', 'direction_id', 'circpat')),
+    ('stop_time', ('trip_id', 'seq', 'minutes')),
+    ('frequency', ('trip_id', 'start_time', 'end_time', 'headway')),
+    ('stop', ('id', 'time', 'circpat', 'station_id', 'line_id', 'direction_id', 'city_id')),
+    ('station_line', ('station_id', 'line_id', 'rank', 'direction_id')),
+    ('line_service', ('line_id', 'direction_id', 'first_departure', 'last_departure', 'runs')),
+    ('counts', ('name', 'value')),
+)
+SERIAL_TABLES = ('line_station', 'stop')
+# Empty dates (open validity periods) are loaded as NULL
+DATE_COLUMNS = {'line': ('from_date', 'to_date')}
+
+COPY_ESCAPES = (('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r'))
+COPY_UNESCAPE_PAT = re.compile(r'\\(.)')
+COPY_UNESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', '\\': '\\'}
+
+def copy_header(table):
+    """
+    Returns the COPY statement of table.
+    """
+    cols = dict(COLUMNS)[table]
+    if table in SERIAL_TABLES:
+        cols = cols[1:]
+    return "COPY %s (%s) FROM STDIN;\n" % (table, ', '.join(cols))
+
+def copy_row(values):
+    """
+    Returns values (strings or None for NULL) as a line of COPY text.
+    """
+    out = []
+    for v in values:
+        if v is None:
+            out.append('\\N')
+        else:
+            for old, new in COPY_ESCAPES:
+                v = v.replace(old, new)
+            out.append(v)
+    return '\t'.join(out) + '\n'
+
+def null_dates(table, values):
+    """
+    Returns values (of all the columns of table, in COLUMNS order) with
+    empty dates as None: PostgreSQL rejects '' for a DATE column.
+    """
+    if not DATE_COLUMNS.has_key(table):
+        return values
+    cols = dict(COLUMNS)[table]
+    values = list(values)
+    for col in DATE_COLUMNS[table]:
+        k = cols.index(col)
+        if k < len(values) and values[k] == '':
+            values[k] = None
+    return values
+
+def copy_values(line):
+    """
+    Returns the values (strings or None for NULL) of a line of COPY text.
+    """
+    values = []
+    for v in line.rstrip('\n').split('\t'):
+        if v == '\\N':
+            values.append(None)
+        else:
+            values.append(COPY_UNESCAPE_PAT.sub(lambda m: COPY_UNESCAPES.get(m.group(1), m.group(1)), v))
+    return values
+
+def parse_copy(f):
+    """
+    Parses COPY ... FROM STDIN blocks of the f file object. Returns a
+    list of (table, columns, rows) with rows as lists of strings (None
+    for NULL). Other statements are ignored.
+    """
+    blocks = []
+    rows = None
+    for line in f:
+        if rows is None:
+            m = re.match(r'^COPY (\w+) \(([^)]*)\) FROM STDIN;$', line.strip())
+            if m:
+                rows = []
+                blocks.append((m.group(1), [c.strip() for c in m.group(2).split(',')], rows))
+            continue
+        line = line.rstrip('\n')
+        if line == '\\.':
+            rows = None
+            continue
+        row = copy_values(line)
+        if len(row) != len(blocks[-1][1]):
+            raise ValueError, "%s: %d values for %d columns" % (blocks[-1][0], len(row), len(blocks[-1][1]))
+        rows.append(row)
+    if rows is not None:
+        raise ValueError, "unterminated COPY block for table %s" % blocks[-1][0]
+    return blocks
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print "Usage: %s htdb-psql.sql" % sys.argv[0]
+        sys.exit(2)
+    f = open(sys.argv[1])
+    for table, cols, rows in parse_copy(f):
+        print "%-14s %8d rows" % (table, len(rows))
+    f.close()
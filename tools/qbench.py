@@ -0,0 +1,265 @@
+#!/usr/bin/env python2
+# -*- coding: latin-1 -*-
+
+"""
+Query workload benchmark.
+
+Replays the queries issued by dbcalc.py and the Android application
+against a built SQLite database (i.e ht.sqlite): every query shape is
+run with a set of parameters, reporting p50/p95/p99 latencies, rows
+returned, virtual machine steps (a measure of rows scanned) and its
+EXPLAIN QUERY PLAN output.
+
+Workloads are generated from the database (same seed, same workload)
+or replayed from a recorded JSON lines file of {"shape": ..., "params":
+[...]} entries (see --record). A second database can be given to
+compare both side by side, on the same workload.
+"""
+
+import sys, os, os.path, json, time, random, math, sqlite3
+from optparse import OptionParser
+
+# Query shapes: name -> SQL. Parameters are generated by make_workload()
+SHAPES = (
+    ('stations', """
+SELECT s.name, c.name FROM station AS s, city AS c WHERE s.city_id=c.id ORDER BY c.name"""),
+    ('station', """
+SELECT s.name, c.name FROM station AS s, city AS c WHERE s.id=? AND s.city_id=c.id"""),
+    ('station lines', """
+SELECT line_id, direction_id FROM station_line WHERE station_id=?"""),
+    ('line stations', """
+SELECT station_id, direction_id FROM line_station WHERE line_id=? ORDER BY rank"""),
+    ('line service', """
+SELECT direction_id, first_departure, last_departure, runs FROM line_service WHERE line_id=?"""),
+    ('station stops', """
+SELECT time, circpat FROM stop WHERE station_id=? AND line_id=? AND direction_id=? ORDER BY time"""),
+    ('line stops', """
+SELECT time, circpat, station_id FROM stop WHERE line_id=? AND direction_id=? ORDER BY station_id, time"""),
+    ('departures', """
+SELECT t.id, st.minutes FROM line_station AS ls, trip AS t, stop_time AS st
+WHERE ls.station_id=? AND t.line_id=ls.line_id AND t.direction_id=ls.direction_id
+AND st.trip_id=t.id AND st.seq=ls.rank"""),
+    ('find', """
+SELECT s.name, c.name FROM station AS s, city AS c WHERE s.city_id=c.id AND s.name LIKE ?"""),
+    ('near', """
+SELECT id FROM station_rtree WHERE min_lat >= ? AND max_lat <= ? AND min_lng >= ? AND max_lng <= ?"""),
+)
+# Tables of the shapes which may be missing or empty (i.e. stop table of 
+# databases built with the trip timetable)
+SHAPE_TABLES = (
+    ('near', ('station_rtree',)),
+    ('station lines', ('station_line',)),
+    ('line service', ('line_service',)),
+    ('station stops', ('stop',)),
+    ('line stops', ('stop',)),
+    ('departures', ('trip', 'stop_time')),
+)
+# Counting VM steps every STEP_GRANULARITY instructions
+STEP_GRANULARITY = 100
+
+def has_table(c, name):
+    c.execute("SELECT name FROM sqlite_master WHERE name=?", (name,))
+    return c.fetchone() is not None
+
+def has_rows(c, name):
+    if not has_table(c, name):
+        return False
+    c.execute("SELECT 1 FROM %s LIMIT 1" % name)
+    return c.fetchone() is not None
+
+def make_workload(c, count, seed=0):
+    """
+    Returns a list of (shape, params) with count queries per shape,
+    parameters being picked from the database.
+    """
+    rnd = random.Random(seed)
+    stations = [r[0] for r in c.execute("SELECT id FROM station ORDER BY id")]
+    lines = [r[0] for r in c.execute("SELECT id FROM line ORDER BY id")]
+    served = c.execute("SELECT DISTINCT station_id, line_id, direction_id FROM line_station ORDER BY 1, 2, 3").fetchall()
+    directions = sorted(set([(r[1], r[2]) for r in served]))
+    names = [unicode(r[0], 'utf-8') for r in c.execute("SELECT name FROM station ORDER BY id")]
+    coords = c.execute("SELECT latitude, longitude FROM station WHERE latitude != 0 ORDER BY id").fetchall()
+    if not stations or not lines:
+        return []
+
+    workload = []
+    for k in range(count):
+        workload.append(('stations', []))
+        workload.append(('station', [rnd.choice(stations)]))
+        workload.append(('station lines', [rnd.choice(stations)]))
+        workload.append(('line stations', [rnd.choice(lines)]))
+        workload.append(('line service', [rnd.choice(lines)]))
+        workload.append(('station stops', list(rnd.choice(served))))
+        workload.append(('line stops', list(rnd.choice(directions))))
+        workload.append(('departures', [rnd.choice(stations)]))
+        name = rnd.choice(names)
+        start = rnd.randint(0, max(0, len(name) - 4))
+        workload.append(('find', ['%' + name[start:start + 4] + '%']))
+        if coords:
+            lat, lng = rnd.choice(coords)
+            delta = 5000
+            workload.append(('near', [lat - delta, lat + delta, lng - delta, lng + delta]))
+    return workload
+
+def read_workload(filename):
+    workload = []
+    f = open(filename)
+    for line in f:
+        if line.strip():
+            q = json.loads(line)
+            workload.append((q['shape'], q['params']))
+    f.close()
+    return workload
+
+def write_workload(workload, filename):
+    f = open(filename, 'w')
+    for shape, params in workload:
+        f.write(json.dumps({'shape': shape, 'params': params}) + '\n')
+    f.close()
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of sorted values.
+    """
+    if not values:
+        return 0
+    k = max(0, min(len(values) - 1, int(math.ceil(p / 100.0 * len(values))) - 1))
+    return values[k]
+
+def replay(dbname, workload, repeat=1):
+    """
+    Runs the workload against dbname. Returns a dictionary of shape ->
+    results (latencies in ms, rows, VM steps and query plan). Shapes
+    whose tables are missing or empty are skipped.
+    """
+    conn = sqlite3.connect(dbname)
+    conn.text_factory = str
+    c = conn.cursor()
+    sql = dict(SHAPES)
+    missing = set()
+    for shape, tables in SHAPE_TABLES:
+        for table in tables:
+            if not has_rows(c, table):
+                missing.add(shape)
+
+    results = {}
+    for shape, params in workload:
+        if shape in missing:
+            continue
+        res = results.setdefault(shape, {'latencies': [], 'rows': 0, 'steps': 0, 'count': 0})
+        if not res.has_key('plan'):
+            c.execute("EXPLAIN QUERY PLAN " + sql[shape], params)
+            res['plan'] = [r[-1] for r in c.fetchall()]
+        for k in range(repeat):
+            t0 = time.time()
+            rows = c.execute(sql[shape], params).fetchall()
+            res['latencies'].append((time.time() - t0) * 1000)
+        # Steps are counted apart, the progress handler slows queries down
+        steps = [0]
+        def progress():
+            steps[0] += 1
+        conn.set_progress_handler(progress, STEP_GRANULARITY)
+        c.execute(sql[shape], params).fetchall()
+        conn.set_progress_handler(None, STEP_GRANULARITY)
+        res['rows'] += len(rows)
+        res['steps'] += steps[0] * STEP_GRANULARITY
+        res['count'] += 1
+    c.close()
+    conn.close()
+
+    for shape, res in results.iteritems():
+        lat = sorted(res.pop('latencies'))
+        res['p50'] = percentile(lat, 50)
+        res['p95'] = percentile(lat, 95)
+        res['p99'] = percentile(lat, 99)
+        res['rows'] = float(res['rows']) / res['count']
+        res['steps'] = float(res['steps']) / res['count']
+    return results
+
+def report(results, plans=True):
+    print "%-14s %6s %9s %9s %9s %9s %10s" % ('shape (ms)', 'count', 'p50', 'p95', 'p99', 'rows', 'steps')
+    for shape, sql in SHAPES:
+        if not results.has_key(shape):
+            continue
+        res = results[shape]
+        print "%-14s %6d %9.3f %9.3f %9.3f %9.1f %10.0f" % (shape, res['count'], res['p50'], res['p95'],
+            res['p99'], res['rows'], res['steps'])
+    if plans:
+        print
+        for shape, sql in SHAPES:
+            if results.has_key(shape):
+                print "%-14s %s" % (shape, '\n               '.join(results[shape]['plan']))
+
+def compare(old, new):
+    """
+    Prints results of two databases side by side.
+    """
+    print "%-14s %9s %9s %7s %9s %9s %7s %10s %10s" % ('shape (ms)', 'p50 A', 'p50 B', 'ratio', 'p95 A', 'p95 B', 'ratio',
+        'steps A', 'steps B')
+    ratio = lambda a, b: b / a if a > 0 else 1
+    for shape, sql in SHAPES:
+        if old.has_key(shape) != new.has_key(shape):
+            print "%-14s skipped on %s (missing or empty tables)" % (shape, 'B' if old.has_key(shape) else 'A')
+            continue
+        if not old.has_key(shape):
+            continue
+        a, b = old[shape], new[shape]
+        print "%-14s %9.3f %9.3f %6.2fx %9.3f %9.3f %6.2fx %10.0f %10.0f" % (shape, a['p50'], b['p50'], ratio(a['p50'], b['p50']),
+            a['p95'], b['p95'], ratio(a['p95'], b['p95']), a['steps'], b['steps'])
+    print
+    for shape, sql in SHAPES:
+        if not old.has_key(shape) or not new.has_key(shape):
+            continue
+        if old[shape]['plan'] != new[shape]['plan']:
+            print "%-14s A: %s" % (shape, '; '.join(old[shape]['plan']))
+            print "%-14s B: %s" % ('', '; '.join(new[shape]['plan']))
+
+def main():
+    parser = OptionParser(usage="""%prog [options] dbfile [other_dbfile]
+
+Replays a query workload against dbfile, or against both databases to
+compare them.""")
+    parser.add_option("-w", '--workload', action="store", dest="workload", default=None, help="replays a recorded workload (JSON lines) instead of generating one")
+    parser.add_option("", '--record', action="store", dest="record", default=None, help="saves the workload (JSON lines)")
+    parser.add_option("-n", '--queries', type="int", dest="queries", default=200, help="queries per shape of generated workloads [default: %default]")
+    parser.add_option("-r", '--repeat', type="int", dest="repeat", default=1, help="runs every query N times [default: %default]")
+    parser.add_option("", '--seed', type="int", dest="seed", default=0, help="random seed of generated workloads [default: %default]")
+    parser.add_option("-o", '--output', action="store", dest="output", default=None, help="writes results as JSON")
+    parser.add_option("", '--no-plans', action="store_false", dest="plans", default=True, help="does not show query plans")
+    options, args = parser.parse_args()
+
+    if len(args) not in (1, 2):
+        parser.print_usage()
+        sys.exit(2)
+    for dbname in args:
+        if not os.path.exists(dbname):
+            parser.error("DB '%s' not found" % dbname)
+
+    if options.workload:
+        workload = read_workload(options.workload)
+    else:
+        conn = sqlite3.connect(args[0])
+        conn.text_factory = str
+        workload = make_workload(conn.cursor(), options.queries, options.seed)
+        conn.close()
+    if options.record:
+        write_workload(workload, options.record)
+        print "Wrote %d queries in %s" % (len(workload), options.record)
+
+    results = [replay(dbname, workload, options.repeat) for dbname in args]
+    if len(results) == 1:
+        print "Database: %s" % args[0]
+        report(results[0], options.plans)
+    else:
+        print "A: %s" % args[0]
+        print "B: %s" % args[1]
+        compare(results[0], results[1])
+
+    if options.output:
+        f = open(options.output, 'w')
+        f.write(json.dumps(dict(zip(args, results)), indent=2))
+        f.close()
+        print "Wrote %s" % options.output
+
+if __name__ == '__main__':
+    main()
@@ -57,10 +57,36 @@ CREATE TABLE stop (
     station_id INTEGER,
     line_id INTEGER,
     direction_id INTEGER,    -- city
-    city_id INTEGER          -- location of station
--- TODO: UNIQUE (time, circpat, station_id, line_id, direction_id, city_id)
+    city_id INTEGER,         -- location of station
+    UNIQUE (station_id, line_id, direction_id, time, circpat, city_id)
 );
 
+DROP TABLE IF EXISTS trip;
+CREATE TABLE trip (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    line_id INTEGER,
+    direction_id INTEGER,   -- city
+    circpat TEXT            -- circulation pattern
+);
+CREATE INDEX trip_line ON trip (line_id, direction_id);
+
+DROP TABLE IF EXISTS stop_time;
+CREATE TABLE stop_time (
+    trip_id INTEGER,
+    seq INTEGER,            -- station's rank on line (see line_station)
+    minutes INTEGER,        -- minutes past midnight
+    PRIMARY KEY (trip_id, seq)
+);
+
+DROP TABLE IF EXISTS frequency;
+CREATE TABLE frequency (
+    trip_id INTEGER,        -- template trip, departing at start_time
+    start_time INTEGER,     -- minutes past midnight
+    end_time INTEGER,       -- last departure, minutes past midnight
+    headway INTEGER         -- minutes between two departures
+);
+CREATE INDEX frequency_trip_id ON frequency (trip_id);
+
 DROP TABLE IF EXISTS line_station;
 CREATE TABLE line_station (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -70,6 +96,35 @@ CREATE TABLE line_station (
     direction_id INTEGER,			        -- city id for direction
     UNIQUE(line_id, station_id, rank, direction_id)
 );
+CREATE INDEX line_station_station_id ON line_station (station_id);
+
+--
+-- Aggregate tables, computed at build time
+--
+DROP TABLE IF EXISTS station_line;
+CREATE TABLE station_line (
+    station_id INTEGER,
+    line_id INTEGER,
+    rank INTEGER,                   -- station's rank order on line
+    direction_id INTEGER,           -- city id for direction
+    PRIMARY KEY (station_id, line_id, direction_id, rank)
+);
+
+DROP TABLE IF EXISTS line_service;
+CREATE TABLE line_service (
+    line_id INTEGER,
+    direction_id INTEGER,           -- city
+    first_departure INTEGER,        -- minutes past midnight
+    last_departure INTEGER,         -- minutes past midnight
+    runs INTEGER,                   -- number of runs (all patterns)
+    PRIMARY KEY (line_id, direction_id)
+);
+
+DROP TABLE IF EXISTS counts;
+CREATE TABLE counts (
+    name TEXT PRIMARY KEY,          -- networks, cities, stations, lines, trips
+    value INTEGER
+);
 
 CREATE TRIGGER fki_line_network_id
 BEFORE INSERT ON line
@@ -121,6 +176,37 @@ BEGIN
     WHERE (SELECT id FROM city WHERE id = NEW.direction_id) IS NULL;
 END;
 
+--
+-- Constraints on trip and stop_time tables
+--
+CREATE TRIGGER fki_trip_line_id
+BEFORE INSERT ON trip
+BEGIN
+    SELECT RAISE(ROLLBACK, "insert on table 'trip' violates foreign key constraint 'fk_line_id'")
+    WHERE (SELECT id FROM line WHERE id = NEW.line_id) IS NULL;
+END;
+
+CREATE TRIGGER fki_trip_direction_id
+BEFORE INSERT ON trip
+BEGIN
+    SELECT RAISE(ROLLBACK, "insert on table 'trip' violates foreign key constraint 'fk_direction_id'")
+    WHERE (SELECT id FROM city WHERE id = NEW.direction_id) IS NULL;
+END;
+
+CREATE TRIGGER fki_stop_time_trip_id
+BEFORE INSERT ON stop_time
+BEGIN
+    SELECT RAISE(ROLLBACK, "insert on table 'stop_time' violates foreign key constraint 'fk_trip_id'")
+    WHERE (SELECT id FROM trip WHERE id = NEW.trip_id) IS NULL;
+END;
+
+CREATE TRIGGER fki_frequency_trip_id
+BEFORE INSERT ON frequency
+BEGIN
+    SELECT RAISE(ROLLBACK, "insert on table 'frequency' violates foreign key constraint 'fk_trip_id'")
+    WHERE (SELECT id FROM trip WHERE id = NEW.trip_id) IS NULL;
+END;
+
 --
 -- Constraints on stop table
 --
@@ -152,3 +238,12 @@ BEGIN
     WHERE (SELECT id FROM city WHERE id = NEW.city_id) IS NULL;
 END;
 """
+
+# Stations spatial index, filled once stations are loaded. Coordinates 
+# are scaled by 10^6 (as in the station table), unknown ones are left out
+SPATIAL_INDEX_ROWS = """INSERT INTO station_rtree SELECT id, latitude, latitude, longitude, longitude FROM station WHERE latitude != 0 OR longitude != 0;"""
+SPATIAL_INDEX = """
+DROP TABLE IF EXISTS station_rtree;
+CREATE VIRTUAL TABLE station_rtree USING rtree(id, min_lat, max_lat, min_lng, max_lng);
+%s
+""" % SPATIAL_INDEX_ROWS
@@ -0,0 +1,64 @@
+#!/usr/bin/env python2
+# -*- coding: latin-1 -*-
+
+"""
+Tests of dbcalc helpers.
+
+    python -m unittest discover -s tools
+"""
+
+import unittest
+import dbcalc
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+@unittest.skipIf(numpy is None, "needs NumPy")
+class StopStatsTest(unittest.TestCase):
+    def columns(self, runs):
+        """
+        Stop columns of runs, a list of (line, direction, pattern, times).
+        """
+        cols = dict([(name, []) for name in ('station', 'line', 'direction', 'run', 'minutes', 'pattern')])
+        for run, (line, direction, pattern, times) in enumerate(runs):
+            for seq, minutes in enumerate(times):
+                cols['station'].append(seq + 1)
+                cols['line'].append(line)
+                cols['direction'].append(direction)
+                cols['run'].append(run)
+                cols['minutes'].append(minutes)
+                cols['pattern'].append(pattern)
+        return dict([(name, numpy.array(v, dtype=numpy.int32)) for name, v in cols.iteritems()])
+
+    def test_departures(self):
+        # Arrivals at the next stations and times past midnight are not departures
+        stats = dbcalc.stop_stats(self.columns([
+            (1, 2, 0, [23 * 60 + 30, 23 * 60 + 50, 24 * 60 + 10]),
+            (1, 2, 0, [6 * 60, 6 * 60 + 20]),
+            (1, 2, 0, [6 * 60 + 30, 6 * 60 + 50]),
+        ]))
+        self.assertEqual(len(stats), 1)
+        st = stats[0]
+        self.assertEqual((st['first'], st['last'], st['trips']), (360, 1410, 3))
+        self.assertEqual(st['headway'], (30 + 1020) / 2.0)
+        self.assertEqual(st['hourly'], {6: 525.0})
+
+    def test_single_run(self):
+        stats = dbcalc.stop_stats(self.columns([(1, 2, 0, [600, 640, 700])]))
+        self.assertEqual((stats[0]['first'], stats[0]['last'], stats[0]['headway']), (600, 600, None))
+
+    def test_groups(self):
+        stats = dbcalc.stop_stats(self.columns([
+            (1, 2, 1, [600, 610]),
+            (1, 2, 0, [620, 630]),
+            (1, 3, 0, [640, 650]),
+        ]))
+        self.assertEqual([(st['direction'], st['pattern'], st['trips']) for st in stats], [(2, 0, 1), (2, 1, 1), (3, 0, 1)])
+
+    def test_empty(self):
+        self.assertEqual(dbcalc.stop_stats(self.columns([])), [])
+
+if __name__ == '__main__':
+    unittest.main()
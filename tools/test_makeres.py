@@ -0,0 +1,144 @@
+#!/usr/bin/env python2
+# -*- coding: latin-1 -*-
+
+"""
+Tests of makeres helpers.
+
+    python -m unittest discover -s tools
+"""
+
+import unittest, tempfile, shutil, os, os.path
+from StringIO import StringIO
+import makeres
+
+class FailingFile(object):
+    def write(self, data):
+        raise IOError, "No space left on device"
+
+class FanOutTest(unittest.TestCase):
+    def test_writes_all_outputs(self):
+        outs = [StringIO(), StringIO()]
+        fan = makeres.FanOut(outs)
+        for k in range(1000):
+            fan.write("INSERT INTO counts VALUES(\"%d\", %d);\n" % (k, k))
+        fan.close()
+        self.assertEqual(outs[0].getvalue(), outs[1].getvalue())
+        self.assertEqual(outs[0].getvalue().count('\n'), 1000)
+
+    def test_failed_writer_raises(self):
+        # More blocks than the queue holds: used to block forever
+        fan = makeres.FanOut([StringIO(), FailingFile()])
+        block = 'x' * makeres.FanOut.BUFSIZE
+        def write_all():
+            for k in range(64):
+                fan.write(block)
+            fan.close()
+        self.assertRaises(IOError, write_all)
+
+    def test_failed_writer_raises_on_close(self):
+        fan = makeres.FanOut([FailingFile()])
+        fan.write('x')
+        self.assertRaises(IOError, fan.close)
+
+class ContentCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = makeres.ContentCache(os.path.join(self.tmpdir, 'cache'), 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def store(self, key, data, mtime):
+        src = os.path.join(self.tmpdir, 'src')
+        f = open(src, 'w')
+        f.write(data)
+        f.close()
+        self.cache.store(key, src)
+        os.utime(self.cache.path(key), (mtime, mtime))
+
+    def test_fetch_keeps_mtime(self):
+        # Hits are hard linked: their mtime is the one fingerprinted
+        self.store('a' * 40, 'x', 1000000)
+        dest = os.path.join(self.tmpdir, 'dest')
+        self.assertTrue(self.cache.fetch('a' * 40, dest))
+        self.assertEqual(os.stat(dest).st_mtime, 1000000)
+        self.assertFalse(self.cache.fetch('b' * 40, dest))
+
+    def test_evicts_least_recently_used(self):
+        self.store('a' * 40, 'x' * 600, 1000000)
+        self.store('b' * 40, 'x' * 600, 2000000)
+        self.cache.fetch('a' * 40, os.path.join(self.tmpdir, 'dest'))
+        self.assertEqual(self.cache.evict(), 1)
+        self.assertTrue(os.path.exists(self.cache.path('a' * 40)))
+        self.assertFalse(os.path.exists(self.cache.path('b' * 40)))
+
+class ParseTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.old_policy = makeres.dfltCirculationPolicy
+
+    def tearDown(self):
+        makeres.dfltCirculationPolicy = self.old_policy
+        shutil.rmtree(self.tmpdir)
+
+    def parse(self, lines):
+        src = os.path.join(self.tmpdir, 'line.txt')
+        f = open(src, 'w')
+        f.write('\n'.join(lines) + '\n')
+        f.close()
+        return makeres.parse(src)
+
+    def direction(self, lines):
+        return self.parse(['name=12', 'circulation=1-5', 'direction=', 'city=Montpellier'] + lines)[1][0]
+
+    def test_columns(self):
+        # Circulation patterns do not take a column, empty fields do
+        direct = self.direction(['Comedie;06:00;*6*;06:10;06:20*7*', 'Gare/Gare SNCF;06:05;;06:25'])
+        self.assertEqual(direct[0]['stops'], ['06:00', ('06:10', '6'), ('06:20', '7')])
+        self.assertEqual(direct[0]['cols'], [0, 1, 2])
+        self.assertEqual([d['station'] for d in direct], ['Comedie', 'Gare', 'Gare Sncf'])
+        self.assertEqual(direct[1]['stops'], ['06:05', '06:25'])
+        self.assertEqual(direct[1]['cols'], [0, 2])
+
+    def test_make_trips(self):
+        trips = makeres.make_trips(self.direction(['Comedie;06:00;*6*;06:10;23:50', 'Gare;06:05;;00:05']))
+        self.assertEqual(trips, [
+            {'circpat': '', 'times': [(1, 360), (2, 365)]},
+            {'circpat': '6', 'times': [(1, 370)]},
+            # Times past midnight keep increasing
+            {'circpat': '6', 'times': [(1, 1430), (2, 1445)]},
+        ])
+
+    def test_unique_trips(self):
+        trips = makeres.make_trips(self.direction(['Comedie;06:00;06:00;06:10', 'Gare;06:05;06:05;06:15']))
+        res, dropped = makeres.unique_trips(trips)
+        self.assertEqual([t['times'][0][1] for t in res], [360, 370])
+        self.assertEqual(dropped, 2)
+
+    def test_collapse_headways(self):
+        direct = self.direction(['Comedie;06:00;06:10;06:20;06:30;07:00', 'Gare;06:05;06:15;06:25;06:35;07:10'])
+        res = makeres.collapse_headways(makeres.make_trips(direct))
+        self.assertEqual([(t['times'][0][1], f) for t, f in res], [(360, (360, 390, 10)), (420, None)])
+
+    def test_collapse_needs_min_runs(self):
+        direct = self.direction(['Comedie;06:00;06:10', 'Gare;06:05;06:15'])
+        res = makeres.collapse_headways(makeres.make_trips(direct))
+        self.assertEqual([f for t, f in res], [None, None])
+
+    def test_expand_frequencies(self):
+        direct = self.direction(['frequency=2;06:40;15', 'Comedie;05:50;06:10', 'Gare;;06:14*6*'])
+        self.assertEqual(direct[0]['stops'], ['05:50', '06:10', '06:25', '06:40'])
+        self.assertEqual(direct[0]['cols'], [0, 1, 2, 3])
+        self.assertEqual(direct[1]['stops'], [('06:14', '6'), ('06:29', '6'), ('06:44', '6')])
+        self.assertEqual(direct[1]['cols'], [1, 2, 3])
+        res = makeres.collapse_headways(makeres.make_trips(direct))
+        self.assertEqual([f for t, f in res], [None, (370, 400, 15)])
+
+    def test_frequency_errors(self):
+        self.assertRaises(ValueError, self.parse, ['name=12', 'frequency=1;08:00;10', 'direction=', 'Comedie;06:00'])
+        self.assertRaises(ValueError, self.direction, ['frequency=1;8h00;10', 'Comedie;06:00'])
+        self.assertRaises(ValueError, self.direction, ['frequency=2;08:00;10', 'Comedie;06:00'])
+        self.assertRaises(ValueError, self.direction, ['frequency=1;08:00;0', 'Comedie;06:00'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python2
+# -*- coding: latin-1 -*-
+
+"""
+Tests of the COPY text helpers of psqldb and of makeres.CopyWriter.
+
+    python -m unittest discover -s tools
+"""
+
+import unittest, tempfile, shutil
+from StringIO import StringIO
+import psqldb, makeres
+
+class CopyTextTest(unittest.TestCase):
+    def test_row_escapes(self):
+        self.assertEqual(psqldb.copy_row(['a\tb', 'c\nd', 'e\\f', 'g\rh']),
+            'a\\tb\tc\\nd\te\\\\f\tg\\rh\n')
+
+    def test_row_null(self):
+        self.assertEqual(psqldb.copy_row([None, '', 'x']), '\\N\t\tx\n')
+
+    def test_round_trip(self):
+        rows = [
+            ['1', 'Saint-Jean-de-Védas', None],
+            ['2', 'tab\there', 'new\nline'],
+            ['3', 'back\\slash', ''],
+            ['4', '\\N', 'crlf\r\n'],
+        ]
+        for row in rows:
+            self.assertEqual(psqldb.copy_values(psqldb.copy_row(row)), row)
+
+    def test_literal_backslash_n_is_not_null(self):
+        self.assertEqual(psqldb.copy_values(psqldb.copy_row(['\\N'])), ['\\N'])
+
+    def test_parse_copy(self):
+        dump = StringIO(
+            "SET client_encoding = 'UTF8';\n"
+            "COPY city (id, name, latitude, longitude) FROM STDIN;\n"
+            + psqldb.copy_row(['1', 'Montpellier', '43', '3'])
+            + psqldb.copy_row(['2', 'Sète\tport', None, None])
+            + "\\.\n"
+            "COPY counts (name, value) FROM STDIN;\n"
+            "\\.\n")
+        blocks = psqldb.parse_copy(dump)
+        self.assertEqual([b[0] for b in blocks], ['city', 'counts'])
+        self.assertEqual(blocks[0][1], ['id', 'name', 'latitude', 'longitude'])
+        self.assertEqual(blocks[0][2], [['1', 'Montpellier', '43', '3'], ['2', 'Sète\tport', None, None]])
+        self.assertEqual(blocks[1][2], [])
+
+    def test_parse_copy_errors(self):
+        self.assertRaises(ValueError, psqldb.parse_copy,
+            StringIO("COPY counts (name, value) FROM STDIN;\nlines\t1\n"))
+        self.assertRaises(ValueError, psqldb.parse_copy,
+            StringIO("COPY counts (name, value) FROM STDIN;\nlines\n\\.\n"))
+
+    def test_null_dates(self):
+        row = ['1', '1', '12', '#fff', '1-6', '1', '2', '', '2015-07-04']
+        self.assertEqual(psqldb.null_dates('line', row)[7:], [None, '2015-07-04'])
+        self.assertEqual(psqldb.null_dates('city', ['1', '', '0', '0']), ['1', '', '0', '0'])
+
+class CopyWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.old_tmp_dir = makeres.TMP_DIR
+        makeres.TMP_DIR = self.tmpdir
+
+    def tearDown(self):
+        makeres.TMP_DIR = self.old_tmp_dir
+        shutil.rmtree(self.tmpdir)
+
+    def convert(self, sql):
+        out = StringIO()
+        w = makeres.CopyWriter(out)
+        w.write(sql)
+        w.close()
+        out.seek(0)
+        return dict([(t, (cols, rows)) for t, cols, rows in psqldb.parse_copy(out)])
+
+    def test_insert_to_copy(self):
+        blocks = self.convert(
+            'INSERT INTO line VALUES(3, 1, "12", "#e2001a", "1-6", 4, 5, "", "");\n'
+            'INSERT INTO line_station VALUES(NULL, 3, 7, 1, 5);\n'
+            'INSERT INTO stop VALUES(NULL, "06:01", "", 7, 3, 5, 4);\n')
+        cols, rows = blocks['line']
+        self.assertEqual(rows, [['3', '1', '12', '#e2001a', '1-6', '4', '5', None, None]])
+        # SERIAL ids are left out
+        cols, rows = blocks['line_station']
+        self.assertEqual(cols, ['line_id', 'station_id', 'rank', 'direction_id'])
+        self.assertEqual(rows, [['3', '7', '1', '5']])
+        cols, rows = blocks['stop']
+        self.assertEqual(rows, [['06:01', '', '7', '3', '5', '4']])
+
+    def test_split_writes(self):
+        sql = 'INSERT INTO city VALUES(1, "Montpellier", 43, 3);\nINSERT INTO city VALUES(2, "Sète", 0, 0);\n'
+        out = StringIO()
+        w = makeres.CopyWriter(out)
+        for k in range(0, len(sql), 7):
+            w.write(sql[k:k + 7])
+        w.close()
+        out.seek(0)
+        self.assertEqual(psqldb.parse_copy(out)[0][2], [['1', 'Montpellier', '43', '3'], ['2', 'Sète', '0', '0']])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python2
+# -*- coding: latin-1 -*-
+
+"""
+Tests of qbench helpers.
+
+    python -m unittest discover -s tools
+"""
+
+import unittest, tempfile, shutil, os.path, sqlite3
+import qbench, sqlitedb
+
+class PercentileTest(unittest.TestCase):
+    def test_nearest_rank(self):
+        values = range(1, 101)
+        self.assertEqual([qbench.percentile(values, p) for p in (50, 95, 99, 100)], [50, 95, 99, 100])
+        self.assertEqual(qbench.percentile([1, 2, 3, 4], 50), 2)
+        self.assertEqual(qbench.percentile([1, 2, 3], 50), 2)
+        self.assertEqual(qbench.percentile([7], 99), 7)
+        self.assertEqual(qbench.percentile([], 50), 0)
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbname = os.path.join(self.tmpdir, 'ht.sqlite')
+        conn = sqlite3.connect(self.dbname)
+        conn.executescript(sqlitedb.DBSTRUCT)
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_skips_empty_tables(self):
+        # Databases built with the trip timetable have an empty stop table
+        results = qbench.replay(self.dbname, [('station stops', [1, 1, 1]), ('departures', [1]), ('station', [1])])
+        self.assertEqual(results.keys(), ['station'])
+
+if __name__ == '__main__':
+    unittest.main()